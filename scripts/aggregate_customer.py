@@ -9,7 +9,27 @@ Usage:
 Behavior:
  - Uses fixed parts dir: data/stage/refined_data/
  - Writes outputs to: data/stage/aggregated/
- - Auto-cleans tmp folder before run (safe).
+ - Works in its own locked workspace agg_tmp/<mode>_<input fingerprint>/, so
+   train and test (or any differently configured runs) can run concurrently;
+   outputs are staged there and moved into place atomically when the run succeeds.
+   A failed run leaves its workspace behind; rerunning it reuses the parts it completed.
+ - With --store-dir, aggregates a customer-sorted statement store
+   (preprocess_*.py --statement-store) in one linear scan instead.
+ - With --feature-set temporal, also joins last/first/delta/slope/diff1/ewm
+   features per numeric column (customer_temporal_{train|test}.parquet).
+ - With --quantiles, also joins approximate p25/median/p75 per numeric column
+   from mergeable per-customer sketches (customer_quantile_{train|test}.parquet).
+ - With --last-k / --last-columns numeric, keeps each customer's last K
+   statements ({col}_lag0 = last statement, {col}_lag1 = the one before, ...).
+ - With --required-features, reads only the source columns and computes only
+   the statistics behind the listed features (e.g. a trained model's features).
+ - With --buckets / --combine-memory-gb, combines partials one customer bucket
+   at a time (bounded memory).
+ - With --state-dir, saves the merged per-customer state; --update then absorbs
+   new parts (e.g. one new month, preprocessed with --extend-customer-index so
+   existing customers keep their keys) into it and rewrites the outputs without
+   rereading older statements. The state records the customer index it was built
+   with, and --update refuses parts encoded with an index that does not extend it.
  - Produces:
      data/stage/aggregated/customer_level_{train|test}.parquet
      data/stage/aggregated/feature_columns_customer_{train|test}.json
@@ -18,6 +38,12 @@ Behavior:
 import argparse
 import json
 import logging
+import math
+import os
+import re
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from typing import List
 import sys
@@ -27,6 +53,27 @@ import gc
 import numpy as np
 import pandas as pd
 
+# Add project root to sys.path so src.* is importable when run as a script
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.aggregation import (
+    MOMENT_STATS,
+    QUANTILE_FEATURES,
+    QUANTILE_SKETCH_SIZE,
+    TEMPORAL_FEATURES,
+    MomentAccumulator,
+    QuantileSummary,
+    count_features,
+    segment_value_counts,
+    segment_tail,
+    sort_segments,
+    sorted_matrix,
+    tail_frame,
+    temporal_features,
+    time_sort_key,
+)
+from src.prefetch import DEFAULT_PREFETCH_DEPTH, prefetch_parquet, read_present_columns
+
 logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
 
 
@@ -35,15 +82,18 @@ logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
 # -----------------------
 PARTS_DIR = Path("data/stage/refined_data")
 OUT_DIR = Path("data/stage/aggregated")
+CATEGORY_MAP_PATH = Path("data/stage/category_map.json")
+CUSTOMER_INDEX_FMT = "data/stage/customer_index_{}.parquet"
 TMP_DIR_NAME = "agg_tmp"
 
 # These lists attempt to match your src.preprocessing; if you modify src you can keep this file unchanged.
 # If you have src.preprocessing available, the script will import and use those lists instead.
 try:
-    from src.preprocessing import FLOAT16_COLS, FLOAT32_COLS, BOOL_COLS, CATEGORICAL_COLS
+    from src.preprocessing import FLOAT16_COLS, FLOAT32_COLS, BOOL_COLS, CATEGORICAL_COLS, CUSTOMER_KEY_COL
     logging.info("Imported column lists from src.preprocessing")
 except Exception:
     logging.info("Falling back to embedded defaults for column lists")
+    CUSTOMER_KEY_COL = "customer_key"
     BOOL_COLS = ["B_31"]
     FLOAT16_COLS = [
         "D_66", "D_68", "B_30", "D_87", "B_38", "D_114", "D_116",
@@ -60,36 +110,294 @@ LINEAR_CAT_COLS = sorted(set(CATEGORICAL_COLS + ADDITIONAL_CAT))
 # numeric base - will be intersected with actual columns present in each part
 NUMERIC_BASE = list(set(FLOAT16_COLS + FLOAT32_COLS))
 
-LAST_ROW_KEEP = ["customer_ID", "S_2"] + ADDITIONAL_CAT
+# Parts carry the dense int32 customer key (see src.preprocessing.build_customer_index);
+# every groupby/merge/sort below runs on it instead of the customer_ID strings.
+CUSTOMER_COL = CUSTOMER_KEY_COL
+
+LAST_ROW_KEEP = [CUSTOMER_COL, "S_2"] + ADDITIONAL_CAT
+
+# Feature sets selectable with --feature-set; "temporal" adds the sequence features
+# of src.aggregation.temporal_features (customer_temporal_{mode}.parquet)
+FEATURE_SETS = ["base", "temporal"]
+EWM_ALPHA = 0.5
 
 # -----------------------
 # Utility helpers
 # -----------------------
+_PART_NAME_RE = re.compile(r"^(.*)_part(\d+)$")
+
+
+def part_sort_key(path: Path):
+    """
+    Sort key restoring CSV order of the `{prefix}_part{i}.parquet` files written by
+    preprocess_and_save_parquet: prefix, then numeric part index (part2 before
+    part10, unlike a string sort). Other files sort by name.
+    """
+    match = _PART_NAME_RE.match(Path(path).stem)
+    if match is None:
+        return Path(path).stem, -1
+    return match.group(1), int(match.group(2))
+
+
 def find_parquet_parts(parts_dir: Path):
-    parts = sorted([p for p in parts_dir.glob("*.parquet") if p.is_file()])
+    parts = sorted([p for p in parts_dir.glob("*.parquet") if p.is_file()], key=part_sort_key)
     return parts
 
 
-def _clean_tmp(tmp_dir: Path):
-    if tmp_dir.exists():
-        logging.info("Auto-clean enabled: removing tmp dir %s", tmp_dir)
-        for f in tmp_dir.glob("*"):
-            try:
-                f.unlink()
-            except Exception:
-                pass
-    tmp_dir.mkdir(parents=True, exist_ok=True)
+# -----------------------
+# Run workspaces
+# -----------------------
+# Every run works in <out_dir>/agg_tmp/<mode>_<fingerprint>/ under an exclusive
+# lock, so train and test (or differently configured) runs never share tmp files.
+# Outputs are staged in the workspace and moved into out_dir with os.replace.
+STAGE_DIR_NAME = "out"
+STATE_STAGE_NAME = "state"
+COMBINE_DIR_NAME = "combined"
+# Options that change how a run executes but not what it produces
+RUN_ONLY_ARGS = {"workers", "max_memory_gb", "prefetch", "verbose", "out_dir"}
+
+
+def input_fingerprint(paths: List[Path], options: dict) -> str:
+    """Short hash of the input files (path, size, mtime) and the output-relevant options."""
+    import hashlib
+
+    digest = hashlib.sha1()
+    for path in sorted(Path(p).resolve() for p in paths):
+        st = path.stat()
+        digest.update(f"{path}|{st.st_size}|{st.st_mtime_ns}\n".encode())
+    digest.update(json.dumps(options, sort_keys=True, default=str).encode())
+    return digest.hexdigest()[:12]
+
+
+def acquire_lock(lock_path: Path):
+    """
+    Takes an exclusive advisory lock on `lock_path`, waiting while another run
+    holds it. The lock lives as long as the returned file object (normally the
+    whole run) and the OS drops it if the process dies, so it never goes stale.
+    """
+    import fcntl
+
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    handle = open(lock_path, "a")
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        logging.info("Waiting for lock %s (held by another run)...", lock_path)
+        fcntl.flock(handle, fcntl.LOCK_EX)
+    return handle
+
+
+def publish_outputs(stage_dir: Path, out_dir: Path) -> List[Path]:
+    """Moves every staged output into out_dir; each file is replaced atomically."""
+    out_dir.mkdir(parents=True, exist_ok=True)
+    published = []
+    for staged in sorted(stage_dir.glob("*")):
+        os.replace(staged, out_dir / staged.name)
+        published.append(out_dir / staged.name)
+    return published
+
+
+def prepare_workspace(workspace: Path) -> None:
+    """
+    Creates the run's workspace or, left behind by an interrupted run on the same
+    inputs and options, keeps its completed part partials (resumed by
+    run_per_part_aggregates) and drops what the combine steps had written.
+    """
+    if workspace.exists():
+        logging.info("Resuming workspace of an interrupted run: %s", workspace)
+    for name in (STAGE_DIR_NAME, STATE_STAGE_NAME, COMBINE_DIR_NAME):
+        shutil.rmtree(workspace / name, ignore_errors=True)
+    (workspace / STAGE_DIR_NAME).mkdir(parents=True)
+
+
+def finish_run(workspace: Path, out_dir: Path, state_dir: Path = None, manifest: dict = None) -> None:
+    """
+    Publishes the staged outputs of a successful run, then the new aggregation
+    state staged in <workspace>/state (with --state-dir), and removes the workspace.
+    The state goes last: until it is saved, the manifest does not list the new
+    batches, so a run that fails before this point absorbs them again on rerun.
+    """
+    for path in publish_outputs(workspace / STAGE_DIR_NAME, out_dir):
+        logging.info("Published %s", path)
+    if state_dir:
+        save_state(workspace / STATE_STAGE_NAME, state_dir, manifest)
+        logging.info("Saved aggregation state to %s (%d batches)", state_dir, len(manifest["batches"]))
+    shutil.rmtree(workspace, ignore_errors=True)
+
+
+# -----------------------
+# Categorical count state
+# -----------------------
+# The categorical partial holds one `{col}__{value}` count column per observed value,
+# `{col}_last` (value at the part's latest statement) and the part's latest time_col.
+# Counts merge across parts by addition; mode/nunique/shares are derived from them.
+CAT_COUNT_SEP = "__"
+
+
+def _cat_values(series: pd.Series, col: str) -> np.ndarray:
+    """Known-cardinality categoricals as float64, string ones (D_63/D_64) as object."""
+    if col in CATEGORICAL_COLS:
+        return series.astype("float64").to_numpy()
+    return series.astype(object).to_numpy()
+
+
+def _value_label(col: str, value) -> str:
+    return str(float(value)) if col in CATEGORICAL_COLS else str(value)
+
+
+def _sorted_labels(col: str, labels) -> List[str]:
+    return sorted(labels, key=float if col in CATEGORICAL_COLS else str)
+
+
+def cat_count_state(df: pd.DataFrame, order: np.ndarray, offsets: np.ndarray, segment_keys: np.ndarray,
+                    cat_cols: List[str], customer_col: str = CUSTOMER_COL, time_col: str = "S_2") -> pd.DataFrame:
+    """
+    Per-customer categorical state of `df` (rows grouped by sort_segments' order/offsets).
+    `{col}_last` and time_col come from each segment's last row: the latest dated
+    statement when the order was sorted on time_sort_key.
+    """
+    last_rows = order[offsets[1:] - 1]
+    state = {customer_col: segment_keys}
+    if time_col in df.columns:
+        state[time_col] = df[time_col].to_numpy()[last_rows]
+    for c in cat_cols:
+        values = _cat_values(df[c], c)
+        counts, uniques = segment_value_counts(values[order], offsets)
+        for j, value in enumerate(uniques):
+            state[f"{c}{CAT_COUNT_SEP}{_value_label(c, value)}"] = counts[:, j]
+        state[f"{c}_last"] = values[last_rows]
+    return pd.DataFrame(state)
+
+
+def cat_vocabulary(state_columns: List[str], cat_cols: List[str], category_map: dict = None) -> dict:
+    """
+    Value labels that get a share feature, per column: the train category map when
+    given (identical feature columns for train and test), else the observed values.
+    """
+    vocabulary = {}
+    for c in cat_cols:
+        if category_map and category_map.get(c):
+            labels = {_value_label(c, v) for v in category_map[c] if v is not None}
+        else:
+            prefix = f"{c}{CAT_COUNT_SEP}"
+            labels = {n[len(prefix):] for n in state_columns if n.startswith(prefix)}
+        vocabulary[c] = _sorted_labels(c, labels)
+    return vocabulary
+
+
+def derive_cat_features(state: pd.DataFrame, cat_cols: List[str], vocabulary: dict) -> pd.DataFrame:
+    """
+    Vectorized categorical features from merged count state (index = customer):
+      {c}_mode, {c}_nunique, {c}_last and {c}_share_{value} for each vocabulary value.
+    Numeric categoricals keep their values; string ones are encoded as their
+    position in the vocabulary (NaN if unseen) so every feature is numeric.
+    """
+    out = {}
+    for c in cat_cols:
+        if f"{c}_last" not in state.columns:
+            continue
+        prefix = f"{c}{CAT_COUNT_SEP}"
+        observed = {n[len(prefix):] for n in state.columns if n.startswith(prefix)}
+        labels = _sorted_labels(c, observed | set(vocabulary[c]))
+        counts = state.reindex(columns=[f"{prefix}{label}" for label in labels]).fillna(0).to_numpy(np.int64)
+        feats = count_features(counts)
+
+        if c in CATEGORICAL_COLS:
+            label_values = np.array([float(label) for label in labels] + [np.nan])
+            last = state[f"{c}_last"].astype("float64")
+        else:
+            code_of = {label: float(i) for i, label in enumerate(vocabulary[c])}
+            label_values = np.array([code_of.get(label, np.nan) for label in labels] + [np.nan])
+            last = state[f"{c}_last"].map(code_of).astype("float64")
+
+        # mode == -1 (no values) picks the trailing NaN
+        out[f"{c}_mode"] = label_values[feats["mode"]]
+        out[f"{c}_nunique"] = feats["nunique"]
+        out[f"{c}_last"] = last.to_numpy()
+        for label in vocabulary[c]:
+            out[f"{c}_share_{label}"] = feats["share"][:, labels.index(label)]
+    return pd.DataFrame(out, index=state.index)
+
+
+# -----------------------
+# Customer buckets (out-of-core combine)
+# -----------------------
+BUCKET_DIR_FMT = "bucket{:04d}"
+# Peak memory of combining one bucket relative to its partials' raw float64 size
+COMBINE_MEMORY_FACTOR = 3
+# Rough categorical partial width per column (value counts + last value)
+CAT_STATE_COLS = 10
+
+
+def customer_bucket(keys: np.ndarray, n_buckets: int, n_keys: int) -> np.ndarray:
+    """
+    Bucket of each customer key. Keys are dense (0..n_keys-1), so contiguous key
+    ranges spread customers evenly and keep the final output sorted by key.
+    """
+    return (np.asarray(keys, dtype=np.int64) * n_buckets) // n_keys
+
+
+def bucket_key_range(bucket: int, n_buckets: int, n_keys: int):
+    """[lo, hi) customer keys of `bucket` (inverse of customer_bucket)."""
+    return -(-bucket * n_keys // n_buckets), -(-(bucket + 1) * n_keys // n_buckets)
+
+
+def count_customer_keys(parts: List[Path], customer_col: str = CUSTOMER_COL) -> int:
+    """max(customer key) + 1 over all parts, from parquet column statistics when available."""
+    import pyarrow.parquet as pq
+
+    max_key = -1
+    for part in parts:
+        meta = pq.read_metadata(part)
+        idx = meta.schema.names.index(customer_col)
+        stats = [meta.row_group(i).column(idx).statistics for i in range(meta.num_row_groups)]
+        if all(st is not None and st.has_min_max for st in stats):
+            max_key = max([max_key] + [int(st.max) for st in stats])
+        else:
+            keys = pd.read_parquet(part, columns=[customer_col])[customer_col]
+            max_key = max(max_key, int(keys.max()) if len(keys) else -1)
+    return max_key + 1
+
+
+def choose_buckets(parts: List[Path], numeric_cols: List[str], cat_cols: List[str], memory_budget: int,
+                   extra_width: int = 0) -> int:
+    """
+    Buckets needed so combining one bucket fits `memory_budget` bytes. Uses the
+    worst case of one partial row per statement, so the bound holds for any
+    number of statements or parts.
+    """
+    import pyarrow.parquet as pq
+
+    rows = sum(pq.read_metadata(p).num_rows for p in parts)
+    width = len(numeric_cols) * len(MOMENT_STATS) + len(cat_cols) * CAT_STATE_COLS + extra_width
+    return max(1, math.ceil(rows * width * 8 * COMBINE_MEMORY_FACTOR / memory_budget))
+
+
+def _part_marker(tmp_dir: Path, part_stem: str, n_buckets: int = 1) -> Path:
+    """File whose presence means the part's partials are complete (resume)."""
+    if n_buckets > 1:
+        return tmp_dir / f"{part_stem}.done"
+    return tmp_dir / f"{part_stem}_numeric.parquet"
 
 
 # -----------------------
 # Per-part processing
 # -----------------------
+def part_columns(numeric_cols: List[str], cat_cols: List[str], customer_col: str = CUSTOMER_COL,
+                 time_col: str = "S_2", quantile_cols: List[str] = (), last_cols: List[str] = ()) -> List[str]:
+    """Columns per_part_aggregates reads from a part (those missing from the part are skipped)."""
+    return list(dict.fromkeys([customer_col, time_col, *numeric_cols, *cat_cols, *quantile_cols, *last_cols]))
+
+
 def per_part_aggregates(part_path: str, tmp_dir: str, numeric_cols: List[str], cat_cols: List[str],
-                        customer_col: str = "customer_ID", time_col: str = "S_2") -> None:
+                        customer_col: str = CUSTOMER_COL, time_col: str = "S_2",
+                        n_buckets: int = 1, n_keys: int = None, quantile_cols: List[str] = (),
+                        sketch_size: int = QUANTILE_SKETCH_SIZE, last_k: int = 1,
+                        last_cols: List[str] = (), df: pd.DataFrame = None) -> None:
     """
     Process a single parquet part and write three partial parquet outputs:
-      - numeric partial (count, sum, sumsq, mean, std, min, max)
-      - categorical partial (mode, nunique)
+      - numeric partial (MomentAccumulator state: count, mean, M2, min, max)
+      - categorical partial (per-value counts and last value, see cat_count_state)
       - last-row partial (last row columns for each customer by time_col)
 
     Args:
@@ -97,8 +405,17 @@ def per_part_aggregates(part_path: str, tmp_dir: str, numeric_cols: List[str], c
         tmp_dir: directory where partial parquet files will be written.
         numeric_cols: list of numeric columns to aggregate.
         cat_cols: list of categorical columns to summarise.
-        customer_col: name of the customer id column (default 'customer_ID').
+        customer_col: name of the customer key column (default 'customer_key').
         time_col: name of the timestamp column used to pick the last row (default 'S_2').
+        n_buckets: if > 1, partials are split by customer_bucket() into
+            <tmp_dir>/bucketNNNN/ directories (out-of-core combine, see combine_bucketed).
+        n_keys: number of customer keys (max key + 1), required with n_buckets > 1.
+        quantile_cols: columns to summarize with a QuantileSummary of `sketch_size`
+            points (<part_stem>_quantile.parquet); empty = no quantile features.
+        last_k: number of latest statements kept per customer in the last partial.
+        last_cols: columns kept for those statements besides the key and time_col.
+        df: the part, already read (e.g. by prefetch_parquet) with part_columns();
+            read from part_path if None.
 
     Notes:
         - If a column in numeric_cols/cat_cols is not present in the part, it is skipped.
@@ -106,6 +423,8 @@ def per_part_aggregates(part_path: str, tmp_dir: str, numeric_cols: List[str], c
             <tmp_dir>/<part_stem>_numeric.parquet
             <tmp_dir>/<part_stem>_cat.parquet
             <tmp_dir>/<part_stem>_last.parquet
+          or, bucketed, as <tmp_dir>/bucketNNNN/<part_stem>_{numeric,cat,last}.parquet
+          plus a <tmp_dir>/<part_stem>.done marker.
     """
     import pandas as pd
     import numpy as np
@@ -116,7 +435,10 @@ def per_part_aggregates(part_path: str, tmp_dir: str, numeric_cols: List[str], c
 
     print(f"[INFO] Processing part: {p.name}")
 
-    df = pd.read_parquet(part_path)
+    # Read only the columns some statistic needs (projection pushdown)
+    if df is None:
+        df = read_present_columns(part_path, part_columns(numeric_cols, cat_cols, customer_col, time_col,
+                                                          quantile_cols, last_cols))
 
     if customer_col not in df.columns:
         raise KeyError(f"{customer_col} not found in part {part_path}")
@@ -128,110 +450,57 @@ def per_part_aggregates(part_path: str, tmp_dir: str, numeric_cols: List[str], c
     # -------------------------
     # Numeric aggregations
     # -------------------------
-    present_numeric = [c for c in numeric_cols if c in df.columns]
-    numeric_agg_frames = []
+    present_numeric = list(dict.fromkeys(c for c in numeric_cols if c in df.columns))
+
+    # Factorize the customer key and sort (customer, time) once; every statistic
+    # below is a segment reduction over this ordering.
+    times = time_sort_key(df[time_col]) if time_col in df.columns else None
+    order, segment_keys, offsets = sort_segments(df[customer_col].to_numpy(), times)
 
     if present_numeric:
-        grp = df.groupby(customer_col)[present_numeric]
-
-        # We'll compute count, sum, sumsq, mean, std, min, max in vectorized way
-        # count & sum
-        cnt = grp.count().rename(columns={c: f"{c}_count" for c in present_numeric})
-        summ = grp.sum().rename(columns={c: f"{c}_sum" for c in present_numeric})
-        # sum of squares (for potential variance calc)
-        # compute via (x * x).sum() per group
-        sumsqs = grp.apply(lambda g: (g**2).sum()).rename(columns={c: f"{c}_sumsq" for c in present_numeric})
-
-        # min/max/mean/std
-        minn = grp.min().rename(columns={c: f"{c}_min" for c in present_numeric})
-        maxx = grp.max().rename(columns={c: f"{c}_max" for c in present_numeric})
-        mean = grp.mean().rename(columns={c: f"{c}_mean" for c in present_numeric})
-        std = grp.std(ddof=0).rename(columns={c: f"{c}_std" for c in present_numeric})  # population std (ddof=0)
-
-        # Combine numeric pieces into a single DataFrame with a single concat to avoid fragmentation
-        numeric_parts = [cnt, summ, sumsqs, mean, std, minn, maxx]
-        numeric_df = pd.concat(numeric_parts, axis=1)
-
-        # Defensive: ensure unique column names (remove duplicates, keep first)
-        if numeric_df.columns.duplicated().any():
-            numeric_df = numeric_df.loc[:, ~numeric_df.columns.duplicated()]
-
-        # Reset index to have customer_ID as column (but be careful about collisions)
-        numeric_out = numeric_df.reset_index()
+        # float64 accumulation regardless of the float16/float32 storage dtype
+        values = sorted_matrix(df, present_numeric, order)
+        numeric_out = MomentAccumulator.from_values(segment_keys, present_numeric, values, offsets).to_frame(customer_col)
     else:
         # create an empty numeric_out with only customer col
         numeric_out = pd.DataFrame(columns=[customer_col])
 
+    # -------------------------
+    # Quantile sketches
+    # -------------------------
+    present_quantile = [c for c in quantile_cols if c in df.columns]
+    quantile_out = None
+    if present_quantile:
+        values = sorted_matrix(df, present_quantile, order)
+        quantile_out = QuantileSummary.from_values(segment_keys, present_quantile, values, offsets,
+                                                   sketch_size).to_frame(customer_col)
+
     # -------------------------
     # Categorical aggregations
     # -------------------------
     present_cat = [c for c in cat_cols if c in df.columns]
-    if present_cat:
-        # We'll compute mode and nunique per customer for each categorical col.
-        # Building a dict of Series to concat once (avoid repeated inserts).
-        cat_result_series = {}
-        gcat = df.groupby(customer_col)
-
-        # mode calculation helper: robust to empties
-        def safe_mode(s):
-            m = s.mode()
-            if m.empty:
-                return pd.NA
-            return m.iloc[0]
-
-        for c in present_cat:
-            # mode
-            mode_ser = gcat[c].agg(safe_mode).rename(f"{c}_mode")
-            # nunique
-            nunq = gcat[c].nunique(dropna=True).rename(f"{c}_nunique")
-            cat_result_series[f"{c}_mode"] = mode_ser
-            cat_result_series[f"{c}_nunique"] = nunq
-
-        if cat_result_series:
-            cat_df = pd.concat(cat_result_series.values(), axis=1)
-            # ensure index name preserved
-            cat_df.index.name = customer_col
-            # drop duplicated columns if any
-            if cat_df.columns.duplicated().any():
-                cat_df = cat_df.loc[:, ~cat_df.columns.duplicated()]
-            cat_out = cat_df.reset_index()
-        else:
-            cat_out = pd.DataFrame(columns=[customer_col])
+    if present_cat and len(offsets) > 1:
+        # Mergeable state: per-(customer, value) counts + value at the latest statement
+        cat_out = cat_count_state(df, order, offsets, segment_keys, present_cat, customer_col, time_col)
     else:
         cat_out = pd.DataFrame(columns=[customer_col])
 
     # -------------------------
-    # Last-row per customer (by timestamp)
+    # Last k rows per customer (by timestamp)
     # -------------------------
-    # We'll keep all columns listed in LAST_ROW_KEEP if present; otherwise fallback to S_2 and customer_ID
-    LAST_ROW_KEEP = ["customer_ID", time_col]  # adjust externally if you want more columns kept
-    keep_cols = [c for c in LAST_ROW_KEEP if c in df.columns]
-
-    if time_col in df.columns:
-        # idx of last row per customer
-        idx = df.groupby(customer_col)[time_col].idxmax()
-        # idx may contain NaN for groups where time is all NaT; drop those
-        idx = idx.dropna().astype(int)
-        if len(idx) > 0:
-            last_rows = df.loc[idx, keep_cols + []].copy()  # keep a copy
-            # make sure customer_ID is a column, not index
-            if customer_col not in last_rows.columns and last_rows.index.name == customer_col:
-                last_rows = last_rows.reset_index()
-            # If customer_ID is index and also present as a column, remove duplicate column
-            if customer_col in last_rows.columns and last_rows.index.name == customer_col:
-                last_rows = last_rows.reset_index()
-            last_out = last_rows.drop_duplicates(subset=[customer_col]).reset_index(drop=True)
-        else:
-            last_out = pd.DataFrame(columns=[customer_col] + [time_col])
+    keep_cols = [c for c in dict.fromkeys([customer_col, time_col, *last_cols]) if c in df.columns]
+
+    # Rows are sorted by (customer, time), so the last k rows of each segment are
+    # the latest statements (or the last appearances when there is no time column).
+    if len(offsets) > 1:
+        rows, _, _ = segment_tail(offsets, last_k)
+        last_out = df.iloc[order[rows]][keep_cols].reset_index(drop=True)
+        if time_col in last_out.columns:
+            # undated statements sort first (time_sort_key), so they only reach the
+            # tail of customers with fewer than k dated ones; they are never "latest"
+            last_out = last_out[last_out[time_col].notna()].reset_index(drop=True)
     else:
-        # No time column: fallback to taking the last appearance per customer by occurrence order
-        idx = df.groupby(customer_col).apply(lambda g: g.index[-1] if len(g) else None)
-        idx = idx.dropna().astype(int)
-        if len(idx) > 0:
-            last_rows = df.loc[idx, keep_cols + []].copy()
-            last_out = last_rows.drop_duplicates(subset=[customer_col]).reset_index(drop=True)
-        else:
-            last_out = pd.DataFrame(columns=[customer_col])
+        last_out = pd.DataFrame(columns=keep_cols)
 
     # Defensive: ensure no duplicate columns across outputs before writing
     def _dedup_columns_out(df_out: pd.DataFrame) -> pd.DataFrame:
@@ -249,86 +518,460 @@ def per_part_aggregates(part_path: str, tmp_dir: str, numeric_cols: List[str], c
     tmp_dir_p = Path(tmp_dir)
     tmp_dir_p.mkdir(parents=True, exist_ok=True)
 
-    numeric_path = tmp_dir_p / f"{part_stem}_numeric.parquet"
-    cat_path = tmp_dir_p / f"{part_stem}_cat.parquet"
-    last_path = tmp_dir_p / f"{part_stem}_last.parquet"
-
-    # Use to_parquet once per file
-    numeric_out.to_parquet(numeric_path, index=False)
-    cat_out.to_parquet(cat_path, index=False)
-    last_out.to_parquet(last_path, index=False)
+    # the numeric partial doubles as the completion marker (_part_marker): written last
+    outputs = [("cat", cat_out), ("last", last_out), ("numeric", numeric_out)]
+    if quantile_out is not None:
+        outputs.insert(0, ("quantile", quantile_out))
+
+    if n_buckets > 1:
+        for kind, out in outputs:
+            if out.empty:
+                continue
+            buckets = customer_bucket(out[customer_col].to_numpy(), n_buckets, n_keys)
+            for b in np.unique(buckets):
+                bucket_dir = tmp_dir_p / BUCKET_DIR_FMT.format(b)
+                bucket_dir.mkdir(exist_ok=True)
+                out[buckets == b].to_parquet(bucket_dir / f"{part_stem}_{kind}.parquet", index=False)
+        _part_marker(tmp_dir_p, part_stem, n_buckets).touch()
+        print(f"[INFO] Wrote bucketed partials for part: {part_stem}")
+        return
+
+    # Use to_parquet once per file; renamed into place, so an interrupted write leaves no partial file
+    for kind, out in outputs:
+        path = tmp_dir_p / f"{part_stem}_{kind}.parquet"
+        out.to_parquet(path.with_suffix(".tmp"), index=False)
+        os.replace(path.with_suffix(".tmp"), path)
 
     print(f"[INFO] Wrote partials for part: {part_stem}")
 
+# -----------------------
+# Parallel per-part execution
+# -----------------------
+# Peak memory of per_part_aggregates relative to the part's raw float64 size
+# (DataFrame + sorted float64 matrix + temporaries).
+PART_MEMORY_FACTOR = 4
+
+
+def _available_memory_bytes():
+    """Currently available physical memory (Linux/macOS sysconf), or None if unknown."""
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _estimate_part_memory(part_path: Path) -> int:
+    """Rough peak bytes needed to aggregate one part, from its parquet metadata."""
+    import pyarrow.parquet as pq
+
+    try:
+        meta = pq.read_metadata(part_path)
+    except Exception:
+        # unreadable part: it will be reported as failed by its worker
+        return 0
+    return meta.num_rows * meta.num_columns * 8 * PART_MEMORY_FACTOR
+
+
+def memory_limited_workers(parts: List[Path], workers: int, memory_budget: int = None) -> int:
+    """
+    Caps `workers` so that that many of the largest parts fit in the memory budget
+    (default: 80% of currently available memory). Always at least 1.
+    """
+    if workers <= 1 or not parts:
+        return 1
+    if memory_budget is None:
+        available = _available_memory_bytes()
+        if available is None:
+            return workers
+        memory_budget = int(available * 0.8)
+    per_part = max(_estimate_part_memory(p) for p in parts)
+    limit = max(1, memory_budget // max(per_part, 1))
+    if limit < workers:
+        logging.info("Limiting workers %d -> %d (~%.1f GB per part, budget %.1f GB)",
+                     workers, limit, per_part / 1e9, memory_budget / 1e9)
+    return int(min(workers, limit))
+
+
+def _run_part(task, df=None):
+    """
+    Process-pool entry point:
+    (part_path, tmp_dir, numeric_cols, cat_cols, options) -> (name, seconds, error),
+    where options are keyword arguments of per_part_aggregates. `df` is the
+    prefetched part (serial runs).
+    """
+    part_path, tmp_dir, numeric_cols, cat_cols, options = task
+    start = time.time()
+    try:
+        per_part_aggregates(part_path, tmp_dir, numeric_cols, cat_cols, df=df, **options)
+    except Exception as e:
+        return Path(part_path).name, time.time() - start, f"{type(e).__name__}: {e}"
+    return Path(part_path).name, time.time() - start, None
+
+
+def run_per_part_aggregates(parts: List[Path], tmp_dir: Path, numeric_cols: List[str], cat_cols: List[str],
+                            workers: int = 1, memory_budget: int = None,
+                            n_buckets: int = 1, n_keys: int = None, quantile_cols: List[str] = (),
+                            sketch_size: int = QUANTILE_SKETCH_SIZE, last_k: int = 1,
+                            last_cols: List[str] = (), prefetch: int = DEFAULT_PREFETCH_DEPTH) -> List[str]:
+    """
+    Runs per_part_aggregates over `parts`, skipping parts whose numeric partial
+    already exists (resume), serially or on a memory-limited process pool.
+    Serial runs read up to `prefetch` parts ahead on a background thread
+    (0 = read each part when it is processed).
+
+    Returns:
+        Names of the parts that failed (their partials are incomplete).
+    """
+    pending = []
+    for pth in parts:
+        marker = _part_marker(tmp_dir, pth.stem, n_buckets)
+        if marker.exists() and (n_buckets > 1 or marker.stat().st_size > 0):
+            logging.info("Skipping already-processed part: %s", pth.name)
+            continue
+        pending.append(pth)
+
+    options = dict(n_buckets=n_buckets, n_keys=n_keys, quantile_cols=list(quantile_cols), sketch_size=sketch_size,
+                   last_k=last_k, last_cols=list(last_cols))
+    tasks = [(str(pth), str(tmp_dir), numeric_cols, cat_cols, options) for pth in pending]
+    workers = memory_limited_workers(pending, workers, memory_budget)
+    logging.info("Aggregating %d parts with %d worker(s)", len(tasks), workers)
+
+    failed = []
+
+    def _report(done, result):
+        name, seconds, error = result
+        if error:
+            failed.append(name)
+            logging.error("[%d/%d] Part %s failed after %.1fs: %s", done, len(tasks), name, seconds, error)
+        else:
+            logging.info("[%d/%d] Part %s done in %.1fs", done, len(tasks), name, seconds)
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_run_part, task) for task in tasks]
+            for done, future in enumerate(as_completed(futures), start=1):
+                _report(done, future.result())
+    else:
+        columns = part_columns(numeric_cols, cat_cols, quantile_cols=quantile_cols, last_cols=last_cols)
+        reader = prefetch_parquet([task[0] for task in tasks], columns=columns, depth=prefetch, return_errors=True)
+        for done, (task, (_, df)) in enumerate(zip(tasks, reader), start=1):
+            if isinstance(df, Exception):
+                _report(done, (Path(task[0]).name, 0.0, f"{type(df).__name__}: {df}"))
+                continue
+            _report(done, _run_part(task, df=df))
+            del df
+    return failed
+
+
+class ParquetAppender:
+    """
+    Appends DataFrames to parquet files batch by batch; the first batch written to
+    a path fixes its schema and later batches are cast to it.
+    """
+
+    def __init__(self):
+        self.writers = {}
+
+    def append(self, path: Path, df: pd.DataFrame):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if path not in self.writers:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.writers[path] = pq.ParquetWriter(str(path), table.schema)
+        self.writers[path].write_table(table.cast(self.writers[path].schema))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for writer in self.writers.values():
+            writer.close()
+
+
+# -----------------------
+# Temporal features
+# -----------------------
+def temporal_frame(df: pd.DataFrame, offsets: np.ndarray, segment_keys: np.ndarray, columns: List[str],
+                   features=TEMPORAL_FEATURES, alpha: float = EWM_ALPHA,
+                   customer_col: str = CUSTOMER_COL) -> pd.DataFrame:
+    """
+    {col}_{feature} temporal features for `df`, whose rows are already sorted by
+    (customer, time) with customer j spanning rows [offsets[j], offsets[j + 1]).
+    """
+    feats = temporal_features(sorted_matrix(df, columns), offsets, features=features, alpha=alpha)
+    out = {customer_col: segment_keys}
+    for j, c in enumerate(columns):
+        for f in features:
+            out[f"{c}_{f}"] = feats[f][:, j]
+    return pd.DataFrame(out)
+
+
+def iter_customer_segments(parts: List[Path], columns: List[str], customer_col: str = CUSTOMER_COL,
+                           time_col: str = "S_2"):
+    """
+    Streams parts in order and yields (batch, offsets, keys) with whole customers
+    only, rows sorted by (customer, time). The customer on the last row of a part
+    may continue in the next part, so its rows are carried over.
+
+    Requires each customer's rows to be contiguous across the ordered parts (the
+    raw CSV is grouped by customer); otherwise raises and a statement store
+    (--store-dir) has to be used instead. Parts must be in CSV order
+    (part_sort_key), which is checked up front.
+    """
+    order = [part_sort_key(p) for p in parts]
+    if order != sorted(order):
+        raise ValueError("Temporal features need the parts in CSV order (part0, part1, ..., part10, ...), got "
+                         + ", ".join(Path(p).name for p in parts[:12]))
+
+    carry = None
+    finished = np.zeros(0, dtype=bool)
+    for i, part in enumerate(parts):
+        df = pd.read_parquet(part, columns=columns)
+        if carry is not None:
+            df = pd.concat([carry, df], ignore_index=True)
+        if df.empty:
+            continue
+        keys = df[customer_col].to_numpy()
+        if len(finished) <= keys.max():
+            finished = np.pad(finished, (0, int(keys.max()) + 1 - len(finished)))
+        if finished[keys].any():
+            raise ValueError(f"Customers in {Path(part).name} already appeared in earlier parts; "
+                             "temporal features need customer-contiguous parts (use --store-dir)")
+
+        if i < len(parts) - 1:
+            tail = keys == keys[-1]
+            carry, df, keys = df[tail], df[~tail], keys[~tail]
+            if df.empty:
+                continue
+
+        times = time_sort_key(df[time_col]) if time_col in df.columns else None
+        order, segment_keys, offsets = sort_segments(keys, times)
+        finished[segment_keys] = True
+        yield df.iloc[order].reset_index(drop=True), offsets, segment_keys
+
+
+def aggregate_temporal_from_parts(parts: List[Path], out_path: Path, columns: List[str],
+                                  features=TEMPORAL_FEATURES, alpha: float = EWM_ALPHA,
+                                  customer_col: str = CUSTOMER_COL, time_col: str = "S_2") -> None:
+    """Writes customer_temporal_{mode}.parquet from the parts in one streaming pass."""
+    import pyarrow.parquet as pq
+
+    present = pq.read_schema(parts[0]).names if parts else []
+    columns = [c for c in columns if c in present]
+    read_cols = [c for c in (customer_col, time_col) if c in present] + columns
+    with ParquetAppender() as appender:
+        for batch, offsets, keys in iter_customer_segments(parts, read_cols, customer_col, time_col):
+            appender.append(out_path, temporal_frame(batch, offsets, keys, columns, features, alpha, customer_col))
+
+
+# -----------------------
+# Statement-store aggregation
+# -----------------------
+def aggregate_from_store(store_dir: Path, numeric_out: Path, cat_out: Path, last_out: Path,
+                         numeric_cols: List[str], cat_cols: List[str], category_map: dict = None,
+                         temporal_out: Path = None, temporal_cols: List[str] = (),
+                         temporal=TEMPORAL_FEATURES, ewm_alpha: float = EWM_ALPHA, last_k: int = 1,
+                         last_cols: List[str] = (), customer_col: str = CUSTOMER_COL,
+                         time_col: str = "S_2") -> None:
+    """
+    Single linear scan over a customer-sorted statement store
+    (see src/statement_store.py) writing the same numeric/cat/last tables as
+    the combine_* functions.
+
+    Every store batch holds whole customers, so each customer is finished in
+    one batch: no tmp partials, no combine step, and the last statement is
+    simply the last row of its segment (rows are sorted by time_col). With
+    `temporal_out`, temporal features are written in the same scan.
+    """
+    from src.statement_store import STATEMENTS_FILE, StatementStore
+
+    store = StatementStore(str(store_dir))
+    present_numeric = [c for c in numeric_cols if c in store.columns]
+    present_cat = [c for c in cat_cols if c in store.columns]
+    present_temporal = [c for c in temporal_cols if c in store.columns]
+    keep_cols = [c for c in dict.fromkeys([customer_col, time_col, *last_cols]) if c in store.columns]
+    columns = list(dict.fromkeys(keep_cols + present_numeric + present_cat + present_temporal))
+    logging.info("Statement store: %s (%d customers, %d rows)", store_dir, store.n_customers, store.n_rows)
+
+    # Share columns must be identical for every batch: fix the vocabulary up front
+    if present_cat and not category_map:
+        cat_values = pd.read_parquet(Path(store_dir) / STATEMENTS_FILE, columns=present_cat)
+        category_map = {c: pd.unique(_cat_values(cat_values[c], c)).tolist() for c in present_cat}
+        category_map = {c: [v for v in values if not pd.isna(v)] for c, values in category_map.items()}
+        del cat_values
+    vocabulary = cat_vocabulary([], present_cat, category_map)
+
+    with ParquetAppender() as appender:
+        for batch, offsets in store.iter_batches(columns=columns):
+            if time_col in batch.columns:
+                # the store sorts undated statements last; order them first, as the parts path does
+                order, _, _ = sort_segments(batch[customer_col].to_numpy(), time_sort_key(batch[time_col]))
+                batch = batch.iloc[order].reset_index(drop=True)
+            ends = offsets[1:] - 1
+            keys = batch[customer_col].to_numpy()[ends]
+
+            if present_numeric:
+                values = sorted_matrix(batch, present_numeric)
+                acc = MomentAccumulator.from_values(keys, present_numeric, values, offsets)
+                appender.append(numeric_out, acc.finalize(customer_col))
+
+            if present_cat:
+                state = cat_count_state(batch, np.arange(len(batch)), offsets, keys, present_cat,
+                                        customer_col, time_col)
+                cat_df = derive_cat_features(state.set_index(customer_col), present_cat, vocabulary)
+                appender.append(cat_out, cat_df.reset_index())
+
+            if temporal_out and present_temporal:
+                appender.append(temporal_out, temporal_frame(batch, offsets, keys, present_temporal,
+                                                             temporal, ewm_alpha, customer_col))
+
+            # last k dated statements (drop the undated rows sorted first)
+            dated = batch[keep_cols]
+            if time_col in dated.columns and dated[time_col].isna().any():
+                dated = dated[dated[time_col].notna()].reset_index(drop=True)
+            _, dated_keys, dated_offsets = sort_segments(dated[customer_col].to_numpy())
+            appender.append(last_out, tail_frame(dated, dated_offsets, dated_keys, keep_cols[1:], last_k,
+                                                 customer_col, time_col))
+
+
+# -----------------------
+# Projection pushdown
+# -----------------------
+NUMERIC_FEATURE_STATS = ("count", "mean", "std", "min", "max")
+CAT_FEATURES = ("mode", "nunique", "last")
+
+
+def plan_from_features(features: List[str], numeric_cols: List[str], cat_cols: List[str]) -> dict:
+    """
+    Source columns and statistics needed to produce `features` (names as in
+    feature_columns_customer_{mode}.json), so a run can read and reduce only those.
+
+    Returns:
+        {"numeric": columns needing moment state, "cat": categorical columns,
+         "temporal": columns needing temporal features, "temporal_features": which,
+         "quantile": columns needing quantile sketches, "last": columns kept for the
+         last statements, "last_k": how many, "unknown": unmatched features}
+    """
+    numeric, cat = set(numeric_cols), set(cat_cols)
+    plan = {"numeric": set(), "cat": set(), "temporal": set(), "temporal_features": set(),
+            "quantile": set(), "last": set(), "last_k": 1, "unknown": []}
+    for feature in features:
+        cat_col = next((c for c in cat if feature.startswith(f"{c}_share_")
+                        or feature in {f"{c}_{f}" for f in CAT_FEATURES}), None)
+        base, _, stat = feature.rpartition("_")
+        if cat_col is not None:
+            plan["cat"].add(cat_col)
+        elif base in numeric and stat in NUMERIC_FEATURE_STATS:
+            plan["numeric"].add(base)
+        elif base in numeric and base not in cat and stat in TEMPORAL_FEATURES:
+            plan["temporal"].add(base)
+            plan["temporal_features"].add(stat)
+        elif base in numeric and base not in cat and stat in QUANTILE_FEATURES:
+            plan["quantile"].add(base)
+        elif (base in numeric or base == "S_2") and stat.startswith("lag") and stat[3:].isdigit():
+            plan["last"].add(base)
+            plan["last_k"] = max(plan["last_k"], int(stat[3:]) + 1)
+        else:
+            plan["unknown"].append(feature)
+
+    # keep the usual column/feature order
+    plan["numeric"] = [c for c in numeric_cols if c in plan["numeric"]]
+    plan["cat"] = [c for c in cat_cols if c in plan["cat"]]
+    plan["temporal"] = sorted(plan["temporal"])
+    plan["temporal_features"] = [f for f in TEMPORAL_FEATURES if f in plan["temporal_features"]]
+    plan["quantile"] = sorted(plan["quantile"])
+    plan["last"] = sorted(plan["last"] - {"S_2"})
+    return plan
+
+
 # -----------------------
 # Combine partials
 # -----------------------
-def combine_numeric_partials(tmp_dir: Path, out_path: Path):
+def combine_numeric_partials(tmp_dir: Path, out_path: Path, state_out: Path = None):
+    """
+    Merges the numeric partials (MomentAccumulator state) into
+    customer_numeric_{mode}.parquet with {base}_count/_mean/_std/_min/_max per
+    base column, bases in sorted order.
+
+    Each partial is read exactly once, only for its moment columns, and all parts
+    are merged in one vectorized parallel (Chan/Welford) update. The merged state
+    itself is written to `state_out` if given (incremental updates).
+    """
+    import pyarrow.parquet as pq
+
     files = sorted(tmp_dir.glob("*_numeric.parquet"))
     if not files:
         logging.info("No numeric partials found")
         return pd.DataFrame()
 
-    dfs = []
+    accumulators = []
     for p in files:
-        df = pd.read_parquet(p)
-        if df.empty or "customer_ID" not in df.columns:
+        names = pq.read_schema(p).names
+        if CUSTOMER_COL not in names:
             continue
-        df = df.set_index("customer_ID")
-        dfs.append(df)
+        columns = [c for c in names if any(c.endswith(f"_{stat}") for stat in MOMENT_STATS)]
+        df = pd.read_parquet(p, columns=[CUSTOMER_COL] + columns)
+        if not df.empty:
+            accumulators.append(MomentAccumulator.from_frame(df, CUSTOMER_COL))
 
-    if not dfs:
+    if not accumulators:
+        return pd.DataFrame()
+
+    merged = MomentAccumulator.combine(accumulators)
+    if state_out is not None:
+        merged.to_frame(CUSTOMER_COL).to_parquet(state_out, index=False)
+    final = merged.finalize(CUSTOMER_COL)
+    bases = sorted(c[:-len("_count")] for c in final.columns if c.endswith("_count"))
+    final = final[[CUSTOMER_COL] + [f"{b}_{stat}" for b in bases for stat in ("count", "mean", "std", "min", "max")]]
+
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    final.to_parquet(out_path, index=False)
+    return final
+
+
+def combine_quantile_partials(tmp_dir: Path, out_path: Path, quantiles: dict = QUANTILE_FEATURES):
+    """
+    Merges the QuantileSummary partials into customer_quantile_{mode}.parquet
+    with {base}_p25/_median/_p75 per base column.
+    """
+    files = sorted(tmp_dir.glob("*_quantile.parquet"))
+    if not files:
+        logging.info("No quantile partials found")
+        return pd.DataFrame()
+
+    sketches = []
+    for p in files:
+        df = pd.read_parquet(p)
+        if not df.empty and CUSTOMER_COL in df.columns:
+            sketches.append(QuantileSummary.from_frame(df, CUSTOMER_COL))
+    if not sketches:
         return pd.DataFrame()
 
-    all_parts = pd.concat(dfs, axis=0, sort=False).fillna(0)
-    grouped = all_parts.groupby(all_parts.index).sum()
-
-    final = pd.DataFrame(index=grouped.index)
-    # derive bases automatically
-    cols = grouped.columns.tolist()
-    bases = set()
-    for c in cols:
-        if c.endswith("_sum"):
-            bases.add(c[:-4])
-        elif c.endswith("_sumsq"):
-            bases.add(c[:-7])
-        elif c.endswith("_cnt"):
-            bases.add(c[:-4])
-    for base in sorted(bases):
-        cnt = grouped.get(f"{base}_cnt", pd.Series(0, index=grouped.index)).astype(float)
-        s = grouped.get(f"{base}_sum", pd.Series(0.0, index=grouped.index)).astype(float)
-        ssq = grouped.get(f"{base}_sumsq", pd.Series(0.0, index=grouped.index)).astype(float)
-
-        mean = s / cnt.replace({0: np.nan})
-        var = (ssq / cnt.replace({0: np.nan})) - (mean ** 2)
-        var = var.fillna(0.0).clip(lower=0.0)
-        std = np.sqrt(var)
-
-        # compute min/max by scanning partial files
-        min_vals = []
-        max_vals = []
-        for p in files:
-            part_df = pd.read_parquet(p).set_index("customer_ID")
-            if f"{base}_min" in part_df.columns:
-                min_vals.append(part_df[f"{base}_min"])
-            if f"{base}_max" in part_df.columns:
-                max_vals.append(part_df[f"{base}_max"])
-        min_series = pd.concat(min_vals, axis=1).min(axis=1).reindex(index=grouped.index).fillna(np.nan) if min_vals else pd.Series(np.nan, index=grouped.index)
-        max_series = pd.concat(max_vals, axis=1).max(axis=1).reindex(index=grouped.index).fillna(np.nan) if max_vals else pd.Series(np.nan, index=grouped.index)
-
-        final[f"{base}_count"] = cnt.astype(int)
-        final[f"{base}_mean"] = mean
-        final[f"{base}_std"] = std
-        final[f"{base}_min"] = min_series
-        final[f"{base}_max"] = max_series
+    # parts may lack columns; merge each column set separately, then outer-join
+    groups = {}
+    for sk in sketches:
+        groups.setdefault(tuple(sk.columns), []).append(sk)
+    frames = [QuantileSummary.combine(group).finalize(CUSTOMER_COL, quantiles).set_index(CUSTOMER_COL)
+              for group in groups.values()]
+    final = frames[0].join(frames[1:], how="outer") if len(frames) > 1 else frames[0]
+    final = final.sort_index().reset_index()
 
     out_path.parent.mkdir(parents=True, exist_ok=True)
-    final_reset = final.reset_index()
-    final_reset.to_parquet(out_path, index=False)
-    return final_reset
+    final.to_parquet(out_path, index=False)
+    return final
 
 
-def combine_cat_partials(tmp_dir: Path, out_path: Path, cat_cols):
+def combine_cat_partials(tmp_dir: Path, out_path: Path, cat_cols, category_map: dict = None,
+                         vocabulary: dict = None, state_out: Path = None):
+    """
+    Merges categorical count state: counts add up across parts, `{c}_last` comes
+    from the part holding the customer's latest statement. Features are then
+    derived once from the merged counts (derive_cat_features). `vocabulary`
+    overrides the share columns (bucketed combine passes the global one); the
+    merged count state is written to `state_out` if given.
+    """
     files = sorted(tmp_dir.glob("*_cat.parquet"))
     if not files:
         logging.info("No categorical partials found")
@@ -337,32 +980,46 @@ def combine_cat_partials(tmp_dir: Path, out_path: Path, cat_cols):
     dfs = []
     for p in files:
         df = pd.read_parquet(p)
-        if df.empty or "customer_ID" not in df.columns:
+        if df.empty or CUSTOMER_COL not in df.columns:
             continue
-        df = df.set_index("customer_ID")
         dfs.append(df)
 
     if not dfs:
         return pd.DataFrame()
 
-    all_parts = pd.concat(dfs, axis=0, sort=False)
-    final = {}
-    for c in [col for col in cat_cols if col in all_parts.columns]:
-        mode_ser = all_parts.groupby(all_parts.index)[c].agg(lambda s: s.mode().iloc[0] if not s.mode().empty else pd.NA)
-        final[c] = mode_ser
-
-    if not final:
-        # No categorical columns found - return empty DataFrame
+    all_parts = pd.concat(dfs, axis=0, ignore_index=True, sort=False)
+    del dfs
+    count_cols = [c for c in all_parts.columns if CAT_COUNT_SEP in c]
+    last_cols = [f"{c}_last" for c in cat_cols if f"{c}_last" in all_parts.columns]
+    if not last_cols:
         logging.info("No categorical columns found in partials")
         return pd.DataFrame()
 
-    final_df = pd.concat(final, axis=1).reset_index()
+    # absent values are NaN in parts that never saw them; sum() treats them as 0
+    counts = all_parts.groupby(CUSTOMER_COL, sort=True)[count_cols].sum()
+    if "S_2" in all_parts.columns:
+        all_parts = all_parts.sort_values([CUSTOMER_COL, "S_2"], kind="stable", na_position="first")
+    last = all_parts.drop_duplicates(CUSTOMER_COL, keep="last").set_index(CUSTOMER_COL)
+    state = counts.join(last[last_cols])
+    if state_out is not None:
+        time_cols = [c for c in ["S_2"] if c in last.columns]
+        state.join(last[time_cols]).reset_index().to_parquet(state_out, index=False)
+
+    if vocabulary is None:
+        vocabulary = cat_vocabulary(count_cols, cat_cols, category_map)
+    final_df = derive_cat_features(state, cat_cols, vocabulary).reset_index()
     out_path.parent.mkdir(parents=True, exist_ok=True)
     final_df.to_parquet(out_path, index=False)
     return final_df
 
 
-def combine_last_partials(tmp_dir: Path, out_path: Path):
+def combine_last_partials(tmp_dir: Path, out_path: Path, state_out: Path = None, last_k: int = 1):
+    """
+    Merges the last-statement partials (each part's last `last_k` dated rows per
+    customer) into one row per customer with the last `last_k` statements across
+    parts, via one stable (customer, S_2) sort and a boundary mask (tail_frame).
+    `state_out` gets the merged rows in partial layout.
+    """
     files = sorted(tmp_dir.glob("*_last.parquet"))
     if not files:
         logging.info("No last-row partials found")
@@ -371,30 +1028,178 @@ def combine_last_partials(tmp_dir: Path, out_path: Path):
     dfs = []
     for p in files:
         df = pd.read_parquet(p)
-        if df.empty or "customer_ID" not in df.columns:
+        if df.empty or CUSTOMER_COL not in df.columns:
             continue
-        df = df.set_index("customer_ID")
         dfs.append(df)
 
-    all_parts = pd.concat(dfs, axis=0, sort=False)
+    if not dfs:
+        return pd.DataFrame()
+
+    all_parts = pd.concat(dfs, axis=0, ignore_index=True, sort=False)
+    times = None
     if "S_2" in all_parts.columns:
         all_parts["S_2"] = pd.to_datetime(all_parts["S_2"])
+        times = time_sort_key(all_parts["S_2"])
+    order, keys, offsets = sort_segments(all_parts[CUSTOMER_COL].to_numpy(), times)
+    all_parts = all_parts.iloc[order].reset_index(drop=True)
+
+    if state_out is not None:
+        rows, _, _ = segment_tail(offsets, last_k)
+        all_parts.iloc[rows].to_parquet(state_out, index=False)
 
-    idx = all_parts.groupby(all_parts.index)["S_2"].idxmax()
-    final = all_parts.loc[idx].reset_index()
+    value_cols = [c for c in all_parts.columns if c != CUSTOMER_COL]
+    final = tail_frame(all_parts, offsets, keys, value_cols, last_k, CUSTOMER_COL)
     out_path.parent.mkdir(parents=True, exist_ok=True)
     final.to_parquet(out_path, index=False)
     return final
 
 
-def merge_final(numeric_out: str, cat_out: str, last_out: str, final_out: str, customer_col: str = "customer_ID"):
+def combine_bucketed(tmp_dir: Path, n_buckets: int, n_keys: int, numeric_out: Path, cat_out: Path,
+                     last_out: Path, final_out: Path, cat_cols: List[str], category_map: dict = None,
+                     extra_outs: List[Path] = (), quantile_out: Path = None,
+                     columns: List[str] = None, last_k: int = 1) -> List[str]:
+    """
+    Out-of-core combine: runs the combine_* functions and merge_final one customer
+    bucket at a time (partials under <tmp_dir>/bucketNNNN/) and appends each
+    bucket's result to the output files, so only one bucket is ever in memory.
+    Extra customer-level tables (temporal features) are read per bucket key range;
+    quantile partials, if any, are combined per bucket into `quantile_out`.
+    `columns` restricts the final table as in merge_final.
+
+    Returns:
+        Columns of the final customer-level table.
+    """
+    import pyarrow.parquet as pq
+
+    # Share columns must match across buckets: one vocabulary from all cat partials
+    state_columns = set()
+    for p in tmp_dir.glob("bucket*/*_cat.parquet"):
+        state_columns.update(pq.read_schema(p).names)
+    vocabulary = cat_vocabulary(sorted(state_columns), cat_cols, category_map)
+
+    work_dir = tmp_dir / COMBINE_DIR_NAME
+    work_dir.mkdir(exist_ok=True)
+    table_columns = {}
+    with ParquetAppender() as appender:
+        for b in range(n_buckets):
+            bucket_dir = tmp_dir / BUCKET_DIR_FMT.format(b)
+            if not bucket_dir.is_dir():
+                continue
+            paths = {kind: work_dir / f"{kind}.parquet" for kind in ("numeric", "cat", "last", "level")}
+            tables = {
+                "numeric": combine_numeric_partials(bucket_dir, paths["numeric"]),
+                "cat": combine_cat_partials(bucket_dir, paths["cat"], cat_cols, vocabulary=vocabulary),
+                "last": combine_last_partials(bucket_dir, paths["last"], last_k=last_k),
+            }
+            lo, hi = bucket_key_range(b, n_buckets, n_keys)
+            bucket_extras = []
+            for i, path in enumerate(extra_outs):
+                extra = pd.read_parquet(path, filters=[(CUSTOMER_COL, ">=", lo), (CUSTOMER_COL, "<", hi)])
+                bucket_extras.append(work_dir / f"extra{i}.parquet")
+                extra.to_parquet(bucket_extras[-1], index=False)
+            if quantile_out is not None:
+                paths["quantile"] = work_dir / "quantile.parquet"
+                tables["quantile"] = combine_quantile_partials(bucket_dir, paths["quantile"])
+                if not tables["quantile"].empty:
+                    bucket_extras.append(paths["quantile"])
+            tables["level"] = merge_final(paths["numeric"], paths["cat"], paths["last"], paths["level"],
+                                          extra_outs=bucket_extras, columns=columns)
+
+            outputs = [("numeric", numeric_out), ("cat", cat_out), ("last", last_out), ("level", final_out)]
+            if quantile_out is not None:
+                outputs.append(("quantile", quantile_out))
+            for kind, out in outputs:
+                if tables[kind].empty:
+                    continue
+                # the first bucket fixes the column order of each output
+                table_columns.setdefault(kind, list(tables[kind].columns))
+                appender.append(out, tables[kind].reindex(columns=table_columns[kind]))
+            for p in work_dir.glob("*.parquet"):
+                p.unlink()
+            logging.info("[%d/%d] Combined bucket %s (keys %d-%d)", b + 1, n_buckets, bucket_dir.name, lo, hi - 1)
+    shutil.rmtree(work_dir)
+    return table_columns.get("level", [])
+
+
+# -----------------------
+# Incremental state
+# -----------------------
+# The state has the partial layout (one row per customer), so it is combined with
+# the partials of a new batch like one more part.
+STATE_KINDS = ("numeric", "cat", "last")
+STATE_STEM = "_state"
+STATE_MANIFEST = "manifest.json"
+
+
+def file_fingerprint(path: Path, chunk_size: int = 1 << 20) -> str:
+    """sha1 of the file contents, used to refuse absorbing the same batch twice."""
+    import hashlib
+
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def customer_index_record(index_path: Path, n: int = None) -> dict:
+    """Size and fingerprint of the first `n` keys (all by default) of a customer index."""
+    from src.preprocessing import customer_index_fingerprint, load_customer_index
+
+    customer_index = load_customer_index(str(index_path))[:n]
+    return {"n": len(customer_index), "sha1": customer_index_fingerprint(customer_index)}
+
+
+def load_state_manifest(state_dir: Path) -> dict:
+    path = state_dir / STATE_MANIFEST
+    if not path.exists():
+        return {"batches": []}
+    with open(path) as f:
+        return json.load(f)
+
+
+def stage_state(state_dir: Path, tmp_dir: Path) -> None:
+    """Links (or copies) the saved state into tmp_dir as the partials of one extra part."""
+    for kind in STATE_KINDS:
+        src = state_dir / f"{kind}.parquet"
+        if not src.exists():
+            raise FileNotFoundError(f"Incomplete aggregation state, missing {src}")
+        dst = tmp_dir / f"{STATE_STEM}_{kind}.parquet"
+        # restaged on every run (never written through: it may be a link to the saved state)
+        if dst.exists():
+            dst.unlink()
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copyfile(src, dst)
+
+
+def save_state(new_state_dir: Path, state_dir: Path, manifest: dict) -> None:
+    """Replaces state_dir with the freshly combined state (written to new_state_dir)."""
+    with open(new_state_dir / STATE_MANIFEST, "w") as f:
+        json.dump(manifest, f, indent=2)
+    old_dir = state_dir.with_name(state_dir.name + ".old")
+    if old_dir.exists():
+        shutil.rmtree(old_dir)
+    if state_dir.exists():
+        os.replace(state_dir, old_dir)
+    os.replace(new_state_dir, state_dir)
+    if old_dir.exists():
+        shutil.rmtree(old_dir)
+
+
+def merge_final(numeric_out: str, cat_out: str, last_out: str, final_out: str, customer_col: str = CUSTOMER_COL,
+                extra_outs: List[str] = (), columns: List[str] = None):
     """
     Robust merging of partials into final customer-level table.
 
     Params:
         numeric_out, cat_out, last_out: file paths (parquet) — may not exist.
+        extra_outs: further customer-level tables to join (e.g. temporal features).
+        columns: if given, keep only these columns (in this order) besides the customer key
+            and S_2 (the latest statement date, needed by the trainers' latest-statement join).
         final_out: output parquet filepath for merged table.
-        customer_col: name of the customer id column (default 'customer_ID').
+        customer_col: name of the customer key column (default 'customer_key').
 
     Returns:
         merged DataFrame (also written to final_out).
@@ -411,7 +1216,7 @@ def merge_final(numeric_out: str, cat_out: str, last_out: str, final_out: str, c
         return None
 
     parts = []
-    for path in (numeric_out, cat_out, last_out):
+    for path in (numeric_out, cat_out, last_out, *extra_outs):
         df = _load_if_exists(path)
         if df is None:
             continue
@@ -434,15 +1239,19 @@ def merge_final(numeric_out: str, cat_out: str, last_out: str, final_out: str, c
         # Nothing to merge: create an empty file (or raise)
         raise ValueError("No partials found to merge. Check agg_tmp for *_numeric/_cat/_last.parquet files.")
 
-    # Now concat horizontally on index (customer_ID)
+    # Now concat horizontally on index (customer key)
     merged = pd.concat(parts, axis=1, join="outer")
 
     # After concat, remove any duplicated columns (keep first occurrence)
     if merged.columns.duplicated().any():
         merged = merged.loc[:, ~merged.columns.duplicated()]
 
-    # Reset index to have customer_ID as column
-    merged = merged.reset_index()
+    if columns is not None:
+        keep = dict.fromkeys(["S_2", *columns])
+        merged = merged[[c for c in keep if c in merged.columns and c != customer_col]]
+
+    # Reset index to have the customer key as column (sorted int keys)
+    merged = merged.sort_index().reset_index()
 
     # Write final parquet (overwrite)
     out_dir = os.path.dirname(final_out)
@@ -455,7 +1264,7 @@ def merge_final(numeric_out: str, cat_out: str, last_out: str, final_out: str, c
 
 
 def build_feature_list(customer_level_df: pd.DataFrame, out_json: Path, 
-                       id_col="customer_ID", target_col="target"):
+                       id_col=CUSTOMER_COL, target_col="target"):
     # Columns to exclude from model input
     exclude = {id_col, target_col, "S_2"}
 
@@ -479,10 +1288,11 @@ def list_parts_for_mode(parts_dir: Path, mode: str) -> List[Path]:
         (containing 'train'/'test' anywhere).
       - Finally fallback to all parquet parts to avoid hard failure.
 
-    This avoids mixing train/test parts accidentally.
+    This avoids mixing train/test parts accidentally. Parts are returned in CSV
+    order (numeric part index, see part_sort_key).
     """
     parts_dir = Path(parts_dir)
-    all_parts = sorted(parts_dir.glob("*.parquet"))
+    all_parts = sorted(parts_dir.glob("*.parquet"), key=part_sort_key)
 
     if mode == "train":
         pref = "train_"
@@ -514,69 +1324,278 @@ def main():
                    help="Directory containing parquet parts (default from constant PARTS_DIR)")
     p.add_argument("--out-dir", type=str, default=str(OUT_DIR),
                    help="Output directory for aggregated files (default from constant OUT_DIR)")
+    p.add_argument("--category-map", type=str, default=str(CATEGORY_MAP_PATH),
+                   help="Train category map fixing the categorical share columns (used if it exists)")
+    p.add_argument("--store-dir", type=str, default=None,
+                   help="Aggregate from a customer-sorted statement store (preprocess --statement-store) "
+                        "in one linear scan instead of per-part partials")
+    p.add_argument("--workers", type=int, default=1,
+                   help="Worker processes for per-part aggregation (default: 1 = serial)")
+    p.add_argument("--max-memory-gb", type=float, default=None,
+                   help="Memory budget used to cap --workers (default: 80%% of available memory)")
+    p.add_argument("--prefetch", type=int, default=DEFAULT_PREFETCH_DEPTH,
+                   help="Serial runs: parts read ahead on a background thread while the current one is "
+                        f"aggregated (default: {DEFAULT_PREFETCH_DEPTH}; 0 = off)")
+    p.add_argument("--buckets", type=int, default=1,
+                   help="Split customers into this many on-disk buckets and combine one bucket at a time "
+                        "(default: 1 = in-memory combine)")
+    p.add_argument("--combine-memory-gb", type=float, default=None,
+                   help="Memory budget for combining partials; raises --buckets so one bucket fits it")
+    p.add_argument("--required-features", type=str, default=None,
+                   help="JSON list of customer-level features to produce (e.g. a model's feature list); "
+                        "only their source columns are read and only the needed statistics computed")
+    p.add_argument("--state-dir", type=str, default=None,
+                   help="Save the merged per-customer state (moments, category counts, last statement) here")
+    p.add_argument("--update", action="store_true",
+                   help="Absorb the parts in --parts-dir (e.g. one new month) into --state-dir "
+                        "instead of aggregating from scratch; the parts must be encoded with the state's "
+                        "customer index or an extension of it (preprocess_*.py --extend-customer-index)")
+    p.add_argument("--customer-index", type=str, default=None,
+                   help="Customer index the parts were encoded with, recorded in and checked against "
+                        "--state-dir (default: data/stage/customer_index_{mode}.parquet)")
+    p.add_argument("--feature-set", choices=FEATURE_SETS, default="base",
+                   help="base: count/mean/std/min/max + categorical; temporal: also last/first/delta/slope/diff1/ewm")
+    p.add_argument("--last-k", type=int, default=1,
+                   help="Keep each customer's last K statements as {col}_lag0 .. {col}_lag{K-1} (default: 1)")
+    p.add_argument("--last-columns", choices=["date", "numeric"], default="date",
+                   help="Columns kept for the last statements: date = S_2 only, numeric = all numeric columns")
+    p.add_argument("--quantiles", action="store_true",
+                   help="Also compute approximate p25/median/p75 per numeric column from mergeable sketches")
+    p.add_argument("--sketch-size", type=int, default=QUANTILE_SKETCH_SIZE,
+                   help="Points per customer and column in the quantile sketch (exact up to this many statements)")
+    p.add_argument("--temporal-features", type=str, default=",".join(TEMPORAL_FEATURES),
+                   help="Comma-separated subset of temporal features for --feature-set temporal")
+    p.add_argument("--ewm-alpha", type=float, default=EWM_ALPHA, help="Smoothing factor of the ewm feature")
     p.add_argument("--verbose", action="store_true", help="Enable verbose debug output")
     args = p.parse_args()
 
     mode = args.mode
     parts_dir = Path(args.parts_dir)
     out_dir = Path(args.out_dir)
-    tmp_dir = out_dir / TMP_DIR_NAME
 
     logging.info("Mode: %s", mode)
     logging.info("Parts dir: %s", parts_dir)
     logging.info("Out dir: %s", out_dir)
 
-    if not parts_dir.exists():
-        logging.error("Parts dir does not exist: %s", parts_dir)
-        sys.exit(1)
+    # Inputs: the statement store files, or the parquet parts of this mode
+    if args.store_dir:
+        from src.statement_store import OFFSETS_FILE, STATEMENTS_FILE
 
-    # Auto-clean tmp (existing behavior)
-    _clean_tmp(tmp_dir)
+        inputs = [Path(args.store_dir) / STATEMENTS_FILE, Path(args.store_dir) / OFFSETS_FILE]
+    else:
+        if not parts_dir.exists():
+            logging.error("Parts dir does not exist: %s", parts_dir)
+            sys.exit(1)
+        # --- use helper that filters parts by mode (train_/test_ preference) ---
+        parts = list_parts_for_mode(parts_dir, mode)
+        if not parts:
+            logging.error("No parquet parts found in %s for mode=%s", parts_dir, mode)
+            sys.exit(1)
+        inputs = list(parts)
+
+    # Isolated workspace per (mode, inputs, options), locked for the whole run
+    options = {k: v for k, v in vars(args).items() if k not in RUN_ONLY_ARGS}
+    for option_file in (args.category_map, args.required_features):
+        if option_file and Path(option_file).exists():
+            inputs.append(Path(option_file))
+    workspace = out_dir / TMP_DIR_NAME / f"{mode}_{input_fingerprint(inputs, options)}"
+    workspace_lock = acquire_lock(workspace.with_name(workspace.name + ".lock"))
+    # Kept until the run succeeds: a rerun after a failure resumes its completed parts
+    prepare_workspace(workspace)
+    tmp_dir = workspace
+    stage_dir = workspace / STAGE_DIR_NAME
+    logging.info("Workspace: %s", workspace)
 
-    # --- use helper that filters parts by mode (train_/test_ preference) ---
-    parts = list_parts_for_mode(parts_dir, mode)
-    if not parts:
-        logging.error("No parquet parts found in %s for mode=%s", parts_dir, mode)
+    numeric_cols = NUMERIC_BASE.copy()
+    cat_cols = LINEAR_CAT_COLS.copy()
+
+    category_map = None
+    if args.category_map and Path(args.category_map).exists():
+        with open(args.category_map) as f:
+            category_map = json.load(f)
+        logging.info("Categorical share columns from category map: %s", args.category_map)
+
+    numeric_out = stage_dir / f"customer_numeric_{mode}.parquet"
+    cat_out = stage_dir / f"customer_cat_{mode}.parquet"
+    last_out = stage_dir / f"customer_last_{mode}.parquet"
+    final_out = stage_dir / f"customer_level_{mode}.parquet"
+    feature_json = stage_dir / f"feature_columns_customer_{mode}.json"
+
+    temporal_out = None
+    temporal = [f for f in args.temporal_features.split(",") if f]
+    # categorical columns get mode/last from the count state instead
+    temporal_cols = sorted(c for c in numeric_cols if c not in cat_cols)
+    if args.feature_set == "temporal":
+        temporal_out = stage_dir / f"customer_temporal_{mode}.parquet"
+        logging.info("Temporal features: %s (%d columns)", ", ".join(temporal), len(temporal_cols))
+    extra_outs = [temporal_out] if temporal_out else []
+
+    last_k = args.last_k
+    last_cols = list(temporal_cols) if args.last_columns == "numeric" else []
+    if last_k > 1 or last_cols:
+        logging.info("Last statements: %d, %d value columns", last_k, len(last_cols))
+
+    quantile_out = None
+    quantile_cols = []
+    if args.quantiles:
+        quantile_out = stage_dir / f"customer_quantile_{mode}.parquet"
+        quantile_cols = temporal_cols
+        logging.info("Quantile features: %s (%d columns, sketch size %d)",
+                     ", ".join(QUANTILE_FEATURES), len(quantile_cols), args.sketch_size)
+
+    required = None
+    if args.required_features:
+        with open(args.required_features) as f:
+            required = json.load(f)
+        plan = plan_from_features(required, numeric_cols, cat_cols)
+        if plan["unknown"]:
+            logging.warning("%d required feature(s) match no aggregate and are ignored: %s",
+                            len(plan["unknown"]), ", ".join(plan["unknown"][:10]))
+        numeric_cols, cat_cols = plan["numeric"], plan["cat"]
+        temporal_cols, temporal = plan["temporal"], plan["temporal_features"]
+        temporal_out = stage_dir / f"customer_temporal_{mode}.parquet" if temporal_cols else None
+        quantile_cols = plan["quantile"]
+        last_cols, last_k = plan["last"], plan["last_k"]
+        quantile_out = stage_dir / f"customer_quantile_{mode}.parquet" if quantile_cols else None
+        extra_outs = [temporal_out] if temporal_out else []
+        logging.info("Required features: %d -> numeric %d, categorical %d, temporal %d, quantile %d columns, "
+                     "last %d statements of %d columns", len(required), len(numeric_cols), len(cat_cols),
+                     len(temporal_cols), len(quantile_cols), last_k, len(last_cols))
+
+    state_dir = Path(args.state_dir) if args.state_dir else None
+    if state_dir:
+        # one writer per state, whatever its inputs
+        state_lock = acquire_lock(state_dir.with_name(state_dir.name + ".lock"))
+    if args.update and state_dir is None:
+        logging.error("--update needs --state-dir")
+        sys.exit(1)
+    if quantile_out and args.store_dir:
+        logging.error("--quantiles is computed from per-part partials, not with --store-dir")
+        sys.exit(1)
+    if state_dir and (args.store_dir or args.buckets > 1 or args.combine_memory_gb or temporal_out
+                      or quantile_out):
+        # temporal features need the full statement history, not mergeable state
+        logging.error("--state-dir supports the base feature set with the in-memory parts combine only")
         sys.exit(1)
 
+    if args.store_dir:
+        logging.info("Aggregating from statement store (single linear scan)...")
+        aggregate_from_store(Path(args.store_dir), numeric_out, cat_out, last_out, numeric_cols, cat_cols,
+                             category_map=category_map, temporal_out=temporal_out, temporal_cols=temporal_cols,
+                             temporal=temporal, ewm_alpha=args.ewm_alpha, last_k=last_k, last_cols=last_cols)
+
+        logging.info("Merging final customer-level table...")
+        final_df = merge_final(numeric_out, cat_out, last_out, final_out, extra_outs=extra_outs,
+                               columns=required)
+
+        logging.info("Building feature list...")
+        build_feature_list(final_df, feature_json)
+
+        finish_run(workspace, out_dir)
+        logging.info("Completed aggregation. Final file: %s", out_dir / final_out.name)
+        return
+
+    manifest = {"batches": []}
+    if state_dir:
+        manifest = load_state_manifest(state_dir) if args.update else manifest
+        index_path = Path(args.customer_index or CUSTOMER_INDEX_FMT.format(mode))
+        if not index_path.exists():
+            logging.error("--state-dir needs the customer index the parts were encoded with: %s not found "
+                          "(see --customer-index)", index_path)
+            sys.exit(1)
+        # Keys are positions in the index: the state's keys must mean the same customers
+        saved_index = manifest.get("customer_index")
+        if args.update and (saved_index is None or customer_index_record(index_path, saved_index["n"]) != saved_index):
+            logging.error("Customer index %s does not extend the one %s was built with; preprocess the new "
+                          "batch with --extend-customer-index (or rebuild the state)", index_path, state_dir)
+            sys.exit(1)
+        manifest["customer_index"] = customer_index_record(index_path)
+        absorbed = {b["sha1"] for b in manifest["batches"]}
+        fingerprints = {pth: file_fingerprint(pth) for pth in parts}
+        skipped = [pth for pth in parts if fingerprints[pth] in absorbed]
+        for pth in skipped:
+            logging.warning("Skipping %s: already absorbed into %s", pth.name, state_dir)
+        parts = [pth for pth in parts if pth not in skipped]
+        if not parts:
+            logging.info("Nothing new to absorb into %s", state_dir)
+            shutil.rmtree(workspace, ignore_errors=True)
+            return
+        manifest["batches"] += [{"part": pth.name, "sha1": fingerprints[pth]} for pth in parts]
+
     logging.info("Found %d parquet parts (mode=%s)", len(parts), mode)
     if args.verbose:
         example = ", ".join(p.name for p in parts[:5])
         logging.debug("Example parts: %s", example)
 
-    numeric_cols = NUMERIC_BASE.copy()
-    cat_cols = LINEAR_CAT_COLS.copy()
+    n_buckets, n_keys = args.buckets, None
+    if args.combine_memory_gb:
+        quantile_width = len(quantile_cols) * (args.sketch_size + 1)
+        n_buckets = max(n_buckets, choose_buckets(parts, numeric_cols, cat_cols, int(args.combine_memory_gb * 1e9),
+                                                  extra_width=quantile_width))
+    if n_buckets > 1:
+        n_keys = count_customer_keys(parts)
+        logging.info("Out-of-core combine: %d customer buckets over %d keys", n_buckets, n_keys)
+
+    memory_budget = int(args.max_memory_gb * 1e9) if args.max_memory_gb else None
+    failed = run_per_part_aggregates(parts, tmp_dir, numeric_cols, cat_cols,
+                                     workers=args.workers, memory_budget=memory_budget,
+                                     n_buckets=n_buckets, n_keys=n_keys,
+                                     quantile_cols=quantile_cols, sketch_size=args.sketch_size,
+                                     last_k=last_k, last_cols=last_cols, prefetch=args.prefetch)
+    if failed:
+        logging.error("%d part(s) failed: %s", len(failed), ", ".join(failed))
+        sys.exit(1)
 
-    for pth in parts:
-        marker = tmp_dir / f"{pth.stem}_numeric.parquet"
-        if marker.exists() and marker.stat().st_size > 0:
-            logging.info("Skipping already-processed part: %s", pth.name)
-            continue
-        per_part_aggregates(pth, tmp_dir, numeric_cols, cat_cols)
+    if temporal_out:
+        logging.info("Building temporal features...")
+        aggregate_temporal_from_parts(parts, temporal_out, temporal_cols, temporal, args.ewm_alpha)
+
+    if n_buckets > 1:
+        logging.info("Combining partials bucket by bucket...")
+        columns = combine_bucketed(tmp_dir, n_buckets, n_keys, numeric_out, cat_out, last_out, final_out,
+                                   cat_cols, category_map=category_map, extra_outs=extra_outs,
+                                   quantile_out=quantile_out, columns=required, last_k=last_k)
 
-    numeric_out = out_dir / f"customer_numeric_{mode}.parquet"
-    cat_out = out_dir / f"customer_cat_{mode}.parquet"
-    last_out = out_dir / f"customer_last_{mode}.parquet"
-    final_out = out_dir / f"customer_level_{mode}.parquet"
-    feature_json = out_dir / f"feature_columns_customer_{mode}.json"
+        logging.info("Building feature list...")
+        build_feature_list(pd.DataFrame(columns=columns), feature_json)
+
+        finish_run(workspace, out_dir)
+        logging.info("Completed aggregation. Final file: %s", out_dir / final_out.name)
+        return
+
+    state_out = {kind: None for kind in STATE_KINDS}
+    if state_dir:
+        if args.update:
+            logging.info("Absorbing %d new part(s) into state %s", len(parts), state_dir)
+            stage_state(state_dir, tmp_dir)
+        new_state_dir = tmp_dir / STATE_STAGE_NAME
+        new_state_dir.mkdir(exist_ok=True)
+        state_out = {kind: new_state_dir / f"{kind}.parquet" for kind in STATE_KINDS}
 
     logging.info("Combining numeric partials...")
-    df_num = combine_numeric_partials(tmp_dir, numeric_out)
+    df_num = combine_numeric_partials(tmp_dir, numeric_out, state_out=state_out["numeric"])
 
     logging.info("Combining categorical partials...")
-    df_cat = combine_cat_partials(tmp_dir, cat_out, cat_cols)
+    df_cat = combine_cat_partials(tmp_dir, cat_out, cat_cols, category_map=category_map,
+                                  state_out=state_out["cat"])
 
     logging.info("Combining last-row partials...")
-    df_last = combine_last_partials(tmp_dir, last_out)
+    df_last = combine_last_partials(tmp_dir, last_out, state_out=state_out["last"], last_k=last_k)
+
+    if quantile_out:
+        logging.info("Combining quantile sketches...")
+        combine_quantile_partials(tmp_dir, quantile_out)
+        extra_outs.append(quantile_out)
 
     logging.info("Merging final customer-level table...")
-    final_df = merge_final(numeric_out, cat_out, last_out, final_out)
+    final_df = merge_final(numeric_out, cat_out, last_out, final_out, extra_outs=extra_outs,
+                           columns=required)
 
     logging.info("Building feature list...")
     build_feature_list(final_df, feature_json)
 
-    logging.info("Completed aggregation. Final file: %s", final_out)
-    logging.info("Temp files are stored in: %s (auto-cleaned before run)", tmp_dir)
+    finish_run(workspace, out_dir, state_dir=state_dir, manifest=manifest)
+    logging.info("Completed aggregation. Final file: %s", out_dir / final_out.name)
 
 
 if __name__ == "__main__":
@@ -13,6 +13,15 @@ Usage:
         --out submission/submission.csv \
         --batch-size 100000
 
+    # Sparse one-hot features (preprocess_*.py --sparse-onehot):
+    python scripts/generate_submission.py \
+        --onehot-npz data/stage/linear_test_onehot.npz \
+        --column-index data/stage/linear_column_index.json
+
+    # Cached feature matrix written by the train_*.py scripts (no parquet reads or merges):
+    python scripts/generate_submission.py \
+        --feature-cache data/stage/feature_cache/<key>
+
 Notes:
  - Requires: pyarrow, pandas, joblib, tqdm, numpy
  - Designed to be memory-friendly for very large test sets.
@@ -21,14 +30,25 @@ Notes:
 import argparse
 import json
 import os
+import sys
 from pathlib import Path
+
+# Add project root to sys.path to allow importing from src
+project_root = Path(__file__).resolve().parents[1]
+sys.path.append(str(project_root))
+
 import joblib
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 from tqdm import tqdm
 import pyarrow.dataset as ds
 from datetime import datetime
 
+from src.aggregation import segment_tail, sort_segments, time_sort_key
+from src.feature_cache import open_feature_cache
+from src.preprocessing import CUSTOMER_KEY_COL, load_customer_index, decode_customer_keys
+
 # -----------------------------
 # Helpers
 # -----------------------------
@@ -73,6 +93,37 @@ def ensure_feature_list(feature_path: Path):
         raise ValueError("Feature file must contain a JSON list of column names")
     return features
 
+def predict_from_cache(model, scaler, cache_path: Path, feature_cols, batch_size: int):
+    """
+    Predicts every row of a feature cache entry (memory-mapped, read batch by
+    batch) and keeps the latest statement's prediction per customer.
+
+    Returns:
+        {customer: (None, proba)}, the same mapping the parquet path builds.
+    """
+    matrix = open_feature_cache(str(cache_path))
+    if matrix is None:
+        raise FileNotFoundError(f"Feature cache entry not found: {cache_path}")
+    missing = [c for c in feature_cols if c not in matrix.features]
+    if missing:
+        raise ValueError(f"Feature cache lacks {len(missing)} model features, e.g. {missing[:5]}")
+    # Same columns in the same order: use the memory map as is, otherwise gather columns
+    position = {c: i for i, c in enumerate(matrix.features)}
+    columns = None if feature_cols == matrix.features else np.array([position[c] for c in feature_cols])
+
+    probs = np.empty(len(matrix), dtype=np.float64)
+    for start in tqdm(range(0, len(matrix), batch_size), desc="Predicting"):
+        X = matrix.X[start:start + batch_size]
+        X = np.nan_to_num(X if columns is None else X[:, columns], nan=0.0)
+        if scaler is not None:
+            X = scaler.transform(X)
+        probs[start:start + len(X)] = predict_proba_array(model, X)
+
+    # Latest statement per customer (rows without a date sort first)
+    order, customers, offsets = sort_segments(np.asarray(matrix.keys), time_sort_key(matrix.time))
+    rows, segment, _ = segment_tail(offsets, 1)
+    return {cust: (None, p) for cust, p in zip(customers[segment].tolist(), probs[order[rows]].tolist())}
+
 # -----------------------------
 # Main
 # -----------------------------
@@ -84,9 +135,17 @@ def main():
     p.add_argument("--out", type=str, default="submission/submission.csv")
     p.add_argument("--temp-pred", type=str, default="submission/_row_predictions.csv")
     p.add_argument("--batch-size", type=int, default=100_000)
-    p.add_argument("--customer-col", type=str, default="customer_ID")
+    p.add_argument("--customer-col", type=str, default=CUSTOMER_KEY_COL)
+    p.add_argument("--customer-index", type=str, default="data/stage/customer_index_test.parquet",
+                   help="Customer index used to decode customer keys back to customer_ID strings")
     p.add_argument("--time-col", type=str, default="S_2")
     p.add_argument("--id-col-in-sample", type=str, default="customer_ID")
+    p.add_argument("--onehot-npz", type=str, default=None,
+                   help="Sparse one-hot block row-aligned with --test-parquet (enables sparse mode)")
+    p.add_argument("--column-index", type=str, default="data/stage/linear_column_index.json",
+                   help="One-hot column names for the --onehot-npz matrix")
+    p.add_argument("--feature-cache", type=str, default=None,
+                   help="Predict from a feature cache entry (data/stage/feature_cache/<key>) instead of --test-parquet")
     args = p.parse_args()
 
     model_path = Path(args.model_path)
@@ -105,87 +164,114 @@ def main():
     feature_cols = ensure_feature_list(feature_path)
     print(f"[INFO] Feature count: {len(feature_cols)}")
 
-    print(f"[INFO] Preparing to stream test parquet: {test_parquet}")
-    dataset = ds.dataset(str(test_parquet), format="parquet")
-
-    # Remove existing temp preds if present
-    if temp_pred.exists():
-        print(f"[INFO] Removing existing temporary prediction file: {temp_pred}")
-        temp_pred.unlink()
-
-    # We'll append CSV rows: customer_ID, S_2 (ISO), proba
-    header_written = False
-
-    # Iterate over record batches
-    print(f"[INFO] Streaming and predicting in batches (batch_size={args.batch_size})...")
-    for batch in dataset.to_batches(batch_size=args.batch_size):
-        df = batch.to_pandas()  # convert to pandas dataframe for operations
-
-        # Keep only needed columns (customer, time, features). If time missing, keep NaT.
-        keep_cols = [args.customer_col, args.time_col] + [c for c in feature_cols if c in df.columns]
-        df_sub = df[keep_cols].copy()
-
-        # Reindex to full feature columns (adds missing columns with NaN)
-        # We need the feature columns in the exact order used for training
-        X = df_sub.reindex(columns=[args.customer_col, args.time_col] + feature_cols, fill_value=np.nan)
-
-        # Extract time and customer columns separately
-        customer_series = X[args.customer_col]
-        time_series = X[args.time_col]
-        X_features = X[feature_cols].fillna(0.0)  # fill missing dummy columns with 0
-
-        # If scaler present, apply it (scaler expects 2D numpy)
-        if scaler is not None:
-            X_input = scaler.transform(X_features)
-        else:
-            X_input = X_features.values
-
-        # Predict probabilities
-        try:
-            probs = predict_proba_array(model, X_input)
-        except Exception as e:
-            # Try converting X_input to numpy explicitly and retry
-            probs = predict_proba_array(model, np.asarray(X_input))
-
-        # Build dataframe of results for this batch
-        # Convert time to ISO string for reliable max comparisons later
-        time_iso = pd.to_datetime(time_series).dt.strftime("%Y-%m-%dT%H:%M:%S.%f")
-        batch_out = pd.DataFrame({
-            args.customer_col: customer_series.values,
-            args.time_col: time_iso.values,
-            "proba": probs.astype(float)
-        })
-
-        # Append to temp CSV
-        mode = "a"
-        header = not header_written
-        batch_out.to_csv(temp_pred, mode=mode, header=header, index=False)
-        header_written = True
-
-    print(f"[INFO] Completed per-row predictions and saved to temp file: {temp_pred}")
-
-    # -----------------------------
-    # Aggregate to customer-level by last S_2
-    # -----------------------------
-    print("[INFO] Aggregating to customer-level (last S_2 per customer)...")
-    # We'll stream-read the temp_pred CSV in chunks and keep an in-memory mapping for latest S_2 per customer
-    cust_map = {}  # customer_id -> (latest_time_iso_str, proba)
-
-    for chunk in pd.read_csv(temp_pred, chunksize=200_000):
-        # Ensure proper dtypes
-        # chunk[args.time_col] is ISO string; compare lexicographically is safe for isoformat
-        for idx, row in chunk.iterrows():
-            cust = row[args.customer_col]
-            t = row[args.time_col]
-            p = float(row["proba"])
-            if pd.isna(cust):
-                continue
-            if cust not in cust_map:
-                cust_map[cust] = (t, p)
+    onehot = None
+    numeric_cols = feature_cols
+    if args.onehot_npz:
+        print(f"[INFO] Loading sparse one-hot block from: {args.onehot_npz}")
+        onehot = sp.load_npz(args.onehot_npz).tocsr()
+        onehot_cols = ensure_feature_list(Path(args.column_index))
+        onehot_set = set(onehot_cols)
+        numeric_cols = [c for c in feature_cols if c not in onehot_set]
+        if feature_cols != numeric_cols + onehot_cols:
+            raise ValueError("Feature list must be numeric columns followed by the one-hot column index")
+
+    if args.feature_cache:
+        print(f"[INFO] Predicting from feature cache: {args.feature_cache}")
+        cust_map = predict_from_cache(model, scaler, Path(args.feature_cache), feature_cols, args.batch_size)
+    else:
+        print(f"[INFO] Preparing to stream test parquet: {test_parquet}")
+        dataset = ds.dataset(str(test_parquet), format="parquet")
+
+        # Remove existing temp preds if present
+        if temp_pred.exists():
+            print(f"[INFO] Removing existing temporary prediction file: {temp_pred}")
+            temp_pred.unlink()
+
+        # We'll append CSV rows: customer key, S_2 (ISO), proba
+        header_written = False
+        row_start = 0  # position of the current batch in the one-hot matrix
+
+        # Iterate over record batches
+        print(f"[INFO] Streaming and predicting in batches (batch_size={args.batch_size})...")
+        for batch in dataset.to_batches(batch_size=args.batch_size):
+            df = batch.to_pandas()  # convert to pandas dataframe for operations
+
+            # Keep only needed columns (customer, time, features). If time missing, keep NaT.
+            keep_cols = [args.customer_col, args.time_col] + [c for c in numeric_cols if c in df.columns]
+            df_sub = df[keep_cols].copy()
+
+            # Reindex to full feature columns (adds missing columns with NaN)
+            # We need the feature columns in the exact order used for training
+            X = df_sub.reindex(columns=[args.customer_col, args.time_col] + numeric_cols, fill_value=np.nan)
+
+            # Extract time and customer columns separately
+            customer_series = X[args.customer_col]
+            time_series = X[args.time_col]
+            X_features = X[numeric_cols].fillna(0.0)  # fill missing dummy columns with 0
+
+            if onehot is not None:
+                # Append this batch's rows of the one-hot block (same column order as training)
+                row_end = row_start + len(X_features)
+                X_features = sp.hstack(
+                    [sp.csr_matrix(X_features.to_numpy(dtype=np.float32)), onehot[row_start:row_end]],
+                    format="csr",
+                )
+                row_start = row_end
+
+            # If scaler present, apply it (scaler expects 2D numpy or sparse)
+            if scaler is not None:
+                X_input = scaler.transform(X_features)
+            elif onehot is not None:
+                X_input = X_features
             else:
-                # Compare times (ISO strings)
-                if t and (cust_map[cust][0] is None or t > cust_map[cust][0]):
+                X_input = X_features.values
+
+            # Predict probabilities
+            try:
+                probs = predict_proba_array(model, X_input)
+            except Exception as e:
+                # Try converting X_input to numpy explicitly and retry
+                probs = predict_proba_array(model, np.asarray(X_input))
+
+            # Build dataframe of results for this batch
+            # Convert time to ISO string for reliable max comparisons later
+            time_iso = pd.to_datetime(time_series).dt.strftime("%Y-%m-%dT%H:%M:%S.%f")
+            batch_out = pd.DataFrame({
+                args.customer_col: customer_series.values,
+                args.time_col: time_iso.values,
+                "proba": probs.astype(float)
+            })
+
+            # Append to temp CSV
+            mode = "a"
+            header = not header_written
+            batch_out.to_csv(temp_pred, mode=mode, header=header, index=False)
+            header_written = True
+
+        print(f"[INFO] Completed per-row predictions and saved to temp file: {temp_pred}")
+
+        # -----------------------------
+        # Aggregate to customer-level by last S_2
+        # -----------------------------
+        print("[INFO] Aggregating to customer-level (last S_2 per customer)...")
+        # We'll stream-read the temp_pred CSV in chunks and keep an in-memory mapping for latest S_2 per customer
+        cust_map = {}  # customer_id -> (latest_time_iso_str, proba)
+
+        for chunk in pd.read_csv(temp_pred, chunksize=200_000):
+            # Ensure proper dtypes
+            # chunk[args.time_col] is ISO string; compare lexicographically is safe for isoformat
+            for idx, row in chunk.iterrows():
+                cust = row[args.customer_col]
+                t = row[args.time_col]
+                p = float(row["proba"])
+                if pd.isna(cust):
+                    continue
+                if cust not in cust_map:
                     cust_map[cust] = (t, p)
+                else:
+                    # Compare times (ISO strings)
+                    if t and (cust_map[cust][0] is None or t > cust_map[cust][0]):
+                        cust_map[cust] = (t, p)
 
     print(f"[INFO] Aggregated predictions for {len(cust_map):,} customers")
 
@@ -209,10 +295,18 @@ def main():
         id_col = args.id_col_in_sample
         pred_col = "prediction"
 
+    # Decode customer keys back to customer_ID strings (only place IDs are needed)
+    customers = list(cust_map.keys())
+    if args.customer_col == CUSTOMER_KEY_COL:
+        print(f"[INFO] Decoding customer keys with: {args.customer_index}")
+        customer_ids = decode_customer_keys(customers, load_customer_index(args.customer_index))
+    else:
+        customer_ids = customers
+
     # Prepare final DF
     out_rows = []
-    for cust, (t, p) in cust_map.items():
-        out_rows.append({id_col: cust, pred_col: p})
+    for cust, cust_id in zip(customers, customer_ids):
+        out_rows.append({id_col: cust_id, pred_col: cust_map[cust][1]})
 
     submission_df = pd.DataFrame(out_rows)
     # Ensure column order
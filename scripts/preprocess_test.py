@@ -5,13 +5,18 @@ Stage 3: Preprocess Kaggle test data for AmEx Default Prediction.
 
 Steps:
 1. Read raw test_data.csv in chunks.
-2. Apply the same preprocessing pipeline as training
-   (types, imputations, missingness flags).
+2. Assign every test customer an int32 customer_key (customer_index_test.parquet;
+   with --extend-customer-index existing keys are kept and new customers appended)
+   and apply the same preprocessing pipeline as training
+   (types, missingness flags, imputation with the train imputation_stats.json).
 3. Save parquet parts under data/stage/refined_data (via preprocess_and_save_parquet).
-4. Load those parts and apply load_and_prepare_for_linear
-   using the existing category_map.json.
+4. Stream those parts through iter_prepare_for_linear using the existing
+   category_map.json and append each batch to linear_test.parquet.
 5. Save:
    - data/stage/linear_test.parquet
+   - data/stage/customer_index_test.parquet (decodes keys when writing submissions)
+   - data/stage/linear_test_onehot.npz (with --sparse-onehot)
+   - data/stage/statement_store_test/ (with --statement-store, see src/statement_store.py)
 """
 
 import argparse
@@ -22,10 +27,17 @@ from pathlib import Path
 project_root = Path(__file__).resolve().parents[1]
 sys.path.append(str(project_root))
 
+import scipy.sparse as sp
+
 from src.preprocessing import (
+    build_customer_index,
+    load_imputation_stats,
     preprocess_and_save_parquet,
+    iter_prepare_for_linear,
     load_and_prepare_for_linear,
+    write_parquet_batches,
 )
+from src.statement_store import build_statement_store
 
 
 def main():
@@ -36,6 +48,40 @@ def main():
         default=100_000,
         help="Number of rows per chunk when reading test_data.csv",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Worker processes for parallel byte-range CSV parsing (default: 1 = serial)",
+    )
+    parser.add_argument(
+        "--reader",
+        choices=["pandas", "arrow"],
+        default="pandas",
+        help="CSV reader backend: pandas dtype inference or pyarrow with an explicit schema",
+    )
+    parser.add_argument(
+        "--imputation",
+        choices=["global", "chunk"],
+        default="global",
+        help="Impute with the train imputation_stats.json (global) or per-chunk medians/modes",
+    )
+    parser.add_argument(
+        "--statement-store",
+        action="store_true",
+        help="Also build a customer-sorted statement store (statement_store_test/) from the parquet parts",
+    )
+    parser.add_argument(
+        "--extend-customer-index",
+        action="store_true",
+        help="Keep the keys of an existing customer_index_test.parquet and only append new customers "
+             "(e.g. a new monthly batch absorbed with aggregate_customer.py --update)",
+    )
+    parser.add_argument(
+        "--sparse-onehot",
+        action="store_true",
+        help="Save the one-hot block as a sparse CSR matrix instead of dense dummy columns",
+    )
     args = parser.parse_args()
 
     project_root = Path(__file__).resolve().parents[1]
@@ -45,15 +91,29 @@ def main():
 
     test_data_path = raw_dir / "test_data.csv"
     category_map_path = stage_dir / "category_map.json"
+    imputation_stats_path = stage_dir / "imputation_stats.json"
 
     if not test_data_path.exists():
         raise FileNotFoundError(f"test_data.csv not found at {test_data_path}")
     if not category_map_path.exists():
         raise FileNotFoundError(f"category_map.json not found at {category_map_path}")
+    if args.imputation == "global" and not imputation_stats_path.exists():
+        raise FileNotFoundError(f"imputation_stats.json not found at {imputation_stats_path}")
 
     print(f"[INFO] Using test data: {test_data_path}")
     print(f"[INFO] Using category map: {category_map_path}")
 
+    imputation_stats = None
+    if args.imputation == "global":
+        print(f"[INFO] Using train imputation stats: {imputation_stats_path}")
+        imputation_stats = load_imputation_stats(str(imputation_stats_path))
+
+    customer_index_path = stage_dir / "customer_index_test.parquet"
+    print(f"[INFO] {'Extending' if args.extend_customer_index else 'Building'} test customer index at "
+          f"{customer_index_path} ...")
+    build_customer_index(str(test_data_path), output_path=str(customer_index_path),
+                         extend=args.extend_customer_index)
+
     # -------------------------------------------------------------------------
     # 1. Preprocess test_data.csv into parquet parts
     # -------------------------------------------------------------------------
@@ -63,25 +123,54 @@ def main():
         input_csv=str(test_data_path),
         output_prefix=str(output_prefix),
         chunksize=args.chunksize,
+        workers=args.workers,
+        reader=args.reader,
+        imputation_stats=imputation_stats,
+        customer_index_path=str(customer_index_path),
     )
     print(f"[INFO] Created {len(parquet_paths)} test parquet parts.")
 
-    # -------------------------------------------------------------------------
-    # 2. Build linear-ready DataFrame using existing category map
-    # -------------------------------------------------------------------------
-    print("[INFO] Loading test parquet parts and preparing linear features...")
-    linear_test_df = load_and_prepare_for_linear(
-        parquet_paths=parquet_paths,
-        category_map_path=str(category_map_path),
-    )
-    print(f"[INFO] linear_test_df shape: {linear_test_df.shape}")
+    if args.statement_store:
+        store_dir = stage_dir / "statement_store_test"
+        print(f"[INFO] Building customer-sorted statement store at {store_dir} ...")
+        build_statement_store(parquet_paths, str(store_dir))
 
     # -------------------------------------------------------------------------
-    # 3. Save linear_test.parquet
+    # 2. Build linear-ready DataFrame using existing category map
     # -------------------------------------------------------------------------
     linear_test_path = stage_dir / "linear_test.parquet"
-    print(f"[INFO] Saving linear_test.parquet to {linear_test_path}")
-    linear_test_df.to_parquet(linear_test_path, index=False)
+    if args.sparse_onehot:
+        print("[INFO] Loading test parquet parts and preparing linear features...")
+        linear_test_df, onehot = load_and_prepare_for_linear(
+            parquet_paths=parquet_paths,
+            category_map_path=str(category_map_path),
+            sparse=True,
+        )
+        print(f"[INFO] Sparse one-hot block: shape={onehot.shape}, nnz={onehot.nnz}")
+        print(f"[INFO] linear_test_df shape: {linear_test_df.shape}")
+
+        # ---------------------------------------------------------------------
+        # 3. Save linear_test.parquet + one-hot block
+        # ---------------------------------------------------------------------
+        print(f"[INFO] Saving linear_test.parquet to {linear_test_path}")
+        linear_test_df.to_parquet(linear_test_path, index=False)
+
+        onehot_path = stage_dir / "linear_test_onehot.npz"
+        print(f"[INFO] Saving sparse one-hot block to {onehot_path}")
+        sp.save_npz(onehot_path, onehot)
+    else:
+        # ---------------------------------------------------------------------
+        # 3. Stream batches into linear_test.parquet
+        # ---------------------------------------------------------------------
+        print(f"[INFO] Streaming linear features into {linear_test_path} ...")
+        columns = write_parquet_batches(
+            iter_prepare_for_linear(
+                parquet_paths=parquet_paths,
+                category_map_path=str(category_map_path),
+            ),
+            str(linear_test_path),
+        )
+        print(f"[INFO] linear_test.parquet written ({len(columns)} columns)")
 
     print("[INFO] Test preprocessing step completed successfully.")
 
@@ -4,16 +4,26 @@
 Stage 1: Preprocess training data for AmEx Default Prediction.
 
 Steps:
-1. Read raw train_data.csv in chunks.
-2. Apply preprocessing (types, imputations, missingness flags).
+1. Assign every customer a dense int32 customer_key (customer_index_train.parquet;
+   with --extend-customer-index existing keys are kept and new customers appended)
+   and fit global imputation statistics (medians/modes) in streaming passes.
+2. Read raw train_data.csv in chunks and apply preprocessing
+   (types, customer keys, imputations, missingness flags).
 3. Save chunked parquet parts under data/stage/refined_data.
 4. Build category_map.json from the parquet parts (for stable linear encoding).
-5. Build a linear-ready DataFrame with one-hot encoding.
-6. Merge with train_labels.csv.
+5. Stream linear-ready batches (fixed one-hot columns) part by part.
+6. Merge each batch with train_labels.csv and append it to linear_train.parquet.
 7. Save:
    - data/stage/linear_train.parquet
+   - data/stage/customer_index_train.parquet
+   - data/stage/imputation_stats.json
    - data/stage/category_map.json
    - data/stage/feature_columns.json
+   With --sparse-onehot the one-hot block is kept out of linear_train.parquet and saved as:
+   - data/stage/linear_train_onehot.npz (scipy CSR, row-aligned with linear_train.parquet)
+   - data/stage/linear_column_index.json (one-hot column names)
+   With --statement-store the parts are also rewritten customer-sorted into
+   data/stage/statement_store_train/ (see src/statement_store.py).
 """
 
 import argparse
@@ -27,12 +37,22 @@ sys.path.append(str(project_root))
 
 
 import pandas as pd
+import scipy.sparse as sp
 
 from src.preprocessing import (
+    CUSTOMER_ID_COL,
+    CUSTOMER_KEY_COL,
+    build_customer_index,
+    build_linear_column_index,
+    encode_customer_ids,
+    fit_imputation_stats,
     preprocess_and_save_parquet,
     build_category_map,
+    iter_prepare_for_linear,
     load_and_prepare_for_linear,
+    write_parquet_batches,
 )
+from src.statement_store import build_statement_store
 
 
 def main():
@@ -43,6 +63,40 @@ def main():
         default=100_000,
         help="Number of rows per chunk when reading train_data.csv",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Worker processes for parallel byte-range CSV parsing (default: 1 = serial)",
+    )
+    parser.add_argument(
+        "--reader",
+        choices=["pandas", "arrow"],
+        default="pandas",
+        help="CSV reader backend: pandas dtype inference or pyarrow with an explicit schema",
+    )
+    parser.add_argument(
+        "--imputation",
+        choices=["global", "chunk"],
+        default="global",
+        help="Impute with global train medians/modes (saved to imputation_stats.json) or per-chunk ones",
+    )
+    parser.add_argument(
+        "--statement-store",
+        action="store_true",
+        help="Also build a customer-sorted statement store (statement_store_train/) from the parquet parts",
+    )
+    parser.add_argument(
+        "--extend-customer-index",
+        action="store_true",
+        help="Keep the keys of an existing customer_index_train.parquet and only append new customers "
+             "(e.g. a new monthly batch absorbed with aggregate_customer.py --update)",
+    )
+    parser.add_argument(
+        "--sparse-onehot",
+        action="store_true",
+        help="Save the one-hot block as a sparse CSR matrix instead of dense dummy columns",
+    )
     args = parser.parse_args()
 
     # -------------------------------------------------------------------------
@@ -65,6 +119,27 @@ def main():
     print(f"[INFO] Using train labels: {train_labels_path}")
     print(f"[INFO] Stage directory:    {stage_dir}")
 
+    # -------------------------------------------------------------------------
+    # 0. Build customer index and fit global imputation statistics
+    # -------------------------------------------------------------------------
+    customer_index_path = stage_dir / "customer_index_train.parquet"
+    print(f"[INFO] {'Extending' if args.extend_customer_index else 'Building'} customer index at "
+          f"{customer_index_path} ...")
+    customer_index = build_customer_index(str(train_data_path), output_path=str(customer_index_path),
+                                          extend=args.extend_customer_index)
+
+    imputation_stats = None
+    if args.imputation == "global":
+        imputation_stats_path = stage_dir / "imputation_stats.json"
+        print(f"[INFO] Fitting global imputation statistics at {imputation_stats_path} ...")
+        imputation_stats = fit_imputation_stats(
+            input_csv=str(train_data_path),
+            output_path=str(imputation_stats_path),
+            chunksize=args.chunksize,
+            workers=args.workers,
+            reader=args.reader,
+        )
+
     # -------------------------------------------------------------------------
     # 1. Preprocess train_data.csv into parquet parts
     # -------------------------------------------------------------------------
@@ -74,55 +149,84 @@ def main():
         input_csv=str(train_data_path),
         output_prefix=str(output_prefix),
         chunksize=args.chunksize,
+        workers=args.workers,
+        reader=args.reader,
+        imputation_stats=imputation_stats,
+        customer_index_path=str(customer_index_path),
     )
     print(f"[INFO] Created {len(parquet_paths)} parquet parts.")
 
+    if args.statement_store:
+        store_dir = stage_dir / "statement_store_train"
+        print(f"[INFO] Building customer-sorted statement store at {store_dir} ...")
+        build_statement_store(parquet_paths, str(store_dir))
+
     # -------------------------------------------------------------------------
     # 2. Build category map from training parquet parts
     # -------------------------------------------------------------------------
     category_map_path = stage_dir / "category_map.json"
     print(f"[INFO] Building category map at {category_map_path} ...")
-    build_category_map(parquet_paths, output_path=str(category_map_path))
-
-    # -------------------------------------------------------------------------
-    # 3. Build linear-ready DataFrame (consistent one-hot encoding)
-    # -------------------------------------------------------------------------
-    print("[INFO] Loading parquet parts and preparing linear features...")
-    linear_df = load_and_prepare_for_linear(
-        parquet_paths=parquet_paths,
-        category_map_path=str(category_map_path),
-    )
-    print(f"[INFO] linear_df shape (before merging labels): {linear_df.shape}")
+    category_map = build_category_map(parquet_paths, output_path=str(category_map_path))
 
     # -------------------------------------------------------------------------
-    # 4. Merge with labels
+    # 3. Load labels
     # -------------------------------------------------------------------------
-    print("[INFO] Merging with train_labels.csv ...")
+    print("[INFO] Loading train_labels.csv ...")
     labels_df = pd.read_csv(train_labels_path)
 
-    # Ensure customer_ID type matches (string on both sides)
-    if "customer_ID" in labels_df.columns:
-        labels_df["customer_ID"] = labels_df["customer_ID"].astype("string")
-
-    train_df = linear_df.merge(labels_df, on="customer_ID", how="left")
-
-    if "target" not in train_df.columns:
-        raise ValueError("Column 'target' not found after merging labels. Check join keys.")
-
-    print(f"[INFO] train_df shape (after merging labels): {train_df.shape}")
+    # Join on the int32 customer key, not the customer_ID strings
+    labels_df[CUSTOMER_KEY_COL] = encode_customer_ids(labels_df[CUSTOMER_ID_COL], customer_index)
+    labels_df = labels_df.drop(columns=[CUSTOMER_ID_COL])
 
     # -------------------------------------------------------------------------
-    # 5. Save linear_train.parquet
+    # 4. Build linear-ready table (consistent one-hot encoding) with labels
     # -------------------------------------------------------------------------
     linear_train_path = stage_dir / "linear_train.parquet"
-    print(f"[INFO] Saving full training table to {linear_train_path} ...")
-    train_df.to_parquet(linear_train_path, index=False)
+    onehot_cols = []
+    if args.sparse_onehot:
+        print("[INFO] Loading parquet parts and preparing linear features...")
+        linear_df, onehot = load_and_prepare_for_linear(
+            parquet_paths=parquet_paths,
+            category_map_path=str(category_map_path),
+            sparse=True,
+        )
+        column_index_path = stage_dir / "linear_column_index.json"
+        onehot_cols = build_linear_column_index(category_map, output_path=str(column_index_path))
+        print(f"[INFO] Sparse one-hot block: shape={onehot.shape}, nnz={onehot.nnz}")
+
+        train_df = linear_df.merge(labels_df, on=CUSTOMER_KEY_COL, how="left")
+        if "target" not in train_df.columns:
+            raise ValueError("Column 'target' not found after merging labels. Check join keys.")
+        print(f"[INFO] train_df shape (after merging labels): {train_df.shape}")
+
+        print(f"[INFO] Saving full training table to {linear_train_path} ...")
+        train_df.to_parquet(linear_train_path, index=False)
+
+        # Left merge keeps linear_df row order, so the CSR rows still line up
+        onehot_path = stage_dir / "linear_train_onehot.npz"
+        print(f"[INFO] Saving sparse one-hot block to {onehot_path} ...")
+        sp.save_npz(onehot_path, onehot)
+        train_columns = train_df.columns.tolist()
+    else:
+        print(f"[INFO] Streaming linear features + labels into {linear_train_path} ...")
+        batches = (
+            batch.merge(labels_df, on=CUSTOMER_KEY_COL, how="left")
+            for batch in iter_prepare_for_linear(
+                parquet_paths=parquet_paths,
+                category_map_path=str(category_map_path),
+            )
+        )
+        train_columns = write_parquet_batches(batches, str(linear_train_path))
+        if "target" not in train_columns:
+            raise ValueError("Column 'target' not found after merging labels. Check join keys.")
+        print(f"[INFO] linear_train.parquet written ({len(train_columns)} columns)")
 
     # -------------------------------------------------------------------------
     # 6. Define and save feature_columns.json
     # -------------------------------------------------------------------------
-    drop_cols = ["customer_ID", "target", "S_2"]  # we won't feed these to linear models
-    feature_cols = [c for c in train_df.columns if c not in drop_cols]
+    drop_cols = [CUSTOMER_KEY_COL, "target", "S_2"]  # we won't feed these to linear models
+    # Sparse mode: numeric columns first, then the one-hot columns (CSR column order)
+    feature_cols = [c for c in train_columns if c not in drop_cols] + onehot_cols
 
     feature_cols_path = stage_dir / "feature_columns.json"
     with feature_cols_path.open("w") as f:
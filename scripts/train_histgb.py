@@ -7,18 +7,39 @@ Train Histogram Gradient Boosting model using:
 
 Then merge test features, generate predictions, and create submission.csv.
 
+With --customer-level, trains and predicts on one row per customer (latest
+statement + aggregates + label, src/training_data.py) instead of merging the
+aggregates onto every statement.
+
+The final train/test matrices are cached as memory-mapped .npy files under
+data/stage/feature_cache/ (src/feature_cache.py), keyed by the inputs and the
+feature list, so the other trainers and reruns skip loading and merging.
+
 Output files:
  - models/histgb_model.pkl
  - data/submissions/submission.csv
 """
 
+import argparse
+import sys
 import pandas as pd
 from sklearn.ensemble import HistGradientBoostingClassifier
 from pathlib import Path
-import json
 import pickle
 import numpy as np
 
+# Add project root to sys.path to allow importing from src
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.preprocessing import (
+    CUSTOMER_ID_COL,
+    CUSTOMER_KEY_COL,
+    decode_customer_keys,
+    load_customer_index,
+)
+from src.gbdt_params import HISTGB_PARAMS, NUM_BOOST_ROUNDS
+from src.training_data import load_or_build_test_matrix, load_or_build_train_matrix
+
 
 # ---------------------------------------------------------
 # Paths
@@ -35,7 +56,11 @@ TRAIN_LABELS = RAW / "train_labels.csv"
 TEST_AGG = AGG / "customer_level_test.parquet"
 TEST_LIN = STAGE / "linear_test.parquet"
 
+TRAIN_CUSTOMER_INDEX = STAGE / "customer_index_train.parquet"
+TEST_CUSTOMER_INDEX = STAGE / "customer_index_test.parquet"
+
 FEATURE_JSON = AGG / "feature_columns_customer_train.json"
+FEATURE_CACHE_DIR = STAGE / "feature_cache"
 
 SUBMISSION_DIR = BASE / "submissions"
 MODEL_DIR = Path("models")
@@ -49,59 +74,29 @@ MODEL_DIR.mkdir(exist_ok=True, parents=True)
 
 
 # ---------------------------------------------------------
-# Load training data
+# Arguments
 # ---------------------------------------------------------
-print("\n[1] Loading train customer-level features...")
-df_cust = pd.read_parquet(TRAIN_AGG)
-
-print("[2] Loading train linear features (includes target)...")
-df_lin = pd.read_parquet(TRAIN_LIN)
-
-print(f"Train shapes → cust={df_cust.shape}, linear={df_lin.shape}")
+parser = argparse.ArgumentParser(description="Train Histogram Gradient Boosting and write a submission")
+parser.add_argument("--customer-level", action="store_true",
+                    help="Train on one row per customer (latest statement + aggregates + label) "
+                         "instead of every statement")
+args = parser.parse_args()
 
-# Verify target exists in linear data
-if "target" not in df_lin.columns:
-    print("[3] Loading labels...")
-    df_lbl = pd.read_csv(TRAIN_LABELS)
-    df_lin = df_lin.merge(df_lbl, on="customer_ID", how="left")
-    print(f"Added target column. New shape: {df_lin.shape}")
 
-
-# ---------------------------------------------------------
-# Merge customer-level features with linear features
 # ---------------------------------------------------------
-print("\n[4] Merging training tables...")
-df_train = df_lin.merge(df_cust, on="customer_ID", how="left")
-
-print("Final merged train shape:", df_train.shape)
-print("Has target:", "target" in df_train.columns)
-
-
-# ---------------------------------------------------------
-# Identify feature columns
+# Load training data
 # ---------------------------------------------------------
-print("\n[5] Loading feature list...")
-with open(FEATURE_JSON, "r") as f:
-    customer_cols = json.load(f)
-
-# Add linear feature columns (exclude customer_ID and target)
-linear_cols = [c for c in df_lin.columns if c not in ["customer_ID", "target"]]
-
-# Combine all potential features
-all_features = sorted(set(customer_cols + linear_cols))
-
-# Filter to only columns that actually exist in df_train (excluding ID and target)
-exclude_cols = {"customer_ID", "target", "S_2"}
-features = [c for c in all_features if c in df_train.columns and c not in exclude_cols]
-
-print(f"Total features: {len(features)}")
+print("\n[1] Loading training matrix...")
+train_matrix = load_or_build_train_matrix(FEATURE_CACHE_DIR, TRAIN_LIN, TRAIN_AGG, TRAIN_LABELS, FEATURE_JSON,
+                                          TRAIN_CUSTOMER_INDEX, customer_level=args.customer_level)
+features = train_matrix.features
 
 
 # ---------------------------------------------------------
 # Prepare training data
 # ---------------------------------------------------------
-X_train = df_train[features].fillna(0)  # HistGB handles missing, but fillna for safety
-y_train = df_train["target"]
+X_train = np.nan_to_num(train_matrix.X, nan=0.0)  # HistGB handles missing, but fillna for safety
+y_train = train_matrix.y
 
 print("[6] Training set:", X_train.shape, "labels:", y_train.shape)
 
@@ -111,16 +106,7 @@ print("[6] Training set:", X_train.shape, "labels:", y_train.shape)
 # ---------------------------------------------------------
 print("\n[7] Training Histogram Gradient Boosting model...")
 
-model = HistGradientBoostingClassifier(
-    max_iter=1200,
-    learning_rate=0.02,
-    max_depth=6,
-    min_samples_leaf=20,
-    l2_regularization=2.0,
-    max_bins=255,
-    random_state=42,
-    verbose=1,
-)
+model = HistGradientBoostingClassifier(max_iter=NUM_BOOST_ROUNDS, verbose=1, **HISTGB_PARAMS)
 
 model.fit(X_train, y_train)
 
@@ -133,62 +119,35 @@ print(f"[✔] Model saved to {model_file}")
 # ---------------------------------------------------------
 # Load test features & predict in chunks (memory-efficient)
 # ---------------------------------------------------------
-print("\n[8] Loading test data...")
-test_cust = pd.read_parquet(TEST_AGG)
-test_lin = pd.read_parquet(TEST_LIN)
-
-print("Test shapes → cust=", test_cust.shape, "linear=", test_lin.shape)
-
-# Process test data in chunks to avoid OOM
-CHUNK_SIZE = 500_000  # Process 500k rows at a time
-print(f"\n[9] Processing test data in chunks of {CHUNK_SIZE:,} rows...")
-
-predictions_list = []
-total_rows = len(test_lin)
-num_chunks = (total_rows + CHUNK_SIZE - 1) // CHUNK_SIZE
-
-for chunk_idx in range(num_chunks):
-    start_idx = chunk_idx * CHUNK_SIZE
-    end_idx = min(start_idx + CHUNK_SIZE, total_rows)
-    
-    print(f"  Chunk {chunk_idx + 1}/{num_chunks}: rows {start_idx:,} to {end_idx:,}")
-    
-    # Get chunk of linear data
-    chunk_lin = test_lin.iloc[start_idx:end_idx].copy()
-    
-    # Merge with customer-level features
-    chunk_merged = chunk_lin.merge(test_cust, on="customer_ID", how="left")
-    
-    # Ensure same feature order and fill missing values
-    chunk_features = chunk_merged[features].fillna(0)
-    
-    # Predict probabilities
-    chunk_preds = model.predict_proba(chunk_features)[:, 1]
-    
-    # Store customer_ID and predictions
-    for cust_id, pred in zip(chunk_merged["customer_ID"], chunk_preds):
-        predictions_list.append({"customer_ID": cust_id, "prediction": pred})
-    
-    # Free memory
-    del chunk_lin, chunk_merged, chunk_features, chunk_preds
-    
-    # Force garbage collection every 5 chunks
-    if (chunk_idx + 1) % 5 == 0:
-        import gc
-        gc.collect()
-
-print(f"\n[10] Aggregating predictions to customer level...")
-# Convert to DataFrame
-df_predictions = pd.DataFrame(predictions_list)
+print("\n[8] Loading test matrix...")
+test_matrix = load_or_build_test_matrix(FEATURE_CACHE_DIR, TEST_LIN, TEST_AGG, features, TEST_CUSTOMER_INDEX,
+                                        customer_level=args.customer_level)
+
+# Predict in chunks straight from the memory-mapped matrix (missing values filled with 0)
+PREDICT_CHUNK_SIZE = 500_000
+print(f"\n[10] Predicting {len(test_matrix):,} rows in chunks of {PREDICT_CHUNK_SIZE:,}...")
+preds = []
+for start_idx in range(0, len(test_matrix), PREDICT_CHUNK_SIZE):
+    chunk_features = np.nan_to_num(test_matrix.X[start_idx:start_idx + PREDICT_CHUNK_SIZE], nan=0.0)
+    preds.append(model.predict_proba(chunk_features)[:, 1])
+df_predictions = pd.DataFrame({
+    CUSTOMER_KEY_COL: np.asarray(test_matrix.keys),
+    "prediction": np.concatenate(preds) if preds else np.zeros(0),
+})
 
 # Aggregate to customer level (take last prediction per customer, matching test set structure)
-df_submission = df_predictions.groupby("customer_ID", as_index=False).last()
+df_submission = df_predictions.groupby(CUSTOMER_KEY_COL, as_index=False).last()
+
+# Decode int32 customer keys back to customer_ID strings for the submission file
+df_submission[CUSTOMER_ID_COL] = decode_customer_keys(
+    df_submission[CUSTOMER_KEY_COL], load_customer_index(str(TEST_CUSTOMER_INDEX))
+)
 
 print(f"Total unique customers in submission: {len(df_submission):,}")
 
 # Create submission
 submission_path = SUBMISSION_DIR / "submission.csv"
-df_submission[["customer_ID", "prediction"]].to_csv(submission_path, index=False)
+df_submission[[CUSTOMER_ID_COL, "prediction"]].to_csv(submission_path, index=False)
 
 print(f"[✔] Submission saved to: {submission_path}")
 
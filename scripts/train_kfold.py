@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+Customer-grouped K-fold training for the GBDT models, with early stopping.
+
+Usage:
+    python scripts/train_kfold.py --model lightgbm
+    python scripts/train_kfold.py --model xgboost --folds 5 --parallel-folds 2 --threads 16
+    python scripts/train_kfold.py --model catboost --customer-level
+
+Behavior:
+ - Uses the same train/test feature matrices as train_<model>.py
+   (data/stage/feature_cache/, built here if missing).
+ - Splits customers (never statements) into --folds stratified folds; each fold
+   model trains on the other folds and early-stops on its own fold, up to 1200
+   rounds, so the number of rounds no longer needs tuning.
+ - Runs --parallel-folds folds at a time and splits --threads between them.
+ - Produces:
+     models/kfold/<model>_fold<k>.<ext>       fold models
+     models/kfold/<model>_oof.parquet         out-of-fold prediction per customer
+     models/kfold/<model>_metrics.json        fold AUCs, best iterations, OOF AUC
+     data/submissions/submission_<model>_kfold.csv   fold-averaged test predictions
+"""
+
+import argparse
+import json
+import os
+import pickle
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics import roc_auc_score
+from sklearn.model_selection import StratifiedKFold
+
+# Add project root to sys.path to allow importing from src
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.aggregation import segment_tail, sort_segments, time_sort_key
+from src.gbdt_params import CATBOOST_PARAMS, HISTGB_PARAMS, LGB_PARAMS, NUM_BOOST_ROUNDS, XGB_PARAMS
+from src.preprocessing import CUSTOMER_ID_COL, CUSTOMER_KEY_COL, decode_customer_keys, load_customer_index
+from src.training_data import load_or_build_test_matrix, load_or_build_train_matrix
+
+
+# ---------------------------------------------------------
+# Paths (same inputs as the train_<model>.py scripts)
+# ---------------------------------------------------------
+BASE = Path("data")
+STAGE = BASE / "stage"
+RAW = BASE / "raw"
+AGG = STAGE / "aggregated"
+
+TRAIN_AGG = AGG / "customer_level_train.parquet"
+TRAIN_LIN = STAGE / "linear_train.parquet"
+TRAIN_LABELS = RAW / "train_labels.csv"
+
+TEST_AGG = AGG / "customer_level_test.parquet"
+TEST_LIN = STAGE / "linear_test.parquet"
+
+TRAIN_CUSTOMER_INDEX = STAGE / "customer_index_train.parquet"
+TEST_CUSTOMER_INDEX = STAGE / "customer_index_test.parquet"
+
+FEATURE_JSON = AGG / "feature_columns_customer_train.json"
+FEATURE_CACHE_DIR = STAGE / "feature_cache"
+
+SUBMISSION_DIR = BASE / "submissions"
+KFOLD_DIR = Path("models") / "kfold"
+
+PREDICT_CHUNK_SIZE = 500_000
+
+MODEL_EXT = {"lightgbm": "txt", "xgboost": "json", "catboost": "cbm", "histgb": "pkl"}
+
+
+# ---------------------------------------------------------
+# Folds
+# ---------------------------------------------------------
+def customer_folds(keys: np.ndarray, y: np.ndarray, n_folds: int, seed: int) -> np.ndarray:
+    """Fold id per row; all rows of a customer share a fold, folds are stratified by label."""
+    customers, codes = np.unique(keys, return_inverse=True)
+    customer_label = np.zeros(len(customers), dtype=np.int8)
+    customer_label[codes] = y > 0.5
+    customer_fold = np.empty(len(customers), dtype=np.int8)
+    splitter = StratifiedKFold(n_splits=n_folds, shuffle=True, random_state=seed)
+    for fold, (_, held_out) in enumerate(splitter.split(np.zeros(len(customers)), customer_label)):
+        customer_fold[held_out] = fold
+    return customer_fold[codes]
+
+
+def latest_per_customer(keys: np.ndarray, times: np.ndarray, values: np.ndarray) -> pd.DataFrame:
+    """Value of each customer's latest row (by time; ties: last row), as customer_key, value."""
+    order, customers, offsets = sort_segments(keys, time_sort_key(times))
+    rows, segment, _ = segment_tail(offsets, 1)
+    return pd.DataFrame({CUSTOMER_KEY_COL: customers[segment], "value": values[order[rows]]})
+
+
+# ---------------------------------------------------------
+# Fold training (one function per model)
+# ---------------------------------------------------------
+def fold_inputs_lightgbm(train_matrix):
+    """
+    Bins the full matrix once (batch by batch, or from the binary saved by
+    train_lightgbm.py); folds train on subsets of it (no per-fold copy of raw values).
+    """
+    from src.lightgbm_dataset import binned_dataset
+
+    return binned_dataset(train_matrix)
+
+
+def train_fold_lightgbm(full, y, train_idx, valid_idx, threads, early_stopping_rounds):
+    import lightgbm as lgb
+
+    train_set = full.subset(train_idx)
+    valid_set = full.subset(valid_idx)
+    model = lgb.train(
+        {**LGB_PARAMS, "num_threads": threads},
+        train_set,
+        num_boost_round=NUM_BOOST_ROUNDS,
+        valid_sets=[valid_set],
+        callbacks=[lgb.early_stopping(early_stopping_rounds, verbose=False)],
+    )
+    best = model.best_iteration or NUM_BOOST_ROUNDS
+    predict = lambda rows: model.predict(rows, num_iteration=best, num_threads=threads)
+    return model, best, predict
+
+
+def fold_inputs_xgboost(train_matrix):
+    import xgboost as xgb
+
+    return xgb.DMatrix(train_matrix.X, label=train_matrix.y, feature_names=train_matrix.features)
+
+
+def train_fold_xgboost(full, y, train_idx, valid_idx, threads, early_stopping_rounds):
+    import xgboost as xgb
+
+    dtrain = full.slice(train_idx)
+    dvalid = full.slice(valid_idx)
+    model = xgb.train(
+        {**XGB_PARAMS, "nthread": threads},
+        dtrain,
+        num_boost_round=NUM_BOOST_ROUNDS,
+        evals=[(dvalid, "valid")],
+        early_stopping_rounds=early_stopping_rounds,
+        verbose_eval=False,
+    )
+    best = model.best_iteration + 1
+    features = full.feature_names
+    predict = lambda rows: model.predict(xgb.DMatrix(rows, feature_names=features, nthread=threads),
+                                         iteration_range=(0, best))
+    return model, best, predict
+
+
+def fold_inputs_catboost(train_matrix):
+    from catboost import Pool
+
+    return Pool(np.asarray(train_matrix.X), np.asarray(train_matrix.y), feature_names=train_matrix.features)
+
+
+def train_fold_catboost(full, y, train_idx, valid_idx, threads, early_stopping_rounds):
+    from catboost import CatBoostClassifier
+
+    model = CatBoostClassifier(iterations=NUM_BOOST_ROUNDS, thread_count=threads,
+                               early_stopping_rounds=early_stopping_rounds, verbose=False, **CATBOOST_PARAMS)
+    model.fit(full.slice(train_idx), eval_set=full.slice(valid_idx), use_best_model=True)
+    best = model.get_best_iteration() + 1
+    predict = lambda rows: model.predict_proba(rows, thread_count=threads)[:, 1]
+    return model, best, predict
+
+
+def fold_inputs_histgb(train_matrix):
+    # HistGB trains on zero-filled features (as in train_histgb.py)
+    return np.nan_to_num(train_matrix.X, nan=0.0)
+
+
+def train_fold_histgb(full, y, train_idx, valid_idx, threads, early_stopping_rounds):
+    from sklearn.ensemble import HistGradientBoostingClassifier
+
+    # Thread count is set process-wide in main() (OpenMP)
+    model = HistGradientBoostingClassifier(max_iter=NUM_BOOST_ROUNDS, early_stopping=True, scoring="loss",
+                                           n_iter_no_change=early_stopping_rounds, **HISTGB_PARAMS)
+    model.fit(full[train_idx], y[train_idx], X_val=full[valid_idx], y_val=y[valid_idx])
+    # n_iter_ counts the early_stopping_rounds rounds without improvement too; HistGB
+    # cannot be cut back to its best round, so it predicts with all n_iter_ of them
+    stopped_early = model.n_iter_ < NUM_BOOST_ROUNDS
+    best = max(1, model.n_iter_ - early_stopping_rounds) if stopped_early else model.n_iter_
+    predict = lambda rows: model.predict_proba(np.nan_to_num(rows, nan=0.0))[:, 1]
+    return model, best, predict
+
+
+FOLD_TRAINERS = {
+    "lightgbm": (fold_inputs_lightgbm, train_fold_lightgbm),
+    "xgboost": (fold_inputs_xgboost, train_fold_xgboost),
+    "catboost": (fold_inputs_catboost, train_fold_catboost),
+    "histgb": (fold_inputs_histgb, train_fold_histgb),
+}
+
+
+def save_fold_model(model_name: str, model, path: Path) -> None:
+    if model_name == "histgb":
+        with open(path, "wb") as f:
+            pickle.dump(model, f)
+    else:
+        model.save_model(str(path))
+
+
+def predict_in_chunks(predict, X: np.ndarray, rows: np.ndarray = None) -> np.ndarray:
+    """Predictions for X[rows] (all rows if None), reading the memory map chunk by chunk."""
+    n = len(X) if rows is None else len(rows)
+    out = np.empty(n, dtype=np.float64)
+    for start in range(0, n, PREDICT_CHUNK_SIZE):
+        stop = min(start + PREDICT_CHUNK_SIZE, n)
+        chunk = X[start:stop] if rows is None else X[rows[start:stop]]
+        out[start:stop] = predict(np.asarray(chunk))
+    return out
+
+
+# ---------------------------------------------------------
+# Main
+# ---------------------------------------------------------
+def main():
+    p = argparse.ArgumentParser(description="Customer-grouped K-fold GBDT training with early stopping")
+    p.add_argument("--model", choices=sorted(FOLD_TRAINERS), required=True)
+    p.add_argument("--folds", type=int, default=5, help="Number of customer folds (default: 5)")
+    p.add_argument("--parallel-folds", type=int, default=None,
+                   help="Folds trained at the same time (default: min(folds, threads // 4))")
+    p.add_argument("--threads", type=int, default=os.cpu_count() or 1,
+                   help="Total thread budget, split evenly between parallel folds (default: all cores)")
+    p.add_argument("--early-stopping-rounds", type=int, default=100,
+                   help="Stop a fold after this many rounds without improvement on its held-out fold")
+    p.add_argument("--customer-level", action="store_true",
+                   help="One row per customer (latest statement + aggregates), as train_<model>.py --customer-level")
+    p.add_argument("--seed", type=int, default=42, help="Fold assignment seed")
+    args = p.parse_args()
+
+    parallel = args.parallel_folds or max(1, min(args.folds, args.threads // 4))
+    threads_per_fold = max(1, args.threads // parallel)
+    KFOLD_DIR.mkdir(parents=True, exist_ok=True)
+    SUBMISSION_DIR.mkdir(parents=True, exist_ok=True)
+
+    train_matrix = load_or_build_train_matrix(FEATURE_CACHE_DIR, TRAIN_LIN, TRAIN_AGG, TRAIN_LABELS, FEATURE_JSON,
+                                              TRAIN_CUSTOMER_INDEX, customer_level=args.customer_level)
+    keys = np.asarray(train_matrix.keys)
+    y = np.asarray(train_matrix.y)
+    folds = customer_folds(keys, y, args.folds, args.seed)
+    print(f"[INFO] {len(y):,} rows, {len(train_matrix.features):,} features, {args.folds} customer folds; "
+          f"{parallel} fold(s) at a time x {threads_per_fold} thread(s)")
+
+    if args.model == "histgb":
+        # OpenMP threads are per process: give every concurrent fold its share
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=threads_per_fold, user_api="openmp")
+
+    build_inputs, train_fold = FOLD_TRAINERS[args.model]
+    full = build_inputs(train_matrix)
+
+    test_matrix = load_or_build_test_matrix(FEATURE_CACHE_DIR, TEST_LIN, TEST_AGG, train_matrix.features,
+                                            TEST_CUSTOMER_INDEX, customer_level=args.customer_level)
+
+    def _run_fold(fold):
+        start = time.time()
+        train_idx = np.flatnonzero(folds != fold)
+        valid_idx = np.flatnonzero(folds == fold)
+        model, best, predict = train_fold(full, y, train_idx, valid_idx, threads_per_fold,
+                                          args.early_stopping_rounds)
+        valid_pred = predict_in_chunks(predict, train_matrix.X, valid_idx)
+        test_pred = predict_in_chunks(predict, test_matrix.X)
+        save_fold_model(args.model, model, KFOLD_DIR / f"{args.model}_fold{fold}.{MODEL_EXT[args.model]}")
+        return fold, valid_idx, valid_pred, test_pred, best, time.time() - start
+
+    oof = np.full(len(y), np.nan)
+    test_sum = np.zeros(len(test_matrix))
+    fold_metrics = []
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        futures = [executor.submit(_run_fold, fold) for fold in range(args.folds)]
+        for future in as_completed(futures):
+            fold, valid_idx, valid_pred, test_pred, best, seconds = future.result()
+            oof[valid_idx] = valid_pred
+            test_sum += test_pred
+            auc = roc_auc_score(y[valid_idx], valid_pred)
+            fold_metrics.append({"fold": fold, "roc_auc": float(auc), "best_iteration": int(best),
+                                 "seconds": round(seconds, 1)})
+            print(f"[RESULT] Fold {fold}: ROC-AUC {auc:.6f}, best iteration {best}/{NUM_BOOST_ROUNDS}, {seconds:.1f}s")
+
+    # Customer-level out-of-fold predictions and metric (latest statement per customer)
+    time_ns = np.asarray(train_matrix.time)
+    oof_df = latest_per_customer(keys, time_ns, oof).rename(columns={"value": "oof"})
+    oof_df["target"] = latest_per_customer(keys, time_ns, y)["value"].to_numpy()
+    oof_path = KFOLD_DIR / f"{args.model}_oof.parquet"
+    oof_df.to_parquet(oof_path, index=False)
+    oof_auc = roc_auc_score(oof_df["target"], oof_df["oof"])
+    print(f"[RESULT] Out-of-fold ROC-AUC: {oof_auc:.6f} ({len(oof_df):,} customers) -> {oof_path}")
+
+    fold_metrics.sort(key=lambda m: m["fold"])
+    metrics = {
+        "model_type": args.model,
+        "oof_roc_auc": float(oof_auc),
+        "folds": fold_metrics,
+        "max_rounds": NUM_BOOST_ROUNDS,
+        "early_stopping_rounds": args.early_stopping_rounds,
+        "parallel_folds": parallel,
+        "threads_per_fold": threads_per_fold,
+        "customer_level": bool(args.customer_level),
+        "n_train_rows": int(len(y)),
+        "n_features": len(train_matrix.features),
+        "seed": args.seed,
+    }
+    metrics_path = KFOLD_DIR / f"{args.model}_metrics.json"
+    with metrics_path.open("w") as f:
+        json.dump(metrics, f, indent=2)
+    print(f"[INFO] Saved metrics to {metrics_path}")
+
+    # Fold-averaged test predictions, latest statement per customer
+    test_pred = test_sum / args.folds
+    df_submission = latest_per_customer(np.asarray(test_matrix.keys), np.asarray(test_matrix.time), test_pred)
+    df_submission = df_submission.rename(columns={"value": "prediction"})
+    df_submission[CUSTOMER_ID_COL] = decode_customer_keys(
+        df_submission[CUSTOMER_KEY_COL], load_customer_index(str(TEST_CUSTOMER_INDEX))
+    )
+    submission_path = SUBMISSION_DIR / f"submission_{args.model}_kfold.csv"
+    df_submission[[CUSTOMER_ID_COL, "prediction"]].to_csv(submission_path, index=False)
+    print(f"[INFO] Submission saved to: {submission_path} ({len(df_submission):,} customers)")
+
+
+if __name__ == "__main__":
+    main()
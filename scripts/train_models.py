@@ -7,6 +7,7 @@ This script:
 1. Loads preprocessed training data from:
    - data/stage/linear_train.parquet
    - data/stage/feature_columns.json
+   - data/stage/linear_train_onehot.npz + linear_column_index.json (with --sparse)
 2. Performs a customer-wise 80/20 train/validation split.
 3. Trains a Logistic Regression model (with StandardScaler).
 4. Evaluates on validation set using ROC-AUC.
@@ -17,17 +18,25 @@ This script:
 
 import argparse
 import json
+import sys
 from pathlib import Path
 
+# Add project root to sys.path to allow importing from src
+project_root = Path(__file__).resolve().parents[1]
+sys.path.append(str(project_root))
+
 import joblib
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import roc_auc_score
 from sklearn.model_selection import train_test_split
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler
 
+from src.preprocessing import CUSTOMER_KEY_COL
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -43,6 +52,11 @@ def main():
         default=42,
         help="Random seed for reproducibility.",
     )
+    parser.add_argument(
+        "--sparse",
+        action="store_true",
+        help="Train on numeric columns + the sparse one-hot block from preprocess_train.py --sparse-onehot.",
+    )
     args = parser.parse_args()
 
     # -------------------------------------------------------------------------
@@ -71,20 +85,39 @@ def main():
     with feature_cols_path.open("r") as f:
         feature_cols = json.load(f)
 
-    missing_features = [c for c in feature_cols if c not in df.columns]
+    onehot = None
+    numeric_cols = feature_cols
+    if args.sparse:
+        onehot_path = stage_dir / "linear_train_onehot.npz"
+        column_index_path = stage_dir / "linear_column_index.json"
+        if not onehot_path.exists():
+            raise FileNotFoundError(f"linear_train_onehot.npz not found at {onehot_path}")
+        with column_index_path.open("r") as f:
+            onehot_cols = json.load(f)
+        onehot = sp.load_npz(onehot_path).tocsr()
+        if onehot.shape != (df.shape[0], len(onehot_cols)):
+            raise ValueError(f"One-hot block shape {onehot.shape} does not match data rows/column index")
+
+        onehot_set = set(onehot_cols)
+        numeric_cols = [c for c in feature_cols if c not in onehot_set]
+        if feature_cols != numeric_cols + onehot_cols:
+            raise ValueError("feature_columns.json must list numeric columns followed by the one-hot columns")
+        print(f"[INFO] Sparse one-hot block: shape={onehot.shape}, nnz={onehot.nnz}")
+
+    missing_features = [c for c in numeric_cols if c not in df.columns]
     if missing_features:
         raise ValueError(f"The following feature columns are missing in data: {missing_features}")
 
     if "target" not in df.columns:
         raise ValueError("Column 'target' is missing in training data.")
-    if "customer_ID" not in df.columns:
-        raise ValueError("Column 'customer_ID' is missing in training data.")
+    if CUSTOMER_KEY_COL not in df.columns:
+        raise ValueError(f"Column '{CUSTOMER_KEY_COL}' is missing in training data.")
 
     # -------------------------------------------------------------------------
     # Customer-wise train/validation split
     # -------------------------------------------------------------------------
     print("[INFO] Performing customer-wise train/validation split...")
-    customer_ids = df["customer_ID"].astype("string").unique()
+    customer_ids = df[CUSTOMER_KEY_COL].unique()
 
     # Simple random split of customers (no time-based logic for now)
     train_customers, val_customers = train_test_split(
@@ -93,8 +126,8 @@ def main():
         random_state=args.random_state,
     )
 
-    train_mask = df["customer_ID"].isin(train_customers)
-    val_mask = df["customer_ID"].isin(val_customers)
+    train_mask = df[CUSTOMER_KEY_COL].isin(train_customers)
+    val_mask = df[CUSTOMER_KEY_COL].isin(val_customers)
 
     train_df = df.loc[train_mask].reset_index(drop=True)
     val_df = df.loc[val_mask].reset_index(drop=True)
@@ -105,10 +138,21 @@ def main():
     # -------------------------------------------------------------------------
     # Build X, y
     # -------------------------------------------------------------------------
-    X_train = train_df[feature_cols]
-    y_train = train_df["target"].astype(int)
+    if onehot is not None:
+        # Numeric block stacked next to the CSR one-hot block (never densified)
+        X_train = sp.hstack(
+            [sp.csr_matrix(train_df[numeric_cols].to_numpy(dtype=np.float32)), onehot[train_mask.to_numpy()]],
+            format="csr",
+        )
+        X_val = sp.hstack(
+            [sp.csr_matrix(val_df[numeric_cols].to_numpy(dtype=np.float32)), onehot[val_mask.to_numpy()]],
+            format="csr",
+        )
+    else:
+        X_train = train_df[feature_cols]
+        X_val = val_df[feature_cols]
 
-    X_val = val_df[feature_cols]
+    y_train = train_df["target"].astype(int)
     y_val = val_df["target"].astype(int)
 
     print(f"[INFO] X_train shape: {X_train.shape}, y_train shape: {y_train.shape}")
@@ -172,6 +216,7 @@ def main():
         "test_size": args.test_size,
         "random_state": args.random_state,
         "model_type": "logistic_regression_saga",
+        "sparse_onehot": bool(args.sparse),
     }
 
     with metrics_path.open("w") as f:
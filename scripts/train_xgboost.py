@@ -7,18 +7,48 @@ Train XGBoost model using:
 
 Then merge test features, generate predictions, and create submission.csv.
 
+With --customer-level, trains and predicts on one row per customer (latest
+statement + aggregates + label, src/training_data.py) instead of merging the
+aggregates onto every statement.
+
+The final train/test matrices are cached as memory-mapped .npy files under
+data/stage/feature_cache/ (src/feature_cache.py), keyed by the inputs and the
+feature list, so the other trainers and reruns skip loading and merging.
+
+With --external-memory, training never holds the merged statement-level frame:
+a DataIter streams linear_train.parquet in batches, merges each batch with the
+customer-level features and feeds an ExtMemQuantileDMatrix whose pages are
+cached on disk (see docs/notes/xgboost_external_memory_benchmark.md).
+
 Output files:
  - models/xgboost_model.json
  - data/submissions/submission.csv
 """
 
+import argparse
+import sys
 import pandas as pd
+import pyarrow.parquet as pq
 import xgboost as xgb
 from pathlib import Path
-import json
 import os
+import shutil
 import numpy as np
 
+# Add project root to sys.path to allow importing from src
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from src.preprocessing import (
+    CUSTOMER_ID_COL,
+    CUSTOMER_KEY_COL,
+    decode_customer_keys,
+    encode_customer_ids,
+    load_customer_index,
+)
+from src.feature_cache import feature_cache_key
+from src.gbdt_params import NUM_BOOST_ROUNDS, XGB_PARAMS
+from src.training_data import load_or_build_test_matrix, load_or_build_train_matrix, model_features
+
 
 # ---------------------------------------------------------
 # Paths
@@ -35,77 +65,138 @@ TRAIN_LABELS = RAW / "train_labels.csv"
 TEST_AGG = AGG / "customer_level_test.parquet"
 TEST_LIN = STAGE / "linear_test.parquet"
 
+TRAIN_CUSTOMER_INDEX = STAGE / "customer_index_train.parquet"
+TEST_CUSTOMER_INDEX = STAGE / "customer_index_test.parquet"
+
 FEATURE_JSON = AGG / "feature_columns_customer_train.json"
+FEATURE_CACHE_DIR = STAGE / "feature_cache"
+EXTERNAL_MEMORY_BATCH_ROWS = 200_000
 
 SUBMISSION_DIR = BASE / "submissions"
 MODEL_DIR = Path("models")
 
 
 # ---------------------------------------------------------
-# Ensure dirs exist
+# External-memory input
 # ---------------------------------------------------------
-SUBMISSION_DIR.mkdir(exist_ok=True, parents=True)
-MODEL_DIR.mkdir(exist_ok=True, parents=True)
+def streaming_features(linear_path: Path, aggregate_path: Path, feature_json: Path):
+    """
+    The feature list of the in-memory path, from the parquet schemas alone
+    (columns in both files get merge suffixes there, so they are left out).
+    """
+    lin_names = set(pq.read_schema(linear_path).names)
+    agg_names = set(pq.read_schema(aggregate_path).names)
+    merged = (lin_names | agg_names) - ((lin_names & agg_names) - {CUSTOMER_KEY_COL})
+    return model_features(merged, linear_path, feature_json)
+
+
+class ParquetBatchIter(xgb.DataIter):
+    """
+    Statement-level training batches for external-memory DMatrix construction:
+    each batch of `linear_path` rows is merged with the in-memory customer-level
+    features (one row per customer) and labels, then handed to XGBoost.
+    XGBoost calls reset()/next() once per pass over the data.
+    """
+
+    def __init__(self, linear_path: Path, df_cust: pd.DataFrame, features, labels: pd.Series = None,
+                 batch_rows: int = EXTERNAL_MEMORY_BATCH_ROWS, cache_prefix: str = None):
+        self.linear_path = linear_path
+        self.df_cust = df_cust
+        self.features = features
+        self.labels = labels
+        self.batch_rows = batch_rows
+        names = set(pq.read_schema(linear_path).names)
+        self.columns = [c for c in [CUSTOMER_KEY_COL, "target", *features] if c in names and c not in df_cust.columns[1:]]
+        self._batches = None
+        super().__init__(cache_prefix=cache_prefix)
+
+    def reset(self) -> None:
+        self._batches = None
+
+    def next(self, input_data) -> bool:
+        if self._batches is None:
+            self._batches = pq.ParquetFile(self.linear_path).iter_batches(batch_size=self.batch_rows,
+                                                                         columns=self.columns)
+        batch = next(self._batches, None)
+        if batch is None:
+            return False
+        df = batch.to_pandas().merge(self.df_cust, on=CUSTOMER_KEY_COL, how="left")
+        label = df["target"] if self.labels is None else df[CUSTOMER_KEY_COL].map(self.labels)
+        input_data(data=df.reindex(columns=self.features).to_numpy(dtype=np.float32, na_value=np.nan),
+                   label=label.to_numpy(dtype=np.float32, na_value=np.nan), feature_names=self.features)
+        return True
 
 
 # ---------------------------------------------------------
-# Load training data
+# Ensure dirs exist
 # ---------------------------------------------------------
-print("\n[1] Loading train customer-level features...")
-df_cust = pd.read_parquet(TRAIN_AGG)
-
-print("[2] Loading train linear features (includes target)...")
-df_lin = pd.read_parquet(TRAIN_LIN)
-
-print(f"Train shapes → cust={df_cust.shape}, linear={df_lin.shape}")
-
-# Verify target exists in linear data
-if "target" not in df_lin.columns:
-    print("[3] Loading labels...")
-    df_lbl = pd.read_csv(TRAIN_LABELS)
-    df_lin = df_lin.merge(df_lbl, on="customer_ID", how="left")
-    print(f"Added target column. New shape: {df_lin.shape}")
+SUBMISSION_DIR.mkdir(exist_ok=True, parents=True)
+MODEL_DIR.mkdir(exist_ok=True, parents=True)
 
 
 # ---------------------------------------------------------
-# Merge customer-level features with linear features
+# Arguments
 # ---------------------------------------------------------
-print("\n[4] Merging training tables...")
-df_train = df_lin.merge(df_cust, on="customer_ID", how="left")
-
-print("Final merged train shape:", df_train.shape)
-print("Has target:", "target" in df_train.columns)
+parser = argparse.ArgumentParser(description="Train XGBoost and write a submission")
+parser.add_argument("--customer-level", action="store_true",
+                    help="Train on one row per customer (latest statement + aggregates + label) "
+                         "instead of every statement")
+parser.add_argument("--external-memory", action="store_true",
+                    help="Stream the statement-level train parquet in batches into an external-memory "
+                         "DMatrix (disk page cache) instead of loading the merged frame")
+args = parser.parse_args()
+if args.external_memory and args.customer_level:
+    parser.error("--external-memory streams statement-level data; it cannot be combined with --customer-level")
 
 
 # ---------------------------------------------------------
-# Identify feature columns
+# Load training data
 # ---------------------------------------------------------
-print("\n[5] Loading feature list...")
-with open(FEATURE_JSON, "r") as f:
-    customer_cols = json.load(f)
-
-# Add linear feature columns (exclude customer_ID and target)
-linear_cols = [c for c in df_lin.columns if c not in ["customer_ID", "target"]]
-
-# Combine all potential features
-all_features = sorted(set(customer_cols + linear_cols))
-
-# Filter to only columns that actually exist in df_train (excluding ID and target)
-exclude_cols = {"customer_ID", "target", "S_2"}
-features = [c for c in all_features if c in df_train.columns and c not in exclude_cols]
-
-print(f"Total features: {len(features)}")
+if args.external_memory:
+    print("\n[1] External-memory mode: loading customer-level features only...")
+    features = streaming_features(TRAIN_LIN, TRAIN_AGG, FEATURE_JSON)
+    agg_features = [c for c in features if c not in set(pq.read_schema(TRAIN_LIN).names)]
+    df_cust = pd.read_parquet(TRAIN_AGG, columns=[CUSTOMER_KEY_COL] + agg_features)
+    df_cust[agg_features] = df_cust[agg_features].astype(np.float32)
+
+    labels = None
+    if "target" not in pq.read_schema(TRAIN_LIN).names:
+        print("[3] Loading labels...")
+        df_lbl = pd.read_csv(TRAIN_LABELS)
+        df_lbl[CUSTOMER_KEY_COL] = encode_customer_ids(df_lbl.pop(CUSTOMER_ID_COL), load_customer_index(str(TRAIN_CUSTOMER_INDEX)))
+        labels = df_lbl.set_index(CUSTOMER_KEY_COL)["target"]
+
+    print(f"Total features: {len(features)}")
+else:
+    print("\n[1] Loading training matrix...")
+    train_matrix = load_or_build_train_matrix(FEATURE_CACHE_DIR, TRAIN_LIN, TRAIN_AGG, TRAIN_LABELS, FEATURE_JSON,
+                                              TRAIN_CUSTOMER_INDEX, customer_level=args.customer_level)
+    features = train_matrix.features
 
 
 # ---------------------------------------------------------
 # Prepare XGBoost Dataset
 # ---------------------------------------------------------
-X_train = df_train[features]
-y_train = df_train["target"]
+if args.external_memory:
+    # Quantile sketching and the hist pages are built batch by batch; pages live under page_dir
+    train_key = feature_cache_key([TRAIN_LIN, TRAIN_AGG, TRAIN_LABELS, FEATURE_JSON, TRAIN_CUSTOMER_INDEX],
+                                  options={"split": "train", "external_memory": True})
+    page_dir = FEATURE_CACHE_DIR / f"xgb_pages_{train_key}"
+    if page_dir.exists():
+        shutil.rmtree(page_dir)
+    page_dir.mkdir(parents=True)
+    train_iter = ParquetBatchIter(TRAIN_LIN, df_cust, features, labels=labels,
+                                  cache_prefix=str(page_dir / "train"))
+    dtrain = xgb.ExtMemQuantileDMatrix(train_iter, missing=np.nan, max_bin=256)
 
-print("[6] Training set:", X_train.shape, "labels:", y_train.shape)
+    print("[6] Training set (external memory):", (dtrain.num_row(), dtrain.num_col()))
+else:
+    X_train = train_matrix.X
+    y_train = train_matrix.y
 
-dtrain = xgb.DMatrix(X_train, label=y_train)
+    print("[6] Training set:", X_train.shape, "labels:", y_train.shape)
+
+    dtrain = xgb.DMatrix(X_train, label=y_train, feature_names=features)
 
 
 # ---------------------------------------------------------
@@ -113,26 +204,16 @@ dtrain = xgb.DMatrix(X_train, label=y_train)
 # ---------------------------------------------------------
 print("\n[7] Training XGBoost model...")
 
-params = {
-    "objective": "binary:logistic",
-    "eval_metric": "logloss",
-    "learning_rate": 0.02,
-    "max_depth": 6,
-    "min_child_weight": 1,
-    "subsample": 0.8,
-    "colsample_bytree": 0.8,
-    "lambda": 2.0,
-    "alpha": 0.1,
-    "tree_method": "hist",
-    "verbosity": 0,
-}
-
 model = xgb.train(
-    params,
+    XGB_PARAMS,
     dtrain,
-    num_boost_round=1200,
+    num_boost_round=NUM_BOOST_ROUNDS,
 )
 
+if args.external_memory:
+    del dtrain, train_iter, df_cust
+    shutil.rmtree(page_dir, ignore_errors=True)
+
 model_file = MODEL_DIR / "xgboost_model.json"
 model.save_model(str(model_file))
 print(f"[✔] Model saved to {model_file}")
@@ -141,63 +222,35 @@ print(f"[✔] Model saved to {model_file}")
 # ---------------------------------------------------------
 # Load test features & predict in chunks (memory-efficient)
 # ---------------------------------------------------------
-print("\n[8] Loading test data...")
-test_cust = pd.read_parquet(TEST_AGG)
-test_lin = pd.read_parquet(TEST_LIN)
-
-print("Test shapes → cust=", test_cust.shape, "linear=", test_lin.shape)
-
-# Process test data in chunks to avoid OOM
-CHUNK_SIZE = 500_000  # Process 500k rows at a time
-print(f"\n[9] Processing test data in chunks of {CHUNK_SIZE:,} rows...")
-
-predictions_list = []
-total_rows = len(test_lin)
-num_chunks = (total_rows + CHUNK_SIZE - 1) // CHUNK_SIZE
-
-for chunk_idx in range(num_chunks):
-    start_idx = chunk_idx * CHUNK_SIZE
-    end_idx = min(start_idx + CHUNK_SIZE, total_rows)
-    
-    print(f"  Chunk {chunk_idx + 1}/{num_chunks}: rows {start_idx:,} to {end_idx:,}")
-    
-    # Get chunk of linear data
-    chunk_lin = test_lin.iloc[start_idx:end_idx].copy()
-    
-    # Merge with customer-level features
-    chunk_merged = chunk_lin.merge(test_cust, on="customer_ID", how="left")
-    
-    # Ensure same feature order and fill missing values
-    chunk_features = chunk_merged[features].fillna(0)
-    
-    # Predict
-    dtest = xgb.DMatrix(chunk_features)
-    chunk_preds = model.predict(dtest)
-    
-    # Store customer_ID and predictions
-    for cust_id, pred in zip(chunk_merged["customer_ID"], chunk_preds):
-        predictions_list.append({"customer_ID": cust_id, "prediction": pred})
-    
-    # Free memory
-    del chunk_lin, chunk_merged, chunk_features, dtest, chunk_preds
-    
-    # Force garbage collection every 5 chunks
-    if (chunk_idx + 1) % 5 == 0:
-        import gc
-        gc.collect()
-
-print(f"\n[10] Aggregating predictions to customer level...")
-# Convert to DataFrame
-df_predictions = pd.DataFrame(predictions_list)
+print("\n[8] Loading test matrix...")
+test_matrix = load_or_build_test_matrix(FEATURE_CACHE_DIR, TEST_LIN, TEST_AGG, features, TEST_CUSTOMER_INDEX,
+                                        customer_level=args.customer_level)
+
+# Predict in chunks straight from the memory-mapped matrix (missing values filled with 0)
+PREDICT_CHUNK_SIZE = 500_000
+print(f"\n[10] Predicting {len(test_matrix):,} rows in chunks of {PREDICT_CHUNK_SIZE:,}...")
+preds = []
+for start_idx in range(0, len(test_matrix), PREDICT_CHUNK_SIZE):
+    chunk_features = np.nan_to_num(test_matrix.X[start_idx:start_idx + PREDICT_CHUNK_SIZE], nan=0.0)
+    preds.append(model.predict(xgb.DMatrix(chunk_features, feature_names=features)))
+df_predictions = pd.DataFrame({
+    CUSTOMER_KEY_COL: np.asarray(test_matrix.keys),
+    "prediction": np.concatenate(preds) if preds else np.zeros(0),
+})
 
 # Aggregate to customer level (take last prediction per customer, matching test set structure)
-df_submission = df_predictions.groupby("customer_ID", as_index=False).last()
+df_submission = df_predictions.groupby(CUSTOMER_KEY_COL, as_index=False).last()
+
+# Decode int32 customer keys back to customer_ID strings for the submission file
+df_submission[CUSTOMER_ID_COL] = decode_customer_keys(
+    df_submission[CUSTOMER_KEY_COL], load_customer_index(str(TEST_CUSTOMER_INDEX))
+)
 
 print(f"Total unique customers in submission: {len(df_submission):,}")
 
 # Create submission
 submission_path = SUBMISSION_DIR / "submission.csv"
-df_submission[["customer_ID", "prediction"]].to_csv(submission_path, index=False)
+df_submission[[CUSTOMER_ID_COL, "prediction"]].to_csv(submission_path, index=False)
 
 print(f"[✔] Submission saved to: {submission_path}")
 
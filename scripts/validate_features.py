@@ -20,11 +20,18 @@ Usage:
 
 import argparse
 import json
+import sys
 from pathlib import Path
 
+# Add project root to sys.path to allow importing from src
+project_root = Path(__file__).resolve().parents[1]
+sys.path.append(str(project_root))
+
 import numpy as np
 import pandas as pd
 
+from src.preprocessing import CUSTOMER_KEY_COL
+
 DEFAULT_TRAIN_FEATS = Path("data/stage/aggregated/feature_columns_customer_train.json")
 DEFAULT_TEST_PARQUET = Path("data/stage/aggregated/customer_level_test.parquet")
 
@@ -60,17 +67,17 @@ def main():
     print(f"[INFO] test table shape: {df_test.shape}")
 
     # ensure customer id exists
-    if "customer_ID" not in df_test.columns:
-        raise KeyError("customer_ID not found in test parquet. Aggregation step may have failed.")
+    if CUSTOMER_KEY_COL not in df_test.columns:
+        raise KeyError(f"{CUSTOMER_KEY_COL} not found in test parquet. Aggregation step may have failed.")
 
     # compute sets
     train_set = set(train_feats)
-    test_set = set([c for c in df_test.columns if c != "customer_ID"])
+    test_set = set([c for c in df_test.columns if c != CUSTOMER_KEY_COL])
     missing = sorted(list(train_set - test_set))
     extra = sorted(list(test_set - train_set))
 
     print(f"[RESULT] Train features: {len(train_feats)}")
-    print(f"[RESULT] Test features (excl customer_ID): {len(test_set)}")
+    print(f"[RESULT] Test features (excl {CUSTOMER_KEY_COL}): {len(test_set)}")
     print(f"[RESULT] Missing features in test (train - test): {len(missing)}")
     print(f"[RESULT] Extra features in test (test - train): {len(extra)}")
     if missing:
@@ -98,15 +105,15 @@ def main():
     if args.save:
         out_p = Path(args.out)
         print(f"[INFO] Reindexing test to train features and filling missing with {args.fill_value} ...")
-        # create ordered columns: customer_ID then train features
-        cols = ["customer_ID"] + train_feats
+        # create ordered columns: customer key then train features
+        cols = [CUSTOMER_KEY_COL] + train_feats
         # reindex will add missing columns with NaN
         df_reindexed = df_test.reindex(columns=cols)
-        # fill missing with fill-value (only on features, not customer_ID)
-        feat_cols = [c for c in cols if c != "customer_ID"]
+        # fill missing with fill-value (only on features, not the customer key)
+        feat_cols = [c for c in cols if c != CUSTOMER_KEY_COL]
         df_reindexed[feat_cols] = df_reindexed[feat_cols].fillna(args.fill_value).astype(np.float32)
-        # keep customer_ID as string
-        df_reindexed["customer_ID"] = df_reindexed["customer_ID"].astype("string")
+        # keep the customer key as int32
+        df_reindexed[CUSTOMER_KEY_COL] = df_reindexed[CUSTOMER_KEY_COL].astype(np.int32)
         print(f"[INFO] Saving reindexed parquet to: {out_p}")
         out_p.parent.mkdir(parents=True, exist_ok=True)
         df_reindexed.to_parquet(out_p, index=False)
@@ -0,0 +1,631 @@
+"""
+AmEx Default Prediction - Vectorized Segment Reductions.
+
+Per-customer statistics without a Python-level call per customer group:
+factorize the customer key once, sort once, and reduce contiguous row segments
+of a 2-D value matrix with NumPy ufunc.reduceat:
+
+    order, keys, offsets = sort_segments(df["customer_key"].to_numpy(), time_sort_key(df["S_2"]))
+    values = sorted_matrix(df, numeric_cols, order)
+    stats = segment_reduce(values, offsets)   # {"count": (n_customers, n_cols), "sum": ..., ...}
+
+Numeric partials are kept as MomentAccumulator state (count, mean, M2, min, max),
+merged across parts with Chan et al.'s parallel update.
+
+Segment j spans rows [offsets[j], offsets[j + 1]) of the sorted matrix and belongs
+to customer keys[j]. NaNs are ignored by every statistic (pandas groupby semantics).
+
+Approximate quantiles (p25/median/p75) come from QuantileSummary, a fixed-size
+mergeable summary that is exact for customers with few statements.
+
+The last k statements of every customer come from one stable sort and a
+boundary mask (segment_tail / tail_frame).
+
+Categorical columns reduce to per-(customer, value) counts (segment_value_counts),
+which merge across parts by addition; count_features derives mode/nunique/shares.
+
+Usage:
+    from src.aggregation import MomentAccumulator, sort_segments, sorted_matrix, segment_reduce
+"""
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+# Statistics returned by segment_reduce, in output column order
+NUMERIC_STATS = ("count", "sum", "mean", "m2", "std", "min", "max")
+
+
+def sort_segments(keys: np.ndarray, times: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Factorizes `keys` once and sorts rows into contiguous per-key segments.
+
+    Args:
+        keys: Customer key per row.
+        times: Optional secondary sort key (e.g. S_2); within a segment rows are
+            then in time order, so the last row of a segment is the latest statement.
+
+    Returns:
+        (order, segment_keys, offsets): `order` permutes rows into segment order,
+        segment j has key segment_keys[j] (ascending) and spans sorted rows
+        [offsets[j], offsets[j + 1]).
+    """
+    codes, uniques = pd.factorize(keys, sort=True)
+    if times is None:
+        order = np.argsort(codes, kind="stable")
+    else:
+        order = np.lexsort((times, codes))
+    counts = np.bincount(codes, minlength=len(uniques))
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    return order, np.asarray(uniques), offsets
+
+
+def time_sort_key(times) -> np.ndarray:
+    """
+    Statement dates as the int64 `times` key of sort_segments, with undated
+    statements (NaT, the int64 minimum) first: the last row of a segment is then
+    the customer's latest dated statement. Sorted as datetime64, NaT would go last.
+    """
+    return np.asarray(times, dtype="datetime64[ns]").astype(np.int64)
+
+
+def sorted_matrix(df: pd.DataFrame, columns, order: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Column-major float64 matrix of `columns`, rows permuted by `order`.
+
+    Gathering column by column is much cheaper than a fancy-indexed row take on a
+    wide matrix, and reduceat along axis 0 runs on contiguous columns.
+    """
+    values = np.empty((len(df), len(columns)), dtype=np.float64, order="F")
+    for j, c in enumerate(columns):
+        col = df[c].to_numpy(dtype=np.float64, na_value=np.nan)
+        values[:, j] = col if order is None else col[order]
+    return values
+
+
+def segment_reduce(values: np.ndarray, offsets: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    count/sum/mean/M2/std/min/max of every column of `values` per segment.
+
+    Args:
+        values: 2-D (n_rows, n_cols) matrix whose rows are already in segment order
+            (column-major is fastest, see sorted_matrix).
+        offsets: Segment boundaries (length n_segments + 1, no empty segments).
+
+    Returns:
+        Dict keyed by NUMERIC_STATS of (n_segments, n_cols) arrays. `count` is
+        int64, the rest float64. M2 is the sum of squared deviations from the
+        segment mean (two-pass, no sum-of-squares cancellation) and std the
+        population std sqrt(M2 / count). All-NaN segments give count 0, sum/M2 0
+        and NaN for mean/std/min/max.
+    """
+    values = np.asfortranarray(values, dtype=np.float64)
+    if values.ndim == 1:
+        values = values[:, None]
+    starts = offsets[:-1]
+    lengths = np.diff(offsets)
+    n_segments, n_cols = len(starts), values.shape[1]
+
+    out = {stat: np.empty((n_segments, n_cols), dtype=np.float64, order="F") for stat in NUMERIC_STATS}
+    out["count"] = np.empty((n_segments, n_cols), dtype=np.int64, order="F")
+    if n_segments == 0:
+        return out
+    if (lengths == 0).any():
+        raise ValueError("segment_reduce() does not support empty segments")
+
+    # One contiguous column at a time: 1-D reduceat is several times faster than
+    # reducing a wide 2-D block, and the column stays in cache across statistics.
+    for j in range(n_cols):
+        x = values[:, j]
+        missing = np.isnan(x)
+        has_missing = missing.any()
+        if has_missing:
+            filled = np.where(missing, 0.0, x)
+            count = lengths - np.add.reduceat(missing, starts, dtype=np.int64)
+        else:
+            filled = x
+            count = lengths
+
+        total = np.add.reduceat(filled, starts)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = total / count
+        deviation = filled - np.repeat(mean, lengths)
+        if has_missing:
+            deviation[missing] = 0.0
+        m2 = np.add.reduceat(deviation * deviation, starts)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            std = np.sqrt(m2 / count)
+
+        out["count"][:, j] = count
+        out["sum"][:, j] = total
+        out["mean"][:, j] = mean
+        out["m2"][:, j] = m2
+        out["std"][:, j] = std
+        # fmin/fmax skip NaN unless the whole segment is NaN
+        out["min"][:, j] = np.fmin.reduceat(x, starts) if has_missing else np.minimum.reduceat(x, starts)
+        out["max"][:, j] = np.fmax.reduceat(x, starts) if has_missing else np.maximum.reduceat(x, starts)
+
+    return out
+
+
+MOMENT_STATS = ("count", "mean", "m2", "min", "max")
+
+
+class MomentAccumulator:
+    """
+    Mergeable per-(customer, column) moments held in float64 arrays:
+    count, mean, M2 (sum of squared deviations from the mean), min and max.
+
+    Accumulators merge with Chan et al.'s parallel update
+        n = n_a + n_b,  mean = (n_a mean_a + n_b mean_b) / n,
+        M2 = M2_a + M2_b + n_a (mean_a - mean)^2 + n_b (mean_b - mean)^2
+    so variances never come from ssq/n - mean^2 and do not suffer catastrophic
+    cancellation; the result does not depend on how parts are grouped.
+    """
+
+    def __init__(self, keys: np.ndarray, columns: List[str], count: np.ndarray, mean: np.ndarray,
+                 m2: np.ndarray, minimum: np.ndarray, maximum: np.ndarray):
+        self.keys = np.asarray(keys)
+        self.columns = list(columns)
+        self.count = np.asarray(count, dtype=np.int64)
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.m2 = np.asarray(m2, dtype=np.float64)
+        self.min = np.asarray(minimum, dtype=np.float64)
+        self.max = np.asarray(maximum, dtype=np.float64)
+
+    @classmethod
+    def from_values(cls, keys: np.ndarray, columns: List[str], values: np.ndarray,
+                    offsets: np.ndarray) -> "MomentAccumulator":
+        """From raw rows in segment order (see sort_segments); keys has one entry per segment."""
+        stats = segment_reduce(values, offsets)
+        return cls(keys, columns, stats["count"], stats["mean"], stats["m2"], stats["min"], stats["max"])
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, customer_col: str) -> "MomentAccumulator":
+        """From a frame written by to_frame (`{col}_{stat}` columns)."""
+        columns = [c[:-len("_count")] for c in df.columns if c.endswith("_count")]
+
+        def _stat(stat):
+            if not columns:
+                return np.empty((len(df), 0))
+            return np.column_stack([df[f"{c}_{stat}"].to_numpy(dtype=np.float64) for c in columns])
+
+        return cls(df[customer_col].to_numpy(), columns, *(_stat(stat) for stat in MOMENT_STATS))
+
+    def to_frame(self, customer_col: str) -> pd.DataFrame:
+        """Partial layout: {col}_count, {col}_mean, {col}_m2, {col}_min, {col}_max per column."""
+        out = {customer_col: self.keys}
+        for j, c in enumerate(self.columns):
+            for stat, arr in zip(MOMENT_STATS, (self.count, self.mean, self.m2, self.min, self.max)):
+                out[f"{c}_{stat}"] = arr[:, j]
+        return pd.DataFrame(out)
+
+    def _aligned(self, columns: List[str]) -> Tuple[np.ndarray, ...]:
+        """Stats reindexed to `columns`; absent columns are empty (count 0)."""
+        n = len(self.keys)
+        pos = {c: j for j, c in enumerate(self.columns)}
+        arrays = []
+        for arr, fill in ((self.count, 0), (self.mean, 0.0), (self.m2, 0.0), (self.min, np.nan), (self.max, np.nan)):
+            out = np.full((n, len(columns)), fill, dtype=arr.dtype)
+            for j, c in enumerate(columns):
+                if c in pos:
+                    out[:, j] = arr[:, pos[c]]
+            arrays.append(out)
+        return tuple(arrays)
+
+    @classmethod
+    def combine(cls, accumulators: Iterable["MomentAccumulator"]) -> "MomentAccumulator":
+        """
+        Merges any number of accumulators in one vectorized pass: rows are grouped
+        by key and every group is reduced with the parallel update above.
+        """
+        accumulators = list(accumulators)
+        columns = list(dict.fromkeys(c for acc in accumulators for c in acc.columns))
+        parts = [acc._aligned(columns) for acc in accumulators]
+        keys = np.concatenate([acc.keys for acc in accumulators])
+        count, mean, m2, minimum, maximum = (np.concatenate(arrays) for arrays in zip(*parts))
+
+        order, merged_keys, offsets = sort_segments(keys)
+        if len(merged_keys) == 0:
+            return cls(merged_keys, columns, *(arr[:0] for arr in (count, mean, m2, minimum, maximum)))
+        starts = offsets[:-1]
+        count, mean, m2, minimum, maximum = (arr[order] for arr in (count, mean, m2, minimum, maximum))
+        mean = np.where(count > 0, mean, 0.0)
+
+        total = np.add.reduceat(count, starts, axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            merged_mean = np.add.reduceat(count * mean, starts, axis=0) / total
+        delta = mean - np.repeat(np.nan_to_num(merged_mean), np.diff(offsets), axis=0)
+        merged_m2 = np.add.reduceat(m2 + count * delta * delta, starts, axis=0)
+        return cls(merged_keys, columns, total, merged_mean, merged_m2,
+                   np.fmin.reduceat(minimum, starts, axis=0), np.fmax.reduceat(maximum, starts, axis=0))
+
+    def merge(self, other: "MomentAccumulator") -> "MomentAccumulator":
+        return MomentAccumulator.combine([self, other])
+
+    def finalize(self, customer_col: str) -> pd.DataFrame:
+        """Customer features: {col}_count, _mean, _std (population), _min, _max."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            std = np.sqrt(self.m2 / self.count)
+        out = {customer_col: self.keys}
+        for j, c in enumerate(self.columns):
+            out[f"{c}_count"] = self.count[:, j]
+            out[f"{c}_mean"] = self.mean[:, j]
+            out[f"{c}_std"] = std[:, j]
+            out[f"{c}_min"] = self.min[:, j]
+            out[f"{c}_max"] = self.max[:, j]
+        return pd.DataFrame(out)
+
+
+QUANTILE_SKETCH_SIZE = 16
+QUANTILE_FEATURES = {"p25": 0.25, "median": 0.5, "p75": 0.75}
+
+
+# Max elements of one padded (columns, segments, length) block in QuantileSummary
+PAD_BLOCK_ELEMENTS = 1 << 24
+
+
+def _sketch_ranks(count: np.ndarray, size: int) -> np.ndarray:
+    """
+    Rank (0-based, within the sorted values) of each sketch point: every value
+    while count <= size, else the values at cumulative weight (j + 0.5) * count / size.
+    """
+    j = np.arange(size)
+    compact = np.ceil((j + 0.5) * count[..., None] / size) - 1
+    return np.where(count[..., None] <= size, j, compact).astype(np.int64)
+
+
+def _padded_blocks(starts: np.ndarray, lengths: np.ndarray, n_columns: int,
+                   max_elements: int = PAD_BLOCK_ELEMENTS):
+    """
+    Splits segments (rows [starts[i], starts[i] + lengths[i])) into blocks to be
+    padded to a common length: segments of similar length (within 2x) go together
+    and a block holds at most `max_elements` padded values, so one long segment
+    cannot inflate the rest.
+
+    Yields:
+        (segments, rows, local, pos, length): segment indices of the block, their
+        rows, and each row's (segment within block, position) in the padded array.
+    """
+    width = np.ceil(np.log2(np.maximum(lengths, 1))).astype(np.int64)
+    for w in np.unique(width):
+        group = np.flatnonzero(width == w)
+        length = max(int(lengths[group].max()), 1)
+        step = max(1, max_elements // (length * max(n_columns, 1)))
+        for s in range(0, len(group), step):
+            segments = group[s:s + step]
+            seg_lengths = lengths[segments]
+            local = np.repeat(np.arange(len(segments)), seg_lengths)
+            pos = np.arange(len(local)) - np.repeat(np.cumsum(seg_lengths) - seg_lengths, seg_lengths)
+            rows = starts[segments][local] + pos
+            yield segments, rows, local, pos, length
+
+
+class QuantileSummary:
+    """
+    Mergeable per-(key, column) quantile sketch with at most `size` points.
+
+    While a customer has at most `size` non-null values the points are the sorted
+    values themselves and quantiles are exact; beyond that the points are the
+    values at evenly spaced ranks, each standing for count / size values. Merging
+    re-picks `size` points from the weighted union, so the state never grows.
+
+    State per key and column: count (float64) and `size` float32 points (NaN
+    padded), i.e. 4 * size + 8 bytes. Segments are sorted as NaN-padded blocks
+    (one vectorized sort per block instead of one per column).
+    """
+
+    def __init__(self, keys: np.ndarray, columns: List[str], count: np.ndarray, points: np.ndarray):
+        self.keys = np.asarray(keys)
+        self.columns = list(columns)
+        self.count = count     # (n_keys, n_columns)
+        self.points = points   # (n_keys, n_columns, size), ascending, NaN padded
+
+    @property
+    def size(self) -> int:
+        return self.points.shape[2]
+
+    @classmethod
+    def from_values(cls, keys: np.ndarray, columns: List[str], values: np.ndarray, offsets: np.ndarray,
+                    size: int = QUANTILE_SKETCH_SIZE) -> "QuantileSummary":
+        """Sketches of the segments of `values` (sorted_matrix layout, segment j -> keys[j])."""
+        n_segments, n_columns = len(offsets) - 1, len(columns)
+        count = np.zeros((n_segments, n_columns))
+        points = np.full((n_segments, n_columns, size), np.nan, dtype=np.float32)
+        for segments, rows, local, pos, length in _padded_blocks(offsets[:-1], np.diff(offsets), n_columns):
+            padded = np.full((n_columns, len(segments), length), np.nan)
+            for j in range(n_columns):
+                padded[j, local, pos] = values[rows, j]
+            padded.sort(axis=2)  # NaN last
+            n = (~np.isnan(padded)).sum(axis=2)
+            ranks = _sketch_ranks(n, size)
+            gathered = np.take_along_axis(padded, np.minimum(ranks, length - 1), axis=2)
+            gathered[ranks >= n[..., None]] = np.nan
+            points[segments] = gathered.transpose(1, 0, 2)
+            count[segments] = n.T
+        return cls(keys, columns, count, points)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, customer_col: str) -> "QuantileSummary":
+        """From a frame written by to_frame (one row per key and column)."""
+        size = sum(1 for c in df.columns if c.startswith("s") and c[1:].isdigit())
+        key_codes, keys = pd.factorize(df[customer_col].to_numpy(), sort=True)
+        col_codes, columns = pd.factorize(df["column"].astype(str).to_numpy())
+        count = np.zeros((len(keys), len(columns)))
+        points = np.full((len(keys), len(columns), size), np.nan, dtype=np.float32)
+        count[key_codes, col_codes] = df["n"].to_numpy(dtype=np.float64)
+        for i in range(size):
+            points[key_codes, col_codes, i] = df[f"s{i}"].to_numpy(dtype=np.float32)
+        return cls(np.asarray(keys), list(columns), count, points)
+
+    def to_frame(self, customer_col: str) -> pd.DataFrame:
+        """
+        Partial layout, one row per key and column: customer_col, column, n and the
+        points s0 .. s{size-1}. A few wide columns write far faster than
+        n_columns * size narrow ones.
+        """
+        n_keys, n_columns = self.count.shape
+        out = {
+            customer_col: np.repeat(self.keys, n_columns),
+            "column": pd.Categorical.from_codes(np.tile(np.arange(n_columns), n_keys), self.columns),
+            "n": self.count.ravel(),
+        }
+        for i in range(self.size):
+            out[f"s{i}"] = self.points[:, :, i].ravel()
+        return pd.DataFrame(out)
+
+    @classmethod
+    def combine(cls, sketches: Iterable["QuantileSummary"]) -> "QuantileSummary":
+        """
+        Merges any number of sketches (same columns and size) in one vectorized
+        pass: the points of each key are sorted with their weights and `size`
+        points are picked at the target cumulative weights.
+        """
+        sketches = list(sketches)
+        columns, size = sketches[0].columns, sketches[0].size
+        if any(sk.columns != columns or sk.size != size for sk in sketches):
+            raise ValueError("Quantile sketches must share columns and size to be merged")
+
+        keys = np.concatenate([sk.keys for sk in sketches])
+        order, merged_keys, offsets = sort_segments(keys)
+        count = np.concatenate([sk.count for sk in sketches])[order]
+        points = np.concatenate([sk.points for sk in sketches])[order]
+        n_columns, n_segments = len(columns), len(merged_keys)
+        merged_count = np.zeros((n_segments, n_columns))
+        merged_points = np.full((n_segments, n_columns, size), np.nan, dtype=np.float32)
+
+        # keys held by a single sketch are already merged
+        n_sketches = np.diff(offsets)
+        single = np.flatnonzero(n_sketches == 1)
+        merged_count[single] = count[offsets[single]]
+        merged_points[single] = points[offsets[single]]
+        multi = np.flatnonzero(n_sketches > 1)
+        if len(multi) == 0:
+            return cls(merged_keys, columns, merged_count, merged_points)
+
+        # every point stands for count / n_points values; padding weighs nothing
+        weight = count / np.maximum(np.minimum(count, size), 1)
+        weight = np.where(np.isnan(points), 0.0, weight[..., None])
+        # one row per point: (n_rows * size, n_columns), segments scaled accordingly
+        values = points.transpose(0, 2, 1).reshape(-1, n_columns)
+        weight = weight.transpose(0, 2, 1).reshape(-1, n_columns)
+        point_offsets = offsets * size
+
+        target_rank = np.arange(size) + 0.5
+        for block, rows, local, pos, length in _padded_blocks(point_offsets[multi], n_sketches[multi] * size,
+                                                              n_columns):
+            segments = multi[block]
+            padded = np.full((n_columns, len(segments), length), np.nan)
+            padded_weight = np.zeros_like(padded)
+            for j in range(n_columns):
+                padded[j, local, pos] = values[rows, j]
+                padded_weight[j, local, pos] = weight[rows, j]
+            srt = np.argsort(padded, axis=2)  # NaN last
+            padded = np.take_along_axis(padded, srt, axis=2)
+            cum = np.cumsum(np.take_along_axis(padded_weight, srt, axis=2), axis=2)
+            total = cum[..., -1]
+
+            # target cumulative weight of point i; mirrors _sketch_ranks
+            target = np.where(total[..., None] <= size, target_rank, target_rank * total[..., None] / size)
+            # one searchsorted over all rows: shift each row by the totals before it
+            base = np.concatenate([[0.0], np.cumsum(total.ravel())[:-1]]).reshape(total.shape)
+            flat = (cum + base[..., None]).ravel()
+            idx = np.searchsorted(flat, (target + base[..., None]).ravel(), side="left").reshape(target.shape)
+            row_start = np.arange(total.size).reshape(total.shape)[..., None] * length
+            idx = np.clip(idx - row_start, 0, length - 1)
+
+            gathered = np.take_along_axis(padded, idx, axis=2)
+            gathered[np.arange(size) >= np.minimum(total, size)[..., None]] = np.nan
+            merged_points[segments] = gathered.transpose(1, 0, 2)
+            merged_count[segments] = total.T
+        return cls(merged_keys, columns, merged_count, merged_points)
+
+    def quantile(self, q: float) -> np.ndarray:
+        """(n_keys, n_columns) quantile q with linear interpolation between points (NaN if empty)."""
+        m = np.minimum(self.count, self.size)
+        pos = q * np.maximum(m - 1, 0)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.minimum(lo + 1, np.maximum(m - 1, 0).astype(np.int64))
+        points = self.points.astype(np.float64)
+        lo_val = np.take_along_axis(points, lo[..., None], axis=2)[..., 0]
+        hi_val = np.take_along_axis(points, hi[..., None], axis=2)[..., 0]
+        out = lo_val + (hi_val - lo_val) * (pos - lo)
+        return np.where(m > 0, out, np.nan)
+
+    def finalize(self, customer_col: str, quantiles: Dict[str, float] = QUANTILE_FEATURES) -> pd.DataFrame:
+        """Customer features: {col}_{name} for every name -> q in `quantiles`."""
+        out = {customer_col: self.keys}
+        values = {name: self.quantile(q) for name, q in quantiles.items()}
+        for j, c in enumerate(self.columns):
+            for name in quantiles:
+                out[f"{c}_{name}"] = values[name][:, j]
+        return pd.DataFrame(out)
+
+
+def segment_value_counts(values: np.ndarray, offsets: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Counts of every distinct non-null value per segment.
+
+    Args:
+        values: 1-D values already in segment order.
+        offsets: Segment boundaries (length n_segments + 1).
+
+    Returns:
+        (counts, uniques): int64 (n_segments, n_uniques) counts and the sorted
+        distinct values they refer to. Counts from different parts/batches merge by
+        addition once aligned on the same values.
+    """
+    codes, uniques = pd.factorize(values, sort=True)
+    n_segments, n_uniques = len(offsets) - 1, len(uniques)
+    segment = np.repeat(np.arange(n_segments), np.diff(offsets))
+    valid = codes >= 0
+    counts = np.bincount(segment[valid] * n_uniques + codes[valid], minlength=n_segments * n_uniques)
+    return counts.reshape(n_segments, n_uniques).astype(np.int64), np.asarray(uniques)
+
+
+def count_features(counts: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    Mode/nunique/share features from a (n_customers, n_values) count matrix whose
+    columns are in ascending value order.
+
+    Returns:
+        "mode": column index of the most frequent value (ties -> smallest value,
+        like Series.mode().iloc[0]), -1 where the customer has no values;
+        "nunique": distinct values seen; "share": counts / row total (NaN if empty).
+    """
+    total = counts.sum(axis=1)
+    if counts.shape[1] == 0:
+        mode = np.full(len(counts), -1)
+    else:
+        mode = np.where(total > 0, counts.argmax(axis=1), -1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        share = counts / total[:, None]
+    return {"mode": mode, "nunique": (counts > 0).sum(axis=1), "share": share}
+
+
+# Temporal features over time-sorted segments, in output column order
+TEMPORAL_FEATURES = ("last", "first", "delta", "slope", "diff1", "ewm")
+
+
+def temporal_features(values: np.ndarray, offsets: np.ndarray, features=TEMPORAL_FEATURES,
+                      alpha: float = 0.5) -> Dict[str, np.ndarray]:
+    """
+    Sequence features of every column per segment; rows must be sorted by time
+    within each segment (sort_segments with `times`).
+
+    - last / first: last / first non-null value
+    - delta: last - first
+    - slope: least-squares slope of the value against the statement position
+      (0, 1, ...) within the segment, over non-null rows
+    - diff1: lag-1 difference of the last two statements (NaN if either is null)
+    - ewm: exponentially weighted mean at the last statement, weight (1 - alpha)^k
+      for the statement k positions before the last (pandas ewm(alpha, adjust=True))
+
+    Returns:
+        Dict of (n_segments, n_cols) float64 arrays for the requested features.
+    """
+    unknown = set(features) - set(TEMPORAL_FEATURES)
+    if unknown:
+        raise ValueError(f"Unknown temporal features {sorted(unknown)}; expected {TEMPORAL_FEATURES}")
+
+    values = np.asfortranarray(values, dtype=np.float64)
+    if values.ndim == 1:
+        values = values[:, None]
+    starts = offsets[:-1]
+    lengths = np.diff(offsets)
+    n_segments, n_cols = len(starts), values.shape[1]
+    out = {f: np.full((n_segments, n_cols), np.nan, order="F") for f in features}
+    if n_segments == 0:
+        return out
+    if (lengths == 0).any():
+        raise ValueError("temporal_features() does not support empty segments")
+
+    n_rows = len(values)
+    rows = np.arange(n_rows)
+    position = rows - np.repeat(starts, lengths)                     # 0.. within segment
+    from_end = np.repeat(offsets[1:] - 1, lengths) - rows             # ..0 within segment
+    weights = (1.0 - alpha) ** from_end
+    has_prev = lengths > 1
+    last_rows, prev_rows = offsets[1:] - 1, np.maximum(offsets[1:] - 2, starts)
+    need_last_first = {"last", "first", "delta"} & set(features)
+
+    for j in range(n_cols):
+        x = values[:, j]
+        valid = ~np.isnan(x)
+        filled = np.where(valid, x, 0.0)
+
+        if need_last_first:
+            # rows of the last / first non-null value (-1 / n_rows when the segment has none)
+            last_idx = np.maximum.reduceat(np.where(valid, rows, -1), starts)
+            first_idx = np.minimum.reduceat(np.where(valid, rows, n_rows), starts)
+            last = np.where(last_idx >= 0, x[np.clip(last_idx, 0, n_rows - 1)], np.nan)
+            first = np.where(first_idx < n_rows, x[np.clip(first_idx, 0, n_rows - 1)], np.nan)
+            if "last" in out:
+                out["last"][:, j] = last
+            if "first" in out:
+                out["first"][:, j] = first
+            if "delta" in out:
+                out["delta"][:, j] = last - first
+
+        if "slope" in out:
+            n = np.add.reduceat(valid, starts, dtype=np.int64)
+            t = np.where(valid, position, 0.0)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                t_mean = np.add.reduceat(t, starts) / n
+                x_mean = np.add.reduceat(filled, starts) / n
+            dt = np.where(valid, position - np.repeat(t_mean, lengths), 0.0)
+            dx = np.where(valid, x - np.repeat(x_mean, lengths), 0.0)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                out["slope"][:, j] = np.add.reduceat(dt * dx, starts) / np.add.reduceat(dt * dt, starts)
+
+        if "diff1" in out:
+            out["diff1"][:, j] = np.where(has_prev, x[last_rows] - x[prev_rows], np.nan)
+
+        if "ewm" in out:
+            w = np.where(valid, weights, 0.0)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                out["ewm"][:, j] = np.add.reduceat(w * filled, starts) / np.add.reduceat(w, starts)
+
+    return out
+
+
+def segment_tail(offsets: np.ndarray, k: int = 1) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    The last k rows of every segment, from a boundary mask over the sorted rows
+    (lag = distance to the segment end; a row is kept when lag < k).
+
+    Returns:
+        (rows, segment, lag): sorted-order row positions, their segment index and
+        lag (0 = last row), in row order.
+    """
+    lengths = np.diff(offsets)
+    segment = np.repeat(np.arange(len(lengths)), lengths)
+    lag = offsets[1:][segment] - 1 - np.arange(offsets[0], offsets[-1])
+    keep = lag < k
+    return np.flatnonzero(keep) + offsets[0], segment[keep], lag[keep]
+
+
+def lag_name(col: str, lag: int, time_col: str = "S_2") -> str:
+    """Column name of `col` at `lag` statements before the last; the last date keeps its name."""
+    return col if col == time_col and lag == 0 else f"{col}_lag{lag}"
+
+
+def tail_frame(df: pd.DataFrame, offsets: np.ndarray, segment_keys: np.ndarray, columns: List[str],
+               k: int = 1, customer_col: str = "customer_key", time_col: str = "S_2") -> pd.DataFrame:
+    """
+    One row per segment with `columns` at the last k rows of the segment:
+    {col}_lag0 (last statement) .. {col}_lag{k-1}, lag-major. `df` rows must be
+    in segment order; segments shorter than k get missing values.
+    """
+    rows, segment, lag = segment_tail(offsets, k)
+    out = {customer_col: segment_keys}
+    for i in range(k):
+        at_lag = lag == i
+        index = pd.Index(segment[at_lag])
+        for c in columns:
+            values = df[c].iloc[rows[at_lag]].set_axis(index)
+            out[lag_name(c, i, time_col)] = values.reindex(pd.RangeIndex(len(segment_keys))).to_numpy()
+    return pd.DataFrame(out)
+
@@ -0,0 +1,172 @@
+"""
+AmEx Default Prediction - Feature Matrix Cache.
+
+Materializes a model matrix once as memory-mapped .npy files, so every trainer
+(and generate_submission.py) opens it without rereading and re-merging the
+Parquet inputs:
+
+    <cache_dir>/<key>/X.npy           float32, rows x features
+    <cache_dir>/<key>/keys.npy        customer key per row
+    <cache_dir>/<key>/time.npy        statement date per row (NaT if unknown)
+    <cache_dir>/<key>/y.npy           target per row (training matrices only)
+    <cache_dir>/<key>/manifest.json   feature names, shape, inputs
+
+`key` (feature_cache_key) hashes the input files (path, size, mtime), the
+feature list and the build options, so changed inputs get a new entry instead
+of a stale matrix. Entries are written to a temporary directory and renamed
+into place, so a crashed build never leaves a partial entry behind.
+
+Usage:
+    from src.feature_cache import feature_cache_key, open_feature_cache, write_feature_cache
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+from src.preprocessing import CUSTOMER_KEY_COL
+
+
+MANIFEST_FILE = "manifest.json"
+WRITE_CHUNK_ROWS = 100_000
+
+
+def feature_cache_key(input_paths: List[str], features: Optional[List[str]] = None,
+                      options: Optional[dict] = None) -> str:
+    """Short hash of the input files (path, size, mtime), the feature list and the options."""
+    digest = hashlib.sha1()
+    for path in input_paths:
+        path = os.path.abspath(path)
+        if os.path.exists(path):
+            st = os.stat(path)
+            digest.update(f"{path}|{st.st_size}|{st.st_mtime_ns}\n".encode())
+        else:
+            digest.update(f"{path}|missing\n".encode())
+    digest.update(json.dumps({"features": features, "options": options}, sort_keys=True, default=str).encode())
+    return digest.hexdigest()[:16]
+
+
+class FeatureMatrix:
+    """
+    A cache entry opened read-only: X, keys, time and y (None for test matrices)
+    are memory-mapped arrays, row-aligned; `features` names the columns of X.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, MANIFEST_FILE), 'r') as f:
+            self.manifest = json.load(f)
+        self.features = self.manifest["features"]
+        self.X = np.load(os.path.join(path, "X.npy"), mmap_mode='r')
+        self.keys = np.load(os.path.join(path, "keys.npy"), mmap_mode='r')
+        self.time = np.load(os.path.join(path, "time.npy"), mmap_mode='r')
+        y_path = os.path.join(path, "y.npy")
+        self.y = np.load(y_path, mmap_mode='r') if os.path.exists(y_path) else None
+
+    def __len__(self) -> int:
+        return self.X.shape[0]
+
+
+def open_feature_cache(path: str) -> Optional[FeatureMatrix]:
+    """Opens the cache entry at `path`, or returns None if it was never (completely) written."""
+    if not os.path.exists(os.path.join(path, MANIFEST_FILE)):
+        return None
+    return FeatureMatrix(path)
+
+
+class FeatureCacheWriter:
+    """
+    Writes a cache entry of `n_rows` rows chunk by chunk (e.g. while merging the
+    test set in chunks), so the full matrix never has to fit in memory:
+
+        with FeatureCacheWriter(path, features, n_rows) as writer:
+            for chunk in chunks:
+                writer.append(chunk)
+
+    The entry is published when the block exits without an error.
+    """
+
+    def __init__(self, path: str, features: List[str], n_rows: int, customer_col: str = CUSTOMER_KEY_COL,
+                 time_col: Optional[str] = "S_2", target_col: Optional[str] = None,
+                 inputs: Optional[List[str]] = None):
+        self.path = os.path.normpath(path)
+        self.tmp_path = f"{self.path}.tmp{os.getpid()}"
+        self.features = list(features)
+        self.n_rows = n_rows
+        self.customer_col = customer_col
+        self.time_col = time_col
+        self.target_col = target_col
+        self.inputs = [str(p) for p in inputs or []]
+        self.rows_written = 0
+
+    def __enter__(self) -> "FeatureCacheWriter":
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+
+        def _array(name, dtype, shape):
+            return np.lib.format.open_memmap(os.path.join(self.tmp_path, name), mode='w+', dtype=dtype, shape=shape)
+
+        self.X = _array("X.npy", np.float32, (self.n_rows, len(self.features)))
+        self.keys = _array("keys.npy", np.int64, (self.n_rows,))
+        self.time = _array("time.npy", "datetime64[ns]", (self.n_rows,))
+        self.y = _array("y.npy", np.float32, (self.n_rows,)) if self.target_col else None
+        return self
+
+    def append(self, df: pd.DataFrame) -> None:
+        """Appends the rows of `df`; feature columns missing from `df` are written as NaN."""
+        if self.rows_written + len(df) > self.n_rows:
+            raise ValueError(f"Cache entry holds {self.n_rows:,} rows; got {self.rows_written + len(df):,}")
+        for start in range(0, len(df), WRITE_CHUNK_ROWS):
+            chunk = df.iloc[start:start + WRITE_CHUNK_ROWS]
+            rows = slice(self.rows_written, self.rows_written + len(chunk))
+            self.X[rows] = chunk.reindex(columns=self.features).to_numpy(dtype=np.float32, na_value=np.nan)
+            self.keys[rows] = chunk[self.customer_col].to_numpy()
+            if self.time_col in chunk.columns:
+                self.time[rows] = pd.to_datetime(chunk[self.time_col], errors="coerce").to_numpy(dtype="datetime64[ns]")
+            else:
+                self.time[rows] = np.datetime64("NaT")
+            if self.y is not None:
+                self.y[rows] = chunk[self.target_col].to_numpy(dtype=np.float32, na_value=np.nan)
+            self.rows_written = rows.stop
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        arrays = [self.X, self.keys, self.time] + ([self.y] if self.y is not None else [])
+        for array in arrays:
+            array.flush()
+        del self.X, self.keys, self.time, self.y
+        if exc_type is not None:
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
+            return
+        if self.rows_written != self.n_rows:
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
+            raise ValueError(f"Cache entry expects {self.n_rows:,} rows; {self.rows_written:,} were written")
+
+        manifest = {"features": self.features, "n_rows": self.n_rows, "customer_col": self.customer_col,
+                    "time_col": self.time_col, "target_col": self.target_col, "inputs": self.inputs}
+        with open(os.path.join(self.tmp_path, MANIFEST_FILE), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+        # Another process may have published the same key meanwhile; keep theirs
+        try:
+            os.replace(self.tmp_path, self.path)
+        except OSError:
+            if not os.path.exists(os.path.join(self.path, MANIFEST_FILE)):
+                raise
+            shutil.rmtree(self.tmp_path)
+        print(f"Feature cache saved to {self.path} ({self.n_rows:,} rows x {len(self.features):,} features)")
+
+
+def write_feature_cache(path: str, df: pd.DataFrame, features: List[str], customer_col: str = CUSTOMER_KEY_COL,
+                        time_col: Optional[str] = "S_2", target_col: Optional[str] = None,
+                        inputs: Optional[List[str]] = None) -> FeatureMatrix:
+    """Writes `df[features]` (plus keys, time and target) as a cache entry and opens it."""
+    with FeatureCacheWriter(path, features, len(df), customer_col=customer_col, time_col=time_col,
+                            target_col=target_col, inputs=inputs) as writer:
+        writer.append(df)
+    return open_feature_cache(path)
@@ -0,0 +1,68 @@
+"""
+AmEx Default Prediction - GBDT Model Parameters.
+
+Hyperparameters shared by the single-model trainers (scripts/train_<model>.py)
+and the K-fold driver (scripts/train_kfold.py), so tuning one model changes
+both.
+
+Usage:
+    from src.gbdt_params import LGB_PARAMS, NUM_BOOST_ROUNDS
+"""
+
+# Boosting rounds of the single-model trainers; the K-fold driver's early-stopping cap
+NUM_BOOST_ROUNDS = 1200
+
+LGB_PARAMS = {
+    "objective": "binary",
+    "metric": "binary_logloss",
+    "learning_rate": 0.02,
+    "num_leaves": 96,
+    "max_depth": -1,
+    "feature_fraction": 0.8,
+    "bagging_fraction": 0.8,
+    "bagging_freq": 3,
+    "lambda_l2": 2.0,
+    "verbosity": -1,
+}
+
+# Dataset (binning) parameters; the binary Dataset cache is keyed by them
+LGB_DATASET_PARAMS = {
+    "max_bin": 255,
+    "bin_construct_sample_cnt": 200_000,
+    "verbosity": -1,
+}
+
+XGB_PARAMS = {
+    "objective": "binary:logistic",
+    "eval_metric": "logloss",
+    "learning_rate": 0.02,
+    "max_depth": 6,
+    "min_child_weight": 1,
+    "subsample": 0.8,
+    "colsample_bytree": 0.8,
+    "lambda": 2.0,
+    "alpha": 0.1,
+    "tree_method": "hist",
+    "verbosity": 0,
+}
+
+# CatBoostClassifier keyword arguments (besides iterations/verbose)
+CATBOOST_PARAMS = {
+    "learning_rate": 0.02,
+    "depth": 6,
+    "l2_leaf_reg": 2.0,
+    "loss_function": "Logloss",
+    "eval_metric": "Logloss",
+    "random_seed": 42,
+    "task_type": "CPU",
+}
+
+# HistGradientBoostingClassifier keyword arguments (besides max_iter/verbose)
+HISTGB_PARAMS = {
+    "learning_rate": 0.02,
+    "max_depth": 6,
+    "min_samples_leaf": 20,
+    "l2_regularization": 2.0,
+    "max_bins": 255,
+    "random_state": 42,
+}
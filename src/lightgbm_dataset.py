@@ -0,0 +1,64 @@
+"""
+AmEx Default Prediction - LightGBM Dataset from the Feature Cache.
+
+Builds the binned lgb.Dataset of a cached training matrix (src/feature_cache.py)
+batch by batch through lgb.Sequence, so the float64 copy LightGBM needs never
+exists for the whole matrix, and saves it next to the matrix (save_binary):
+later runs on the same inputs and binning parameters load it instead of binning.
+
+Usage:
+    from src.lightgbm_dataset import binned_dataset
+"""
+
+import os
+
+import lightgbm as lgb
+import numpy as np
+
+from src.feature_cache import FeatureMatrix, feature_cache_key
+from src.gbdt_params import LGB_DATASET_PARAMS
+
+
+SEQUENCE_BATCH_ROWS = 20_000
+
+
+class MatrixSequence(lgb.Sequence):
+    """
+    Rows of the memory-mapped feature matrix for lgb.Dataset: LightGBM samples
+    rows for the bin edges and then reads the matrix `batch_size` rows at a
+    time, so only one float64 batch of the training set is in memory at once.
+    """
+
+    def __init__(self, X: np.ndarray, batch_size: int = SEQUENCE_BATCH_ROWS):
+        self.X = X
+        self.batch_size = batch_size
+
+    def __getitem__(self, idx):
+        # LightGBM's sequence interface takes float64 rows
+        return np.asarray(self.X[idx], dtype=np.float64)
+
+    def __len__(self) -> int:
+        return len(self.X)
+
+
+def binned_dataset(train_matrix: FeatureMatrix, params: dict = LGB_DATASET_PARAMS,
+                   batch_rows: int = SEQUENCE_BATCH_ROWS) -> lgb.Dataset:
+    """
+    Constructed Dataset of `train_matrix` (features, labels), loaded from its
+    binary file inside the cache entry, or binned in batches and saved there.
+    Subsets (e.g. folds) of it reuse the bins without touching the raw matrix.
+    """
+    # Saved inside the training matrix entry, i.e. keyed by the inputs too
+    binary_path = os.path.join(train_matrix.path, f"lightgbm_{feature_cache_key([], options=params)}.bin")
+    if os.path.exists(binary_path):
+        print(f"Loading binned Dataset: {binary_path}")
+        return lgb.Dataset(binary_path, params=params).construct()
+
+    print(f"Binning Dataset in batches of {batch_rows:,} rows...")
+    dataset = lgb.Dataset(MatrixSequence(train_matrix.X, batch_rows), label=train_matrix.y,
+                          feature_name=train_matrix.features, params=params).construct()
+    tmp_path = f"{binary_path}.tmp{os.getpid()}"
+    dataset.save_binary(tmp_path)
+    os.replace(tmp_path, binary_path)
+    print(f"Binned Dataset saved to {binary_path}")
+    return dataset
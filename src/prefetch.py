@@ -0,0 +1,101 @@
+"""
+AmEx Default Prediction - Prefetching Parquet Reader.
+
+Reads Parquet files on a background I/O thread while the caller processes the
+previous one, so disk/network reads and decoding overlap with computation
+(pyarrow releases the GIL while reading and decoding):
+
+    for path, df in prefetch_parquet(paths, columns=[...]):
+        process(df)              # file i + 1 is being read meanwhile
+
+At most `depth` decoded files wait in the queue, plus one being read and one
+being processed, which bounds the extra memory to `depth + 1` parts.
+
+Usage:
+    from src.prefetch import prefetch_parquet
+"""
+
+import queue
+import threading
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+
+DEFAULT_PREFETCH_DEPTH = 2
+_DONE = object()
+
+
+def read_present_columns(path: str, columns: Optional[Sequence[str]] = None) -> pd.DataFrame:
+    """Reads `path`, restricted to those of `columns` the file has (None = all columns)."""
+    if columns is None:
+        return pd.read_parquet(path)
+    available = set(pq.read_schema(path).names)
+    return pd.read_parquet(path, columns=[c for c in dict.fromkeys(columns) if c in available])
+
+
+def prefetch_parquet(paths: List[str], columns: Optional[Sequence[str]] = None,
+                     depth: int = DEFAULT_PREFETCH_DEPTH,
+                     return_errors: bool = False) -> Iterator[Tuple[str, pd.DataFrame]]:
+    """
+    Yields (path, DataFrame) for every path in order, reading ahead on one
+    background thread.
+
+    Args:
+        paths: Parquet files, yielded in this order.
+        columns: Columns to read; columns missing from a file are skipped (None = all).
+        depth: Max files read ahead (queue size); 0 reads synchronously.
+        return_errors: If True, a file that fails to read is yielded as
+            (path, exception) and reading continues; otherwise the error is raised
+            at that file's position.
+    """
+    if depth <= 0:
+        for path in paths:
+            try:
+                df = read_present_columns(path, columns)
+            except Exception as exc:
+                if not return_errors:
+                    raise
+                df = exc
+            yield path, df
+        return
+
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def _put(item) -> bool:
+        # Blocks while the queue is full, but gives up once the consumer has stopped
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _reader():
+        for path in paths:
+            try:
+                item = (path, read_present_columns(path, columns))
+            except Exception as exc:
+                item = (path, exc)
+            if not _put(item):
+                return
+        _put(_DONE)
+
+    thread = threading.Thread(target=_reader, name="parquet-prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is _DONE:
+                break
+            path, df = item
+            if isinstance(df, Exception) and not return_errors:
+                raise df
+            yield path, df
+    finally:
+        # Consumer finished or stopped early: release the reader thread
+        stop.set()
+        thread.join()
@@ -12,15 +12,26 @@ Usage:
     from src.preprocessing import preprocess_and_save_parquet, build_category_map
 """
 
+import hashlib
+import io
 import json
+import math
 import os
 import sys
-from typing import List, Dict, Optional, Any
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import List, Dict, Optional, Any, Tuple, Union, Iterable, Iterator
 
 import humanize
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+import scipy.sparse as sp
 
+from src.prefetch import prefetch_parquet
 
 # =============================================================================
 # CONSTANTS & CONFIGURATION
@@ -32,6 +43,11 @@ SENTINEL_FLOAT = -999.0
 SENTINEL_INT = -1
 SENTINEL_STRING = "MISSING"
 
+# Customer identifiers: the raw 64-char hex ID and the dense int32 key that
+# replaces it from preprocessing onwards (see `build_customer_index`)
+CUSTOMER_ID_COL = "customer_ID"
+CUSTOMER_KEY_COL = "customer_key"
+
 # Column Groups
 BOOL_COLS: List[str] = ['B_31']
 
@@ -86,6 +102,15 @@ LINEAR_EXTRA_CATEGORICAL_COLS: List[str] = ["D_63", "D_64"]
 # All categorical columns that should be one-hot encoded for linear models
 LINEAR_CATEGORICAL_COLS: List[str] = CATEGORICAL_COLS + LINEAR_EXTRA_CATEGORICAL_COLS
 
+# Columns imputed with their (global or per-chunk) mode
+MODE_IMPUTED_COLS: List[str] = ['D_63'] + CATEGORICAL_COLS
+
+# CSV reader backends accepted by `preprocess_and_save_parquet`
+CSV_READERS: List[str] = ["pandas", "arrow"]
+
+# Bytes decoded per block by the Arrow streaming CSV reader
+ARROW_BLOCK_SIZE = 64 * 1024 * 1024
+
 # =============================================================================
 # UTILITY FUNCTIONS
 # =============================================================================
@@ -176,7 +201,14 @@ def handle_high_corr_missingness(df: pd.DataFrame, high_corr_cols: List[str]) ->
     return df
 
 
-def preprocess_chunk(chunk: pd.DataFrame) -> pd.DataFrame:
+def _chunk_mode(series: pd.Series) -> Optional[Any]:
+    """Returns the most frequent value of a chunk column, or None if it is all-NaN."""
+    mode_val = series.mode()
+    return None if mode_val.empty else mode_val[0]
+
+
+def preprocess_chunk(chunk: pd.DataFrame, imputation_stats: Optional[Dict[str, Dict[str, Any]]] = None,
+                     customer_index: Optional[pd.Index] = None) -> pd.DataFrame:
     """
     Preprocesses a single chunk of data.
 
@@ -184,15 +216,26 @@ def preprocess_chunk(chunk: pd.DataFrame) -> pd.DataFrame:
     - Boolean conversion.
     - Float16/Float32 conversion and median imputation.
     - String and Datetime conversion.
+    - Customer-ID encoding to `customer_key` (when a customer index is given).
     - Categorical imputation (mode/sentinel).
     - Feature selection (dropping low-correlation columns).
     - High-correlation missingness handling.
 
+    Args:
+        chunk: Raw CSV chunk.
+        imputation_stats: Global medians/modes from `fit_imputation_stats`. Columns
+            without a global statistic fall back to the chunk's own median/mode.
+        customer_index: Index from `load_customer_index`. If given, `customer_ID`
+            is replaced by its int32 `customer_key` (first column).
+
     NOTE:
     - This function does NOT perform one-hot encoding.
     - Linear models should always go through `load_and_prepare_for_linear`
       with a precomputed category map.
     """
+    medians = imputation_stats.get("medians", {}) if imputation_stats else {}
+    modes = imputation_stats.get("modes", {}) if imputation_stats else {}
+
     # Boolean conversions
     for col in BOOL_COLS:
         if col in chunk.columns:
@@ -201,18 +244,27 @@ def preprocess_chunk(chunk: pd.DataFrame) -> pd.DataFrame:
     # Float16 conversions and median imputation
     for col in FLOAT16_COLS:
         if col in chunk.columns:
-            median_val = chunk[col].median()
+            median_val = medians.get(col)
+            if median_val is None:
+                median_val = chunk[col].median()
             chunk[col] = chunk[col].fillna(median_val).astype('float16')
 
     # Float32 conversions and median imputation
     for col in FLOAT32_COLS:
         if col in chunk.columns:
-            median_val = chunk[col].median()
+            median_val = medians.get(col)
+            if median_val is None:
+                median_val = chunk[col].median()
             chunk[col] = chunk[col].fillna(median_val).astype('float32')
 
-    # String conversion
-    if 'customer_ID' in chunk.columns:
-        chunk['customer_ID'] = chunk['customer_ID'].astype('string')
+    # String conversion / customer key encoding
+    if CUSTOMER_ID_COL in chunk.columns:
+        if customer_index is not None:
+            keys = encode_customer_ids(chunk[CUSTOMER_ID_COL], customer_index)
+            chunk = chunk.drop(columns=[CUSTOMER_ID_COL])
+            chunk.insert(0, CUSTOMER_KEY_COL, keys)
+        else:
+            chunk[CUSTOMER_ID_COL] = chunk[CUSTOMER_ID_COL].astype('string')
 
     # Datetime conversion
     if 'S_2' in chunk.columns:
@@ -227,9 +279,13 @@ def preprocess_chunk(chunk: pd.DataFrame) -> pd.DataFrame:
                     chunk[col] = chunk[col].cat.add_categories(SENTINEL_STRING)
                 chunk[col] = chunk[col].fillna(SENTINEL_STRING)
             else:
-                mode_val = chunk[col].mode()
-                if not mode_val.empty:
-                    chunk[col] = chunk[col].fillna(mode_val[0])
+                mode_val = modes.get(col)
+                if mode_val is None:
+                    mode_val = _chunk_mode(chunk[col])
+                if mode_val is not None:
+                    if mode_val not in chunk[col].cat.categories:
+                        chunk[col] = chunk[col].cat.add_categories([mode_val])
+                    chunk[col] = chunk[col].fillna(mode_val)
 
     # Other categorical columns and mode imputation
     for col in CATEGORICAL_COLS:
@@ -237,9 +293,13 @@ def preprocess_chunk(chunk: pd.DataFrame) -> pd.DataFrame:
             if pd.api.types.is_float_dtype(chunk[col].dtype) and chunk[col].dtype == 'float16':
                 chunk[col] = chunk[col].astype('float32')
             chunk[col] = chunk[col].astype('category')
-            mode_val = chunk[col].mode()
-            if not mode_val.empty:
-                chunk[col] = chunk[col].fillna(mode_val[0])
+            mode_val = modes.get(col)
+            if mode_val is None:
+                mode_val = _chunk_mode(chunk[col])
+            if mode_val is not None:
+                if mode_val not in chunk[col].cat.categories:
+                    chunk[col] = chunk[col].cat.add_categories([mode_val])
+                chunk[col] = chunk[col].fillna(mode_val)
 
     # Drop low missing correlation columns
     cols_to_drop = [col for col in LOW_MISSING_CORR_COLS if col in chunk.columns]
@@ -252,34 +312,471 @@ def preprocess_chunk(chunk: pd.DataFrame) -> pd.DataFrame:
     return chunk
 
 
-def preprocess_and_save_parquet(input_csv: str, output_prefix: str, chunksize: int = 100_000) -> List[str]:
+def _chunk_byte_offsets(input_csv: str, chunksize: int, block_size: int = 64 * 1024 * 1024) -> Tuple[bytes, List[int]]:
+    """
+    Scans a CSV once and returns its header line plus the byte offsets at which
+    every `chunksize`-row chunk starts (the last offset is the end of the file).
+
+    Offsets are aligned to newlines, so chunk i covers exactly the same rows as
+    the i-th chunk of `pd.read_csv(..., chunksize=chunksize)`.
+
+    NOTE:
+    - Assumes no quoted fields contain embedded newlines (true for the AmEx CSVs).
+    """
+    file_size = os.path.getsize(input_csv)
+    with open(input_csv, 'rb') as f:
+        header = f.readline()
+        pos = f.tell()
+        offsets = [pos]
+        rows_in_chunk = 0
+
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n'))
+            # Newlines that close the last row of a chunk
+            boundaries = newlines[chunksize - rows_in_chunk - 1::chunksize]
+            offsets.extend((pos + boundaries + 1).tolist())
+            rows_in_chunk = (rows_in_chunk + len(newlines)) % chunksize
+            pos += len(block)
+
+    if offsets[-1] < file_size:
+        offsets.append(file_size)
+    return header, offsets
+
+
+def _arrow_csv_convert_options() -> "pa_csv.ConvertOptions":
+    """
+    Explicit Arrow column types for the raw AmEx CSV, so nothing is parsed as
+    float64/object first and downcast later.
+
+    - FLOAT16/FLOAT32/BOOL columns are read as float32 (`preprocess_chunk` still
+      applies the final float16/bool casts and imputation).
+    - `S_2` is parsed directly as a timestamp.
+    - `customer_ID` is dictionary-encoded (one dictionary entry per customer
+      instead of ~13 repeated 64-char strings).
+    - `D_63`/`D_64` stay plain strings so `preprocess_chunk` builds the same
+      sorted categories as the pandas reader.
+    """
+    column_types = {col: pa.float32() for col in FLOAT16_COLS + FLOAT32_COLS + BOOL_COLS}
+    column_types['S_2'] = pa.timestamp('ns')
+    column_types['customer_ID'] = pa.dictionary(pa.int32(), pa.string())
+    for col in LINEAR_EXTRA_CATEGORICAL_COLS:
+        column_types[col] = pa.string()
+    return pa_csv.ConvertOptions(column_types=column_types, strings_can_be_null=True)
+
+
+def _iter_arrow_csv_chunks(input_csv: str, chunksize: int):
+    """
+    Streams a CSV with pyarrow's multithreaded reader and yields pandas chunks of
+    exactly `chunksize` rows (the last one may be shorter), matching the chunk
+    boundaries of `pd.read_csv(..., chunksize=chunksize)`.
+    """
+    reader = pa_csv.open_csv(
+        input_csv,
+        read_options=pa_csv.ReadOptions(use_threads=True, block_size=ARROW_BLOCK_SIZE),
+        convert_options=_arrow_csv_convert_options(),
+    )
+
+    pending = []
+    pending_rows = 0
+    for batch in reader:
+        pending.append(batch)
+        pending_rows += batch.num_rows
+        while pending_rows >= chunksize:
+            table = pa.Table.from_batches(pending)
+            yield table.slice(0, chunksize).to_pandas()
+            rest = table.slice(chunksize)
+            pending = rest.to_batches()
+            pending_rows = rest.num_rows
+
+    if pending_rows:
+        yield pa.Table.from_batches(pending).to_pandas()
+
+
+def _read_csv_bytes(data: bytes, reader: str) -> pd.DataFrame:
+    """Parses an in-memory CSV (header included) with the selected reader backend."""
+    if reader == "arrow":
+        return pa_csv.read_csv(
+            io.BytesIO(data),
+            read_options=pa_csv.ReadOptions(use_threads=True),
+            convert_options=_arrow_csv_convert_options(),
+        ).to_pandas()
+    return pd.read_csv(io.BytesIO(data))
+
+
+def _read_byte_range(input_csv: str, header: bytes, start: int, end: int, reader: str) -> pd.DataFrame:
+    """Reads and parses the rows stored in bytes [start, end) of the CSV."""
+    with open(input_csv, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return _read_csv_bytes(header + data, reader)
+
+
+def _iter_csv_chunks(input_csv: str, chunksize: int, reader: str):
+    """Serial chunk iterator for the selected reader backend."""
+    if reader not in CSV_READERS:
+        raise ValueError(f"Unknown CSV reader '{reader}'. Expected one of {CSV_READERS}")
+    if reader == "arrow":
+        return _iter_arrow_csv_chunks(input_csv, chunksize)
+    return pd.read_csv(input_csv, chunksize=chunksize)
+
+
+def _preprocess_byte_range(task: Tuple[str, bytes, int, int, str, str, Optional[Dict[str, Dict[str, Any]]],
+                                       Optional[str]]) -> str:
+    """
+    Worker: parses one newline-aligned byte range of the CSV, preprocesses it and
+    writes it to its parquet part. Runs in a separate process.
+    """
+    input_csv, header, start, end, part_path, reader, imputation_stats, customer_index_path = task
+    customer_index = _cached_customer_index(customer_index_path) if customer_index_path else None
+    chunk = _read_byte_range(input_csv, header, start, end, reader)
+    processed = preprocess_chunk(chunk, imputation_stats, customer_index)
+    processed.to_parquet(part_path, index=False)
+    return part_path
+
+
+def preprocess_and_save_parquet(input_csv: str, output_prefix: str, chunksize: int = 100_000,
+                                workers: int = 1, reader: str = "pandas",
+                                imputation_stats: Optional[Dict[str, Dict[str, Any]]] = None,
+                                customer_index_path: Optional[str] = None) -> List[str]:
     """
     Reads a CSV in chunks, processes them, and saves as Parquet files.
 
+    With `workers > 1` the CSV is first split into newline-aligned byte ranges of
+    `chunksize` rows each, and every range is parsed and preprocessed in a worker
+    process. Range i holds the same rows as chunk i of the serial reader and is
+    written to the same `*_part{i}.parquet` file, so both paths produce identical parts.
+
     Args:
         input_csv: Path to input CSV.
         output_prefix: Prefix for output files (e.g., 'data/processed').
         chunksize: Number of rows per chunk.
+        workers: Number of worker processes (1 = serial reader).
+        reader: CSV parser backend. "pandas" lets pandas infer dtypes; "arrow" uses
+            pyarrow's multithreaded CSV reader with an explicit schema
+            (see `_arrow_csv_convert_options`).
+        imputation_stats: Global medians/modes from `fit_imputation_stats`
+            (None = impute each chunk with its own statistics).
+        customer_index_path: Customer index from `build_customer_index`. If given,
+            parts store the int32 `customer_key` instead of `customer_ID` strings.
 
     Returns:
         List of paths to the generated Parquet files.
     """
+    if reader not in CSV_READERS:
+        raise ValueError(f"Unknown CSV reader '{reader}'. Expected one of {CSV_READERS}")
+
     refined_dir = os.path.join(os.path.dirname(output_prefix), "refined_data")
     os.makedirs(refined_dir, exist_ok=True)
 
-    chunks = pd.read_csv(input_csv, chunksize=chunksize)
+    def _part_path(i: int) -> str:
+        filename = f"{os.path.basename(output_prefix)}_part{i}.parquet"
+        return os.path.join(refined_dir, filename)
+
+    if workers > 1:
+        header, offsets = _chunk_byte_offsets(input_csv, chunksize)
+        tasks = [
+            (input_csv, header, start, end, _part_path(i), reader, imputation_stats, customer_index_path)
+            for i, (start, end) in enumerate(zip(offsets[:-1], offsets[1:]))
+        ]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(_preprocess_byte_range, tasks))
+
+    customer_index = load_customer_index(customer_index_path) if customer_index_path else None
+    chunks = _iter_csv_chunks(input_csv, chunksize, reader)
     parquet_parts = []
 
     for i, chunk in enumerate(chunks):
-        processed = preprocess_chunk(chunk)  # Always save raw categories
-        filename = f"{os.path.basename(output_prefix)}_part{i}.parquet"
-        part_path = os.path.join(refined_dir, filename)
+        processed = preprocess_chunk(chunk, imputation_stats, customer_index)  # Always save raw categories
+        part_path = _part_path(i)
         processed.to_parquet(part_path, index=False)
         parquet_parts.append(part_path)
 
     return parquet_parts
 
 
+# =============================================================================
+# CUSTOMER INDEX
+# =============================================================================
+
+def build_customer_index(input_csv: str, output_path: str = "customer_index.parquet",
+                         extend: bool = False) -> pd.Index:
+    """
+    Assigns every customer a dense int32 `customer_key` in one pass over the raw CSV.
+
+    Only the `customer_ID` column is decoded (pyarrow multithreaded reader), and
+    keys follow first-appearance order. The index is saved as a Parquet file with
+    columns (`customer_key`, `customer_ID`), where `customer_key` is the row number.
+
+    With `extend=True` and an existing index at `output_path`, its keys are kept
+    and only IDs it does not contain are appended (e.g. new customers of a later
+    monthly batch), so parts encoded with either version agree on every key the
+    old index has. This is what incremental aggregation (`--update`) relies on.
+
+    Returns:
+        Index of customer IDs; position i holds the ID of customer_key i.
+    """
+    reader = pa_csv.open_csv(
+        input_csv,
+        read_options=pa_csv.ReadOptions(use_threads=True, block_size=ARROW_BLOCK_SIZE),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=[CUSTOMER_ID_COL],
+            column_types={CUSTOMER_ID_COL: pa.string()},
+        ),
+    )
+    # Customers span ~13 consecutive rows, so per-batch uniques are already small
+    batch_uniques = [pc.unique(batch.column(0)) for batch in reader]
+    ids = pc.unique(pa.concat_arrays(batch_uniques)) if batch_uniques else pa.array([], type=pa.string())
+    ids = pc.drop_null(ids)
+
+    n_existing = 0
+    if extend and os.path.exists(output_path):
+        existing = pq.read_table(output_path, columns=[CUSTOMER_ID_COL]).column(CUSTOMER_ID_COL).combine_chunks()
+        n_existing = len(existing)
+        ids = pa.concat_arrays([existing, ids.filter(pc.invert(pc.is_in(ids, value_set=existing)))])
+
+    if len(ids) > np.iinfo(np.int32).max:
+        raise ValueError(f"Too many customers for an int32 key: {len(ids)}")
+
+    table = pa.table({
+        CUSTOMER_KEY_COL: pa.array(np.arange(len(ids), dtype=np.int32)),
+        CUSTOMER_ID_COL: ids,
+    })
+    # Written aside and renamed, so readers never see a half-written index
+    tmp_path = f"{output_path}.tmp{os.getpid()}"
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, output_path)
+
+    if extend:
+        print(f"Customer index extended at {output_path} ({n_existing:,} existing + "
+              f"{len(ids) - n_existing:,} new customers)")
+    else:
+        print(f"Customer index saved to {output_path} ({len(ids):,} customers)")
+    return pd.Index(ids.to_pylist(), dtype='string')
+
+
+def load_customer_index(path: str = "customer_index.parquet") -> pd.Index:
+    """Loads a customer index written by `build_customer_index`."""
+    table = pq.read_table(path, columns=[CUSTOMER_ID_COL])
+    return pd.Index(table.column(CUSTOMER_ID_COL).to_pylist(), dtype='string')
+
+
+def customer_index_fingerprint(customer_index: pd.Index, n: Optional[int] = None) -> str:
+    """
+    sha1 of the first `n` customer IDs (all by default), in key order. An index
+    extended with `build_customer_index(extend=True)` keeps the fingerprint of
+    its first `n` keys, so it identifies which keys data was encoded with.
+    """
+    return hashlib.sha1("\n".join(customer_index[:n]).encode()).hexdigest()
+
+
+@lru_cache(maxsize=2)
+def _cached_customer_index(path: str) -> pd.Index:
+    """Per-process cache so pool workers load the index once, not once per task."""
+    return load_customer_index(path)
+
+
+def encode_customer_ids(ids: pd.Series, customer_index: pd.Index) -> np.ndarray:
+    """
+    Maps customer_ID strings to their int32 keys.
+
+    Raises:
+        KeyError: if any ID is not in the index.
+    """
+    keys = customer_index.get_indexer(ids.astype('string'))
+    if (keys < 0).any():
+        unknown = ids[keys < 0].iloc[:3].tolist()
+        raise KeyError(f"{int((keys < 0).sum())} customer IDs not in the customer index, e.g. {unknown}")
+    return keys.astype(np.int32)
+
+
+def decode_customer_keys(keys: Any, customer_index: pd.Index) -> np.ndarray:
+    """Maps int32 customer keys back to customer_ID strings."""
+    return customer_index.take(np.asarray(keys, dtype=np.int64)).to_numpy()
+
+
+# =============================================================================
+# GLOBAL IMPUTATION STATISTICS
+# =============================================================================
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch with relative-error guarantees (DDSketch-style).
+
+    Values are counted in logarithmic buckets of width `gamma = (1 + a) / (1 - a)`,
+    so any quantile is returned within a relative error `a` of the true value.
+    Sketches built on separate chunks merge exactly by adding bucket counts.
+    """
+
+    # Magnitudes below this are counted in the zero bucket
+    MIN_INDEXABLE = 1e-9
+
+    def __init__(self, relative_accuracy: float = 0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.positive: Dict[int, int] = {}
+        self.negative: Dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def update(self, values: np.ndarray) -> None:
+        values = np.asarray(values, dtype=np.float64)
+        values = values[np.isfinite(values)]
+        self.count += len(values)
+        self.zero_count += int((np.abs(values) < self.MIN_INDEXABLE).sum())
+
+        for store, magnitudes in ((self.positive, values[values >= self.MIN_INDEXABLE]),
+                                  (self.negative, -values[values <= -self.MIN_INDEXABLE])):
+            if len(magnitudes):
+                keys, counts = np.unique(np.ceil(np.log(magnitudes) / self._log_gamma).astype(np.int64),
+                                         return_counts=True)
+                for k, c in zip(keys.tolist(), counts.tolist()):
+                    store[k] = store.get(k, 0) + c
+
+    def merge(self, other: "QuantileSketch") -> None:
+        if other.gamma != self.gamma:
+            raise ValueError("Cannot merge sketches with different relative accuracy")
+        for store, other_store in ((self.positive, other.positive), (self.negative, other.negative)):
+            for k, c in other_store.items():
+                store[k] = store.get(k, 0) + c
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def _bucket_value(self, key: int) -> float:
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Returns the approximate q-quantile, or None for an empty sketch."""
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+
+        cumulative = 0
+        for k in sorted(self.negative, reverse=True):
+            cumulative += self.negative[k]
+            if cumulative > rank:
+                return -self._bucket_value(k)
+        cumulative += self.zero_count
+        if cumulative > rank:
+            return 0.0
+        for k in sorted(self.positive):
+            cumulative += self.positive[k]
+            if cumulative > rank:
+                return self._bucket_value(k)
+        return self._bucket_value(max(self.positive))
+
+
+def _imputation_state(chunk: pd.DataFrame, relative_accuracy: float) -> Dict[str, Dict[str, Any]]:
+    """
+    Mergeable imputation state for one raw chunk: a quantile sketch per numeric
+    column and a value-count histogram per mode-imputed column.
+    """
+    state = {"sketches": {}, "counts": {}}
+    for col in FLOAT16_COLS + FLOAT32_COLS:
+        if col in chunk.columns:
+            sketch = QuantileSketch(relative_accuracy)
+            sketch.update(chunk[col].to_numpy(dtype=np.float64, na_value=np.nan))
+            state["sketches"][col] = sketch
+    for col in MODE_IMPUTED_COLS:
+        if col in chunk.columns:
+            state["counts"][col] = chunk[col].value_counts(dropna=True).to_dict()
+    return state
+
+
+def _merge_imputation_state(total: Dict[str, Dict[str, Any]], state: Dict[str, Dict[str, Any]]) -> None:
+    for col, sketch in state["sketches"].items():
+        if col in total["sketches"]:
+            total["sketches"][col].merge(sketch)
+        else:
+            total["sketches"][col] = sketch
+    for col, counts in state["counts"].items():
+        merged = total["counts"].setdefault(col, {})
+        for value, c in counts.items():
+            merged[value] = merged.get(value, 0) + c
+
+
+def _fit_byte_range(task: Tuple[str, bytes, int, int, str, float]) -> Dict[str, Dict[str, Any]]:
+    """Worker: computes the imputation state of one newline-aligned byte range."""
+    input_csv, header, start, end, reader, relative_accuracy = task
+    return _imputation_state(_read_byte_range(input_csv, header, start, end, reader), relative_accuracy)
+
+
+def fit_imputation_stats(input_csv: str, output_path: str = "imputation_stats.json", chunksize: int = 100_000,
+                         workers: int = 1, reader: str = "pandas",
+                         relative_accuracy: float = 0.01) -> Dict[str, Dict[str, Any]]:
+    """
+    Computes global imputation statistics in a single streaming pass over a raw CSV.
+
+    - Medians of FLOAT16/FLOAT32 columns come from a mergeable `QuantileSketch`
+      (within `relative_accuracy` of the exact median). Low-cardinality
+      `CATEGORICAL_COLS` use their exact (lower) histogram median instead, so an imputed
+      value is always a real category.
+    - Modes of `MODE_IMPUTED_COLS` come from merged value-count histograms
+      (ties resolved to the smallest value, like `Series.mode`).
+
+    The result is saved as JSON and is meant to be passed to
+    `preprocess_and_save_parquet(imputation_stats=...)` for both train and test.
+
+    Returns:
+        {"medians": {col: float}, "modes": {col: value}}
+    """
+    total = {"sketches": {}, "counts": {}}
+
+    if workers > 1:
+        header, offsets = _chunk_byte_offsets(input_csv, chunksize)
+        tasks = [
+            (input_csv, header, start, end, reader, relative_accuracy)
+            for start, end in zip(offsets[:-1], offsets[1:])
+        ]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for state in executor.map(_fit_byte_range, tasks):
+                _merge_imputation_state(total, state)
+    else:
+        for chunk in _iter_csv_chunks(input_csv, chunksize, reader):
+            _merge_imputation_state(total, _imputation_state(chunk, relative_accuracy))
+
+    def _mode(counts: Dict[Any, int]) -> Optional[Any]:
+        if not counts:
+            return None
+        top = max(counts.values())
+        mode_val = min(v for v, c in counts.items() if c == top)
+        return mode_val.item() if isinstance(mode_val, np.generic) else mode_val
+
+    def _histogram_median(counts: Dict[Any, int]) -> Optional[float]:
+        if not counts:
+            return None
+        values = sorted(counts)
+        cumulative = np.cumsum([counts[v] for v in values])
+        n = int(cumulative[-1])
+        # Lower median: averaging the two middle values could fall between categories
+        return float(values[int(np.searchsorted(cumulative, (n - 1) // 2, side='right'))])
+
+    medians = {col: sketch.quantile(0.5) for col, sketch in total["sketches"].items()}
+    for col in CATEGORICAL_COLS:
+        if col in total["counts"]:
+            medians[col] = _histogram_median(total["counts"][col])
+
+    stats = {
+        "medians": medians,
+        "modes": {col: _mode(counts) for col, counts in total["counts"].items()},
+    }
+
+    with open(output_path, 'w') as f:
+        json.dump(stats, f)
+
+    print(f"Imputation stats saved to {output_path}")
+    return stats
+
+
+def load_imputation_stats(path: str = "imputation_stats.json") -> Dict[str, Dict[str, Any]]:
+    """Loads imputation statistics written by `fit_imputation_stats`."""
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
 def build_category_map(parquet_paths: List[str], output_path: str = "category_map.json") -> Dict[str, List[Any]]:
     """
     Scans Parquet files to identify all unique categories for categorical columns.
@@ -314,14 +811,8 @@ def build_category_map(parquet_paths: List[str], output_path: str = "category_ma
 
     full_categories = {col: set() for col in LINEAR_CATEGORICAL_COLS}
 
-    for path in parquet_paths:
-        try:
-            # Fast path: read only expected categorical columns
-            df = pd.read_parquet(path, columns=[c for c in LINEAR_CATEGORICAL_COLS])
-        except Exception:
-            # Fallback: read whole file
-            df = pd.read_parquet(path)
-
+    # Read only the categorical columns each part has; the next part is read in the background
+    for _, df in prefetch_parquet(parquet_paths, columns=LINEAR_CATEGORICAL_COLS):
         present_cat_cols = [c for c in LINEAR_CATEGORICAL_COLS if c in df.columns]
         for col in present_cat_cols:
             # dropna() then iterate unique values
@@ -344,13 +835,82 @@ def build_category_map(parquet_paths: List[str], output_path: str = "category_ma
     return json_ready_map
 
 
-def load_and_prepare_for_linear(parquet_paths: List[str], category_map_path: str = "category_map.json") -> pd.DataFrame:
+def build_linear_column_index(category_map: Dict[str, List[Any]], output_path: Optional[str] = None) -> List[str]:
+    """
+    Returns the one-hot column names for the linear categoricals, in the same order
+    and with the same names `pd.get_dummies(..., drop_first=True)` produces
+    (e.g. 'D_63_CR', 'D_87_1.0'). Optionally persists them as JSON.
+    """
+    columns = []
+    for col in LINEAR_CATEGORICAL_COLS:
+        if col in category_map:
+            columns.extend(f"{col}_{cat}" for cat in category_map[col][1:])
+
+    if output_path is not None:
+        with open(output_path, 'w') as f:
+            json.dump(columns, f)
+        print(f"Linear column index saved to {output_path}")
+    return columns
+
+
+def encode_onehot_sparse(df: pd.DataFrame, category_map: Dict[str, List[Any]]) -> sp.csr_matrix:
+    """
+    One-hot encodes the linear categoricals of `df` into a CSR matrix whose columns
+    follow `build_linear_column_index(category_map)` (first category dropped).
+    Values outside the category map, NaNs and absent columns encode as all-zero rows.
+    """
+    row_blocks, col_blocks = [], []
+    offset = 0
+    for col in LINEAR_CATEGORICAL_COLS:
+        if col not in category_map:
+            continue
+        categories = category_map[col]
+        if col in df.columns:
+            values = df[col]
+            # set_categories recodes against the map order (astype is a no-op for
+            # an unordered categorical holding the same categories in another order)
+            if not isinstance(values.dtype, pd.CategoricalDtype):
+                values = values.astype('category')
+            codes = values.cat.set_categories(categories).cat.codes.to_numpy()
+            rows = np.flatnonzero(codes > 0)
+            row_blocks.append(rows)
+            col_blocks.append(offset + codes[rows].astype(np.int64) - 1)
+        offset += max(len(categories) - 1, 0)
+
+    rows = np.concatenate(row_blocks) if row_blocks else np.empty(0, dtype=np.int64)
+    cols = np.concatenate(col_blocks) if col_blocks else np.empty(0, dtype=np.int64)
+    data = np.ones(len(rows), dtype=np.float32)
+    return sp.csr_matrix((data, (rows, cols)), shape=(len(df), offset))
+
+
+def load_and_prepare_for_linear(parquet_paths: List[str], category_map_path: str = "category_map.json",
+                                sparse: bool = False) -> Union[pd.DataFrame, Tuple[pd.DataFrame, sp.csr_matrix]]:
+    """
+    Loads Parquet parts and one-hot encodes the linear categoricals using a fixed
+    category map.
+
+    Args:
+        parquet_paths: List of Parquet files to load.
+        category_map_path: Path to category_map.json.
+        sparse: If True, keep the one-hot block out of the DataFrame and return it as
+            a CSR matrix whose columns follow `build_linear_column_index`.
+
+    Returns:
+        Dense mode: a single DataFrame with `pd.get_dummies` columns.
+        Sparse mode: (DataFrame without the categorical columns, CSR one-hot matrix),
+        row-aligned.
+    """
     with open(category_map_path, 'r') as f:
         category_map = json.load(f)
 
     dfs = []
-    for path in parquet_paths:
-        df = pd.read_parquet(path)
+    onehot_blocks = []
+    for _, df in prefetch_parquet(parquet_paths):
+        if sparse:
+            onehot_blocks.append(encode_onehot_sparse(df, category_map))
+            df = df.drop(columns=[col for col in LINEAR_CATEGORICAL_COLS if col in df.columns])
+            dfs.append(df)
+            continue
 
         # Enforce categories for all categorical columns that will be one-hot encoded
         for col, categories in category_map.items():
@@ -365,9 +925,85 @@ def load_and_prepare_for_linear(parquet_paths: List[str], category_map_path: str
 
         dfs.append(df)
 
+    if sparse:
+        return pd.concat(dfs, ignore_index=True), sp.vstack(onehot_blocks, format='csr')
     return pd.concat(dfs, ignore_index=True)
 
 
+def _apply_category_map(df: pd.DataFrame, category_map: Dict[str, List[Any]]) -> pd.DataFrame:
+    """Recodes categorical columns to exactly the categories (and order) of the map."""
+    for col, categories in category_map.items():
+        if col in df.columns:
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].cat.set_categories(categories)
+            else:
+                df[col] = df[col].astype(pd.CategoricalDtype(categories=categories, ordered=False))
+    return df
+
+
+def iter_prepare_for_linear(parquet_paths: List[str], category_map_path: str = "category_map.json") -> Iterator[pd.DataFrame]:
+    """
+    Streaming variant of `load_and_prepare_for_linear`: yields one one-hot encoded
+    batch per Parquet part instead of concatenating them.
+
+    Every batch has the same dummy columns (`build_linear_column_index` order,
+    bool dtype) regardless of which categories occur in that part, so batches can
+    be appended to a single Parquet file (see `write_parquet_batches`).
+    """
+    with open(category_map_path, 'r') as f:
+        category_map = json.load(f)
+    onehot_cols = build_linear_column_index(category_map)
+
+    for _, df in prefetch_parquet(parquet_paths):
+        onehot = encode_onehot_sparse(df, category_map)
+        df = df.drop(columns=[col for col in LINEAR_CATEGORICAL_COLS if col in df.columns])
+        dummies = pd.DataFrame(onehot.toarray().astype(bool), columns=onehot_cols, index=df.index)
+        yield pd.concat([df, dummies], axis=1)
+
+
+def iter_prepare_for_tree(parquet_paths: List[str], category_map_path: Optional[str] = None) -> Iterator[pd.DataFrame]:
+    """
+    Streaming variant of `load_and_prepare_for_tree`: yields one batch per Parquet part.
+    With a category map, categorical columns get identical categories in every batch.
+    """
+    category_map = {}
+    if category_map_path is not None:
+        with open(category_map_path, 'r') as f:
+            category_map = json.load(f)
+
+    for _, df in prefetch_parquet(parquet_paths):
+        yield _apply_category_map(df, category_map)
+
+
+def write_parquet_batches(batches: Iterable[pd.DataFrame], output_path: str) -> List[str]:
+    """
+    Appends DataFrame batches to one Parquet file through a single ParquetWriter,
+    so only one batch is held in memory at a time. The first batch fixes the
+    schema; later batches are reordered and cast to it.
+
+    Returns:
+        Column names of the written file.
+    """
+    writer = None
+    schema = None
+    try:
+        for df in batches:
+            if writer is None:
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                schema = table.schema
+                writer = pq.ParquetWriter(output_path, schema)
+            else:
+                table = pa.Table.from_pandas(df[schema.names], schema=schema, preserve_index=False)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if schema is None:
+        raise ValueError(f"No batches to write to {output_path}")
+    return schema.names
+
+
 def load_and_prepare_for_tree(parquet_paths: List[str]) -> pd.DataFrame:
     """
     Loads data for tree-based models (preserves categorical dtypes).
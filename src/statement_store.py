@@ -0,0 +1,177 @@
+"""
+AmEx Default Prediction - Customer-Sorted Statement Store.
+
+Rewrites the preprocessed Parquet parts into a single Parquet file sorted by
+(customer_key, S_2), plus a CSR-style offsets array:
+
+    <store_dir>/statements.parquet   rows sorted by (customer_key, S_2)
+    <store_dir>/offsets.npy          int64, length n_customers + 1
+
+The statements of customer k are rows [offsets[k], offsets[k + 1]). Row groups
+always end on a customer boundary, so a linear scan over row groups never splits
+a customer, and a single-customer lookup reads exactly one row group.
+
+Usage:
+    from src.statement_store import build_statement_store, StatementStore
+"""
+
+import os
+import shutil
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from src.preprocessing import CUSTOMER_KEY_COL
+
+
+STATEMENTS_FILE = "statements.parquet"
+OFFSETS_FILE = "offsets.npy"
+SPILL_DIR_NAME = "_spill"
+
+
+def _customer_boundaries(offsets: np.ndarray, rows_per_group: int) -> np.ndarray:
+    """
+    Row positions (within `offsets`) that split its rows into groups of roughly
+    `rows_per_group` rows without splitting any customer. Includes 0 and the end.
+    """
+    n_rows = int(offsets[-1] - offsets[0])
+    targets = offsets[0] + np.arange(rows_per_group, n_rows, rows_per_group)
+    cuts = offsets[np.searchsorted(offsets, targets, side='left')]
+    return np.unique(np.concatenate([[offsets[0]], cuts, [offsets[-1]]])) - offsets[0]
+
+
+def build_statement_store(parquet_paths: List[str], store_dir: str, customer_col: str = CUSTOMER_KEY_COL,
+                          time_col: str = "S_2", rows_per_bucket: int = 5_000_000,
+                          rows_per_group: int = 250_000) -> np.ndarray:
+    """
+    Builds a customer-sorted statement store from preprocessed Parquet parts.
+
+    External bucket sort, so memory is bounded by `rows_per_bucket` rows:
+    1. Count rows per customer key (reads only the key column) -> offsets.
+    2. Split every part into key-range buckets of ~`rows_per_bucket` rows (spill files).
+    3. Sort each bucket by (customer, time) and append it to the store in
+       customer-aligned row groups of ~`rows_per_group` rows.
+
+    Args:
+        parquet_paths: Preprocessed parts (must contain the int `customer_col`).
+        store_dir: Output directory (replaced if it exists).
+        customer_col: Dense integer customer key column.
+        time_col: Statement date column used as the secondary sort key.
+
+    Returns:
+        The offsets array (also saved as offsets.npy).
+    """
+    if os.path.exists(store_dir):
+        shutil.rmtree(store_dir)
+    spill_dir = os.path.join(store_dir, SPILL_DIR_NAME)
+    os.makedirs(spill_dir)
+
+    # 1. Rows per customer key
+    counts = np.zeros(0, dtype=np.int64)
+    for path in parquet_paths:
+        keys = pq.read_table(path, columns=[customer_col]).column(0).to_numpy()
+        part_counts = np.bincount(keys)
+        if len(part_counts) > len(counts):
+            counts = np.pad(counts, (0, len(part_counts) - len(counts)))
+        counts[:len(part_counts)] += part_counts
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    # Key ranges [bucket_keys[b], bucket_keys[b + 1]) holding ~rows_per_bucket rows each
+    bucket_keys = np.searchsorted(offsets, np.arange(0, offsets[-1], rows_per_bucket), side='right') - 1
+    bucket_keys = np.unique(np.concatenate([bucket_keys, [len(counts)]]))
+
+    # 2. Spill every part into its key-range buckets
+    schema = pa.unify_schemas([pq.read_schema(path) for path in parquet_paths], promote_options="permissive")
+    for i, path in enumerate(parquet_paths):
+        table = pq.read_table(path).select(schema.names).cast(schema)
+        buckets = np.searchsorted(bucket_keys, table.column(customer_col).to_numpy(), side='right') - 1
+        for b in np.unique(buckets):
+            bucket_path = os.path.join(spill_dir, f"bucket{b:05d}")
+            os.makedirs(bucket_path, exist_ok=True)
+            rows = pa.array(np.flatnonzero(buckets == b))
+            pq.write_table(table.take(rows), os.path.join(bucket_path, f"part{i:05d}.parquet"))
+
+    # 3. Sort bucket by bucket and append in customer-aligned row groups
+    sort_keys = [(customer_col, "ascending")]
+    if time_col in schema.names:
+        sort_keys.append((time_col, "ascending"))
+
+    with pq.ParquetWriter(os.path.join(store_dir, STATEMENTS_FILE), schema) as writer:
+        for b in range(len(bucket_keys) - 1):
+            bucket_path = os.path.join(spill_dir, f"bucket{b:05d}")
+            if not os.path.isdir(bucket_path):
+                continue
+            spills = sorted(os.listdir(bucket_path))
+            table = pa.concat_tables([pq.read_table(os.path.join(bucket_path, f)) for f in spills])
+            table = table.take(pc.sort_indices(table, sort_keys=sort_keys))
+
+            bucket_offsets = offsets[bucket_keys[b]:bucket_keys[b + 1] + 1]
+            cuts = _customer_boundaries(bucket_offsets, rows_per_group)
+            for start, end in zip(cuts[:-1], cuts[1:]):
+                writer.write_table(table.slice(start, end - start), row_group_size=int(end - start))
+            shutil.rmtree(bucket_path)
+
+    shutil.rmtree(spill_dir)
+    np.save(os.path.join(store_dir, OFFSETS_FILE), offsets)
+
+    print(f"Statement store saved to {store_dir} ({len(counts):,} customers, {offsets[-1]:,} rows)")
+    return offsets
+
+
+class StatementStore:
+    """
+    Read access to a store written by `build_statement_store`.
+
+    Customer k's statements are rows `customer_slice(k)` of statements.parquet.
+    """
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        self.offsets = np.load(os.path.join(store_dir, OFFSETS_FILE))
+        self._file = pq.ParquetFile(os.path.join(store_dir, STATEMENTS_FILE))
+        group_rows = [self._file.metadata.row_group(i).num_rows for i in range(self._file.num_row_groups)]
+        self.row_group_starts = np.concatenate([[0], np.cumsum(group_rows)]).astype(np.int64)
+
+    @property
+    def n_customers(self) -> int:
+        return len(self.offsets) - 1
+
+    @property
+    def n_rows(self) -> int:
+        return int(self.offsets[-1])
+
+    @property
+    def columns(self) -> List[str]:
+        return self._file.schema_arrow.names
+
+    def customer_slice(self, customer_key: int) -> slice:
+        return slice(int(self.offsets[customer_key]), int(self.offsets[customer_key + 1]))
+
+    def read_customer(self, customer_key: int, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """Reads one customer's statements (one row group, O(1) lookup)."""
+        rows = self.customer_slice(customer_key)
+        group = int(np.searchsorted(self.row_group_starts, rows.start, side='right') - 1)
+        table = self._file.read_row_group(group, columns=columns)
+        start = rows.start - int(self.row_group_starts[group])
+        return table.slice(start, rows.stop - rows.start).to_pandas()
+
+    def iter_batches(self, columns: Optional[List[str]] = None) -> Iterator[Tuple[pd.DataFrame, np.ndarray]]:
+        """
+        Linear scan over the store, one row group at a time.
+
+        Yields:
+            (batch, local_offsets): the batch holds whole customers; customer j of
+            the batch spans rows [local_offsets[j], local_offsets[j + 1]).
+        """
+        for group in range(self._file.num_row_groups):
+            start, end = self.row_group_starts[group], self.row_group_starts[group + 1]
+            first = int(np.searchsorted(self.offsets, start, side='right') - 1)
+            last = int(np.searchsorted(self.offsets, end, side='left'))
+            local_offsets = self.offsets[first:last + 1] - start
+            # Customers without statements produce empty segments; drop them
+            local_offsets = np.unique(local_offsets)
+            yield self._file.read_row_group(group, columns=columns).to_pandas(), local_offsets
@@ -0,0 +1,183 @@
+"""
+AmEx Default Prediction - Customer-Level Training Data.
+
+Builds the model matrix with one row per customer instead of one row per
+statement: the customer's latest statement (linear_*.parquet) joined with the
+customer-level aggregates (customer_level_*.parquet) and, for training, the label.
+
+The statement-level merge repeats every customer's aggregates on each of its
+~13 statements; the label is per customer, so the extra rows only add time and
+memory. The history itself is already summarized by the aggregates.
+
+It also builds (or opens) the cached train/test model matrices shared by all
+trainers (load_or_build_train_matrix / load_or_build_test_matrix, see
+src/feature_cache.py), at statement or customer level.
+
+Usage:
+    from src.training_data import build_customer_frame, load_or_build_train_matrix
+"""
+
+import json
+import os
+from typing import List, Optional
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from src.aggregation import segment_tail, sort_segments, time_sort_key
+from src.feature_cache import (
+    FeatureCacheWriter,
+    FeatureMatrix,
+    feature_cache_key,
+    open_feature_cache,
+    write_feature_cache,
+)
+from src.preprocessing import CUSTOMER_ID_COL, CUSTOMER_KEY_COL, encode_customer_ids, load_customer_index
+
+
+TARGET_COL = "target"
+TEST_MERGE_CHUNK_ROWS = 500_000
+
+
+def _last_rows(df: pd.DataFrame, customer_col: str, time_col: str) -> pd.DataFrame:
+    """Latest dated row (by time_col, ties: last in file order) of every customer in df, sorted by key."""
+    times = time_sort_key(pd.to_datetime(df[time_col], errors="coerce")) if time_col in df.columns else None
+    order, _, offsets = sort_segments(df[customer_col].to_numpy(), times)
+    rows, _, _ = segment_tail(offsets, 1)
+    return df.iloc[order[rows]].reset_index(drop=True)
+
+
+def last_statements(linear_path: str, customer_col: str = CUSTOMER_KEY_COL, time_col: str = "S_2",
+                    columns: Optional[List[str]] = None, batch_rows: int = 1_000_000) -> pd.DataFrame:
+    """
+    Latest statement of every customer in `linear_path`, one row per customer.
+
+    Reads the file in batches of `batch_rows` rows and keeps only each batch's
+    per-customer latest rows, so memory is bounded by customers, not statements
+    (customers may span batches; a final pass picks the latest candidate).
+    """
+    parquet_file = pq.ParquetFile(linear_path)
+    candidates = []
+    for batch in parquet_file.iter_batches(batch_size=batch_rows, columns=columns):
+        candidates.append(_last_rows(batch.to_pandas(), customer_col, time_col))
+    if not candidates:
+        return parquet_file.schema_arrow.empty_table().to_pandas()
+    return _last_rows(pd.concat(candidates, ignore_index=True), customer_col, time_col)
+
+
+def build_customer_frame(linear_path: str, aggregate_path: str, labels_path: Optional[str] = None,
+                         customer_index_path: Optional[str] = None, customer_col: str = CUSTOMER_KEY_COL,
+                         time_col: str = "S_2") -> pd.DataFrame:
+    """
+    One row per customer: latest statement + customer-level aggregates (+ label).
+
+    Args:
+        linear_path: Statement-level features (linear_{train|test}.parquet).
+        aggregate_path: Customer-level aggregates (customer_level_{train|test}.parquet).
+        labels_path: train_labels.csv; joined when the statements carry no target.
+        customer_index_path: Customer index used to encode the label file's customer_ID.
+        customer_col: Dense integer customer key column.
+        time_col: Statement date; the latest statement per customer is kept.
+
+    Returns:
+        DataFrame sorted by `customer_col`. Columns present in both inputs are
+        taken from the aggregates.
+    """
+    df = last_statements(linear_path, customer_col, time_col)
+    df_cust = pd.read_parquet(aggregate_path)
+
+    overlap = [c for c in df.columns if c in df_cust.columns and c != customer_col]
+    df = df.drop(columns=overlap).merge(df_cust, on=customer_col, how="left")
+
+    if labels_path is not None and TARGET_COL not in df.columns:
+        df_lbl = pd.read_csv(labels_path)
+        df_lbl[customer_col] = encode_customer_ids(df_lbl.pop(CUSTOMER_ID_COL), load_customer_index(customer_index_path))
+        df = df.merge(df_lbl, on=customer_col, how="left")
+
+    print(f"Customer-level frame: {df.shape[0]:,} customers x {df.shape[1]:,} columns")
+    return df
+
+
+def model_features(columns: List[str], linear_path: str, feature_json: str) -> List[str]:
+    """
+    Model features among `columns` (the merged frame): the listed customer-level
+    features plus the linear columns, without the customer key, target and S_2.
+    """
+    with open(feature_json, "r") as f:
+        customer_cols = json.load(f)
+    linear_cols = [c for c in pq.read_schema(linear_path).names if c not in [CUSTOMER_KEY_COL, TARGET_COL]]
+    exclude_cols = {CUSTOMER_KEY_COL, TARGET_COL, "S_2"}
+    present = set(columns)
+    return [c for c in sorted(set(customer_cols + linear_cols)) if c in present and c not in exclude_cols]
+
+
+def load_or_build_train_matrix(cache_dir: str, linear_path: str, aggregate_path: str, labels_path: str,
+                               feature_json: str, customer_index_path: str,
+                               customer_level: bool = False) -> FeatureMatrix:
+    """
+    Opens the cached training matrix for these inputs, building it first if missing.
+
+    The statement-level matrix merges the aggregates onto every statement of
+    linear_path; with `customer_level` it has one row per customer
+    (build_customer_frame). Labels are joined from `labels_path` if the linear
+    table carries no target. The cache key covers every input file, including
+    the customer index, so a rebuilt input never reuses a stale entry.
+    """
+    inputs = [linear_path, aggregate_path, labels_path, feature_json, customer_index_path]
+    path = os.path.join(cache_dir, feature_cache_key(inputs, options={"split": "train",
+                                                                      "customer_level": customer_level}))
+    train_matrix = open_feature_cache(path)
+    if train_matrix is not None:
+        print(f"Using cached training matrix: {train_matrix.path}")
+        return train_matrix
+
+    if customer_level:
+        print("Building customer-level training matrix...")
+        df_train = build_customer_frame(str(linear_path), str(aggregate_path), labels_path=str(labels_path),
+                                        customer_index_path=str(customer_index_path))
+    else:
+        print("Loading and merging training tables...")
+        df_lin = pd.read_parquet(linear_path)
+        if TARGET_COL not in df_lin.columns:
+            df_lbl = pd.read_csv(labels_path)
+            df_lbl[CUSTOMER_KEY_COL] = encode_customer_ids(df_lbl.pop(CUSTOMER_ID_COL),
+                                                           load_customer_index(str(customer_index_path)))
+            df_lin = df_lin.merge(df_lbl, on=CUSTOMER_KEY_COL, how="left")
+        df_train = df_lin.merge(pd.read_parquet(aggregate_path), on=CUSTOMER_KEY_COL, how="left")
+        del df_lin
+    print(f"Train frame: {df_train.shape}, has target: {TARGET_COL in df_train.columns}")
+
+    features = model_features(df_train.columns, linear_path, feature_json)
+    print(f"Total features: {len(features)}")
+    return write_feature_cache(path, df_train, features, target_col=TARGET_COL, inputs=inputs)
+
+
+def load_or_build_test_matrix(cache_dir: str, linear_path: str, aggregate_path: str, features: List[str],
+                              customer_index_path: str, customer_level: bool = False,
+                              chunk_rows: int = TEST_MERGE_CHUNK_ROWS) -> FeatureMatrix:
+    """
+    Opens the cached test matrix with columns `features`, building it first if missing.
+
+    The statement-level matrix is merged `chunk_rows` statements at a time and
+    written straight into the cache, so the merged test frame is never in memory.
+    """
+    inputs = [linear_path, aggregate_path, customer_index_path]
+    path = os.path.join(cache_dir, feature_cache_key(inputs, features=features,
+                                                     options={"split": "test", "customer_level": customer_level}))
+    test_matrix = open_feature_cache(path)
+    if test_matrix is not None:
+        print(f"Using cached test matrix: {test_matrix.path}")
+        return test_matrix
+
+    if customer_level:
+        print("Building customer-level test matrix...")
+        return write_feature_cache(path, build_customer_frame(str(linear_path), str(aggregate_path)), features,
+                                   inputs=inputs)
+
+    print(f"Merging test tables in chunks of {chunk_rows:,} rows...")
+    test_cust = pd.read_parquet(aggregate_path)
+    test_lin = pd.read_parquet(linear_path)
+    with FeatureCacheWriter(path, features, len(test_lin), inputs=inputs) as writer:
+        for start in range(0, len(test_lin), chunk_rows):
+            writer.append(test_lin.iloc[start:start + chunk_rows].merge(test_cust, on=CUSTOMER_KEY_COL, how="left"))
+    return open_feature_cache(path)
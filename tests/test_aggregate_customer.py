@@ -0,0 +1,89 @@
+"""Tests for scripts/aggregate_customer.py on a few synthetic parquet parts."""
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "scripts"))
+
+import aggregate_customer as agg  # noqa: E402
+
+
+def write_parts(parts_dir: Path, n_parts: int = 3, customers_per_part: int = 4) -> None:
+    rng = np.random.default_rng(0)
+    parts_dir.mkdir(parents=True)
+    for i in range(n_parts):
+        keys = np.repeat(np.arange(customers_per_part) + i * customers_per_part, 3).astype(np.int32)
+        pd.DataFrame({
+            agg.CUSTOMER_COL: keys,
+            "S_2": pd.to_datetime("2018-01-01") + pd.to_timedelta(np.tile([0, 31, 62], customers_per_part), "D"),
+            "P_2": rng.random(len(keys)).astype(np.float32),
+            "B_1": rng.random(len(keys)).astype(np.float32),
+            "D_63": rng.integers(0, 3, len(keys)).astype(np.float32),
+        }).to_parquet(parts_dir / f"train_part{i}.parquet", index=False)
+
+
+def run_main(monkeypatch, parts_dir: Path, out_dir: Path, *extra: str) -> None:
+    monkeypatch.setattr(sys, "argv", ["aggregate_customer.py", "train", "--parts-dir", str(parts_dir),
+                                      "--out-dir", str(out_dir), "--prefetch", "0", *extra])
+    agg.main()
+
+
+def recording_aggregates(monkeypatch, processed: list, fail_on: str = None) -> None:
+    """Patches per_part_aggregates to record the parts it processes and fail on `fail_on`."""
+    aggregate_part = agg.per_part_aggregates
+
+    def per_part_aggregates(part_path, *args, **kwargs):
+        processed.append(Path(part_path).name)
+        if Path(part_path).name == fail_on:
+            raise RuntimeError("interrupted")
+        return aggregate_part(part_path, *args, **kwargs)
+
+    monkeypatch.setattr(agg, "per_part_aggregates", per_part_aggregates)
+
+
+def test_interrupted_run_reuses_completed_parts(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    parts_dir = tmp_path / "parts"
+    write_parts(parts_dir)
+    run_main(monkeypatch, parts_dir, tmp_path / "fresh")
+
+    processed = []
+    with monkeypatch.context() as m:
+        recording_aggregates(m, processed, fail_on="train_part2.parquet")
+        with pytest.raises(SystemExit):
+            run_main(m, parts_dir, tmp_path / "out")
+    assert not (tmp_path / "out" / "customer_level_train.parquet").exists()
+
+    processed.clear()
+    with monkeypatch.context() as m:
+        recording_aggregates(m, processed)
+        run_main(m, parts_dir, tmp_path / "out")
+    assert processed == ["train_part2.parquet"]
+    assert not [p for p in (tmp_path / "out" / agg.TMP_DIR_NAME).iterdir() if p.is_dir()]
+    pd.testing.assert_frame_equal(pd.read_parquet(tmp_path / "out" / "customer_level_train.parquet"),
+                                  pd.read_parquet(tmp_path / "fresh" / "customer_level_train.parquet"))
+
+
+def test_undated_statement_is_never_the_latest(tmp_path):
+    # customer 0's undated statement comes last in the file; customer 1 has only dated ones
+    part = tmp_path / "train_part0.parquet"
+    pd.DataFrame({
+        agg.CUSTOMER_COL: np.array([0, 0, 0, 1, 1], dtype=np.int32),
+        "S_2": pd.to_datetime(["2018-01-01", "2018-02-01", None, "2018-01-01", "2018-02-01"]),
+        "P_2": np.array([0.1, 0.2, 0.3, 0.4, 0.5], dtype=np.float32),
+        "D_63": ["CO", "CR", "XZ", "CO", "CL"],
+    }).to_parquet(part, index=False)
+
+    agg.per_part_aggregates(str(part), str(tmp_path), ["P_2"], ["D_63"], last_k=2, last_cols=["P_2"])
+    last = pd.read_parquet(tmp_path / "train_part0_last.parquet")
+    cat = pd.read_parquet(tmp_path / "train_part0_cat.parquet").set_index(agg.CUSTOMER_COL)
+
+    assert last[agg.CUSTOMER_COL].tolist() == [0, 0, 1, 1]
+    assert last["S_2"].tolist() == list(pd.to_datetime(["2018-01-01", "2018-02-01"] * 2))
+    assert last["P_2"].tolist() == pytest.approx([0.1, 0.2, 0.4, 0.5])
+    assert cat["D_63_last"].tolist() == ["CR", "CL"]
+    assert cat["S_2"].tolist() == list(pd.to_datetime(["2018-02-01", "2018-02-01"]))
@@ -0,0 +1,21 @@
+"""Tests for src/training_data.py."""
+
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from src.training_data import _last_rows  # noqa: E402
+
+
+def test_last_rows_skip_undated_statements():
+    df = pd.DataFrame({
+        "customer_key": [0, 0, 0, 1],
+        "S_2": ["2018-01-01", "2018-02-01", None, None],
+        "P_2": [0.1, 0.2, 0.3, 0.4],
+    })
+    last = _last_rows(df, "customer_key", "S_2")
+    # customer 1 has no dated statement: its only row is still its last
+    assert last["P_2"].tolist() == [0.2, 0.4]